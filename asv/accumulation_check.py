@@ -0,0 +1,83 @@
+import argparse
+import numpy as np
+import torch
+import torch.optim as optim
+import model as model_
+from train_loop import TrainLoop
+from utils.optimizer import TransformerOptimizer
+from throughput_check import SyntheticLoader
+
+def make_trainer(args, dropout_prob, recompute=False):
+	torch.manual_seed(args.seed)
+	model = model_.TDNN(n_z=64, nh=1, n_h=64, proj_size=args.n_speakers, ncoef=args.ncoef, sm_type='softmax', dropout_prob=dropout_prob).double()
+	# Zero learning rate: the step leaves weights unchanged and gradients in place for comparison
+	optimizer = TransformerOptimizer(optim.SGD(model.parameters(), lr=0.0), lr=0.0)
+	return TrainLoop(model, optimizer, None, None, max_gnorm=1e10, cuda=False, device=torch.device('cpu'), accumulation_steps=args.accumulation_steps, recompute=recompute)
+
+def freeze_batch_norm(model):
+	# Batch statistics depend on how examples are split into micro-batches. Running statistics make the encoder
+	# per-example, so an accumulated step can be compared with a single large batch
+	for module in model.modules():
+		if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+			module.eval()
+			module.train = lambda mode=True, module=module: module
+
+def grads(model):
+	return [param.grad.clone() if param.grad is not None else torch.zeros_like(param) for param in model.parameters()]
+
+def max_err(tensors_1, tensors_2):
+	return max([(t_1.double()-t_2.double()).abs().max().item() for t_1, t_2 in zip(tensors_1, tensors_2)])
+
+def step(trainer, batches, accumulated, seed):
+	np.random.seed(seed)
+	torch.manual_seed(seed)
+	if accumulated:
+		losses = trainer.train_step_accumulated(batches)
+	else:
+		losses = trainer.train_step(merge(batches))
+	losses = [float(loss) for loss in losses]
+	return losses, grads(trainer.model), [buffer.clone() for buffer in trainer.model.buffers()]
+
+def merge(batches):
+	return [torch.cat(tensors, 0) for tensors in zip(*batches)]
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Compare accumulated steps against one large batch, and recomputation against stored activations')
+	parser.add_argument('--n-speakers', type=int, default=8, metavar='N', help='Number of synthetic speakers (default: 8)')
+	parser.add_argument('--batch-size', type=int, default=4, metavar='N', help='Micro-batch size (default: 4)')
+	parser.add_argument('--accumulation-steps', type=int, default=3, metavar='N', help='Number of micro-batches per step (default: 3)')
+	parser.add_argument('--ncoef', type=int, default=23, metavar='N', help='number of MFCCs (default: 23)')
+	parser.add_argument('--n-frames', type=int, default=60, metavar='N', help='number of frames per utterance (default: 60)')
+	parser.add_argument('--trials', type=int, default=3, metavar='N', help='Number of random steps (default: 3)')
+	parser.add_argument('--seed', type=int, default=1, metavar='S', help='random seed (default: 1)')
+	args = parser.parse_args()
+
+	dataset = SyntheticLoader(args.n_speakers, args.batch_size*args.accumulation_steps*args.trials, args.ncoef, args.n_frames, seed=args.seed)
+	loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+	batches = [[x.double() if x.is_floating_point() else x for x in batch] for batch in loader]
+
+	for i in range(args.trials):
+
+		micro_batches = batches[i*args.accumulation_steps:(i+1)*args.accumulation_steps]
+
+		# Accumulated step vs a single batch holding all micro-batches
+		trainer = make_trainer(args, dropout_prob=0.0)
+		freeze_batch_norm(trainer.model)
+		ref_losses, ref_grads, _ = step(trainer, micro_batches, accumulated=False, seed=i)
+
+		for recompute in [False, True]:
+			trainer = make_trainer(args, dropout_prob=0.0, recompute=recompute)
+			freeze_batch_norm(trainer.model)
+			losses, acc_grads, _ = step(trainer, micro_batches, accumulated=True, seed=i)
+			loss_err, grad_err = abs(ref_losses[0]-losses[0]), max_err(ref_grads, acc_grads)
+			print('Large batch vs {} micro-batches (recompute: {}), loss err: {:.2e}, max grad err: {:.2e}'.format(args.accumulation_steps, recompute, loss_err, grad_err))
+			assert loss_err<1e-10 and grad_err<1e-10
+
+		# Recomputation replays dropout masks and leaves batch norm statistics as a single pass would
+		results = [step(make_trainer(args, dropout_prob=0.25, recompute=recompute), micro_batches, accumulated=True, seed=i) for recompute in [False, True]]
+		grad_err, buffer_err = max_err(results[0][1], results[1][1]), max_err(results[0][2], results[1][2])
+		print('Recompute vs stored activations, max grad err: {:.2e}, max buffer err: {:.2e}'.format(grad_err, buffer_err))
+		assert grad_err<1e-10 and buffer_err<1e-10
+
+	print('OK')
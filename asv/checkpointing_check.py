@@ -0,0 +1,113 @@
+import argparse
+import time
+import torch
+import model as model_
+
+MODELS = {'resnet_stats': model_.ResNet_stats, 'resnet_mfcc': model_.ResNet_mfcc, 'resnet_lstm': model_.ResNet_lstm, 'resnet_small': model_.ResNet_small, 'resnet_large': model_.ResNet_large}
+
+def make_model(args, stages, device):
+	torch.manual_seed(args.seed)
+	return MODELS[args.model](ncoef=args.ncoef, proj_size=100, sm_type='softmax', checkpoint_stages=stages).to(device).train()
+
+def parse_stages(config):
+	return [] if config=='none' else [int(stage) for stage in config.split(',')]
+
+def forward_backward(model, x):
+	# Bytes of the tensors kept for backward, parameters excluded. The inputs of checkpointed stages are kept by the
+	# checkpoint itself and are added with pre-hooks
+	params = set([param.untyped_storage().data_ptr() for param in model.parameters()])
+	saved, recording = {}, [True]
+
+	def pack(tensor):
+		storage = tensor.untyped_storage()
+		if recording[0] and storage.data_ptr() not in params:
+			saved[storage.data_ptr()] = storage.nbytes()
+		return tensor
+
+	def stage_input(module, inputs):
+		pack(inputs[0])
+
+	hooks = [getattr(model, 'layer{}'.format(stage)).register_forward_pre_hook(stage_input) for stage in model.checkpoint_stages]
+
+	with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+		mu, fc = model(x)
+	recording[0] = False
+
+	(mu.pow(2).mean() + fc.pow(2).mean()).backward()
+
+	for hook in hooks:
+		hook.remove()
+
+	return sum(saved.values())/2**20
+
+def benchmark(args, stages, batch_size, device):
+	model = make_model(args, stages, device)
+	x = torch.randn(batch_size, 1, args.ncoef, args.n_frames, device=device)
+
+	forward_backward(model, x)
+	model.zero_grad(set_to_none=True)
+
+	if device.type=='cuda':
+		torch.cuda.synchronize(device)
+		torch.cuda.reset_peak_memory_stats(device)
+		base = torch.cuda.memory_allocated(device)
+
+	start = time.time()
+	for step in range(args.steps):
+		model.zero_grad(set_to_none=True)
+		saved = forward_backward(model, x)
+	if device.type=='cuda':
+		torch.cuda.synchronize(device)
+	elapsed = time.time()-start
+
+	peak = (torch.cuda.max_memory_allocated(device)-base)/2**20 if device.type=='cuda' else float('nan')
+
+	return saved, peak, args.steps*batch_size/elapsed
+
+def check_gradients(args, stages, device):
+	# Recomputed stages give the gradients and batch norm statistics of stored activations
+	x = torch.randn(args.batch_sizes[0], 1, args.ncoef, args.n_frames, device=device)
+	results = []
+	for stages_ in [[], stages]:
+		model = make_model(args, stages_, device)
+		forward_backward(model, x)
+		# The discriminator and output layers are not used by forward and have no gradient
+		results.append(([param.grad for param in model.parameters() if param.grad is not None], [buffer.float() for buffer in model.buffers()]))
+
+	grad_err = max([(g_1-g_2).abs().max().item() for g_1, g_2 in zip(results[0][0], results[1][0])])
+	buffer_err = max([(b_1-b_2).abs().max().item() for b_1, b_2 in zip(results[0][1], results[1][1])])
+
+	return grad_err, buffer_err
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Activation memory and throughput of ResNet encoders with and without per-stage activation checkpointing')
+	parser.add_argument('--model', choices=list(MODELS), default='resnet_lstm', help='Model arch (default: resnet_lstm)')
+	parser.add_argument('--configs', nargs='+', default=['none', '1', '1,2', '1,2,3,4'], metavar='STAGES', help='Comma separated checkpointed stages per run, or none (default: none 1 1,2 1,2,3,4)')
+	parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 16, 32], metavar='N', help='Batch sizes (default: 8 16 32)')
+	parser.add_argument('--steps', type=int, default=3, metavar='N', help='Number of timed steps per run (default: 3)')
+	parser.add_argument('--ncoef', type=int, default=23, metavar='N', help='number of MFCCs (default: 23)')
+	parser.add_argument('--n-frames', type=int, default=800, metavar='N', help='number of frames per utterance (default: 800)')
+	parser.add_argument('--no-cuda', action='store_true', default=False, help='Disables GPU use')
+	parser.add_argument('--seed', type=int, default=1, metavar='S', help='random seed (default: 1)')
+	args = parser.parse_args()
+
+	device = torch.device('cuda:0' if torch.cuda.is_available() and not args.no_cuda else 'cpu')
+
+	print('{:<12}{:>8}{:>16}{:>12}{:>12}'.format('Stages', 'Batch', 'Saved (MB)', 'Peak (MB)', 'Ex/s'))
+	for config in args.configs:
+		stages = parse_stages(config)
+		for batch_size in args.batch_sizes:
+			try:
+				saved, peak, speed = benchmark(args, stages, batch_size, device)
+				print('{:<12}{:>8}{:>16.1f}{:>12.1f}{:>12.2f}'.format(config, batch_size, saved, peak, speed))
+			except torch.cuda.OutOfMemoryError:
+				print('{:<12}{:>8}{:>16}'.format(config, batch_size, 'OOM'))
+				torch.cuda.empty_cache()
+
+		if stages:
+			grad_err, buffer_err = check_gradients(args, stages, device)
+			print('Stages {} vs stored activations, max grad err: {:.2e}, max buffer err: {:.2e}'.format(config, grad_err, buffer_err))
+			assert grad_err<1e-4 and buffer_err<1e-6
+
+	print('OK')
@@ -23,30 +23,39 @@ class Loader(Dataset):
 
 	def __getitem__(self, index):
 
+		# BucketBatchSampler gives (index, n_frames): all examples of a batch are cropped to its shortest utterance
+		index, n_frames = index if isinstance(index, tuple) else (index, self.max_nb_frames)
+
 		utt_1, utt_2, utt_3, utt_4, utt_5, spk, y= self.utt_list[index]
 
 		if not self.open_file: self.open_file = h5py.File(self.hdf5_name, 'r')
 
-		utt_1_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_1] ) )
-		utt_2_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_2] ) )
-		utt_3_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_3] ) )
-		utt_4_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_4] ) )
-		utt_5_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_5] ) )
+		# Crops only depend on the list seed and the index, not on which worker loads the example or when,
+		# so a resumed epoch yields the same batches
+		rng = np.random.RandomState([self.list_seed, index])
+
+		utt_1_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_1], rng, n_frames ) )
+		utt_2_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_2], rng, n_frames ) )
+		utt_3_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_3], rng, n_frames ) )
+		utt_4_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_4], rng, n_frames ) )
+		utt_5_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_5], rng, n_frames ) )
 
 		return utt_1_data.contiguous(), utt_2_data.contiguous(), utt_3_data.contiguous(), utt_4_data.contiguous(), utt_5_data, y
 
 	def __len__(self):
 		return len(self.utt_list)
 
-	def prep_utterance(self, data):
+	def prep_utterance(self, data, rng=np.random, n_frames=None):
 
-		if data.shape[-1]>self.max_nb_frames:
-			ridx = np.random.randint(0, data.shape[-1]-self.max_nb_frames)
-			data_ = data[:, :, ridx:(ridx+self.max_nb_frames)]
+		n_frames = self.max_nb_frames if n_frames is None else n_frames
+
+		if data.shape[-1]>n_frames:
+			ridx = rng.randint(0, data.shape[-1]-n_frames)
+			data_ = data[:, :, ridx:(ridx+n_frames)]
 		else:
-			mul = int(np.ceil(self.max_nb_frames/data.shape[-1]))
+			mul = int(np.ceil(n_frames/data.shape[-1]))
 			data_ = np.tile(data, (1, 1, mul))
-			data_ = data_[:, :, :self.max_nb_frames]
+			data_ = data_[:, :, :n_frames]
 
 		return data_
 
@@ -56,12 +65,16 @@ class Loader(Dataset):
 
 		self.spk2utt = {}
 		self.spk2label = {}
+		self.utt2frames = {}
 		self.utt_list = []
 
 		for i, spk in enumerate(open_file):
 			spk_utt_list = list(open_file[spk])
 			self.spk2utt[spk] = spk_utt_list
 			self.spk2label[spk] = torch.LongTensor([i])
+			# Only reads the dataset shapes
+			for utt in spk_utt_list:
+				self.utt2frames[utt] = open_file[spk][utt].shape[-1]
 
 		open_file.close()
 
@@ -82,14 +95,39 @@ class Loader(Dataset):
 					self.utt_list[-1].append(spk)
 					self.utt_list[-1].append(self.spk2label[spk])
 
+		self.list_seed = np.random.randint(2**31)
+
+		# Frames of each utterance of each example, and length of each example (its shortest utterance)
+		self.frames = np.array([[self.utt2frames[utt] for utt in example[:5]] for example in self.utt_list], dtype=np.int64).reshape(-1, 5)
+		self.lengths = self.frames.min(1)
+
+	def tiled_fraction(self, batches=None):
+		# Fraction of the frames given to the encoder that repeat a short utterance. Examples are cropped to
+		# max_nb_frames, or to n_frames for (indices, n_frames) batches as given by BucketBatchSampler
+		if batches is None:
+			frames, crop = self.frames, np.full(len(self.frames), self.max_nb_frames)
+		elif not batches:
+			return 0.0
+		else:
+			frames = self.frames[np.concatenate([idxs for idxs, n_frames in batches])]
+			crop = np.concatenate([np.full(len(idxs), n_frames) for idxs, n_frames in batches])
+
+		return np.clip(crop[:, None]-frames, 0, None).sum()/max(5*crop.sum(), 1)
+
 class Loader_valid(Dataset):
+	"""
+	Validation utterances, returned one at a time as (features, label, index) with a fixed crop, so that each
+	utterance is embedded once per epoch. self.trials holds a fixed list of target and non-target pairs of indices
+	into utt_list (n_trials of each, drawn with trials_seed), so scores are comparable across epochs.
+	"""
 
-	def __init__(self, hdf5_name, max_nb_frames):
+	def __init__(self, hdf5_name, max_nb_frames, n_trials=10000, trials_seed=0):
 		super(Loader_valid, self).__init__()
 		self.hdf5_name = hdf5_name
 		self.max_nb_frames = int(max_nb_frames)
 
 		self.create_lists()
+		self.create_trials(n_trials, trials_seed)
 
 		self.open_file = None
 
@@ -103,22 +141,16 @@ class Loader_valid(Dataset):
 		utt_data = self.prep_utterance( self.open_file[spk][utt] )
 		utt_data = torch.from_numpy( utt_data )
 
-		utt_1, utt_2, utt_3, utt_4 = np.random.choice(self.spk2utt[spk], 4)
-
-		utt_1_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_1] ) )
-		utt_2_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_2] ) )
-		utt_3_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_3] ) )
-		utt_4_data = torch.from_numpy( self.prep_utterance( self.open_file[spk][utt_4] ) )
-
-		return utt_data.contiguous(), utt_1_data.contiguous(), utt_2_data.contiguous(), utt_3_data.contiguous(), utt_4_data.contiguous(), self.utt2label[utt]
+		return utt_data.contiguous(), self.utt2label[utt], index
 
 	def __len__(self):
 		return len(self.utt_list)
 
 	def prep_utterance(self, data):
 
+		# Centered crop: the same frames are scored every epoch
 		if data.shape[-1]>self.max_nb_frames:
-			ridx = np.random.randint(0, data.shape[-1]-self.max_nb_frames)
+			ridx = (data.shape[-1]-self.max_nb_frames)//2
 			data_ = data[:, :, ridx:(ridx+self.max_nb_frames)]
 		else:
 			mul = int(np.ceil(self.max_nb_frames/data.shape[-1]))
@@ -148,6 +180,34 @@ class Loader_valid(Dataset):
 
 		open_file.close()
 
+	def create_trials(self, n_trials, seed):
+
+		rng = np.random.RandomState(seed)
+
+		labels = np.array([self.utt2label[utt].item() for utt in self.utt_list])
+		spk_idxs = [np.where(labels==label)[0] for label in np.unique(labels)]
+		multi_utt = [idxs for idxs in spk_idxs if len(idxs)>1]
+
+		if len(multi_utt)==0:
+			raise ValueError('No speaker has two or more utterances in {}: no target trials can be drawn for validation'.format(self.hdf5_name))
+		if len(spk_idxs)<2:
+			raise ValueError('Only one speaker in {}: no non-target trials can be drawn for validation'.format(self.hdf5_name))
+
+		# Target trials: two different utterances of a speaker with at least two utterances
+		spk = rng.randint(len(multi_utt), size=n_trials)
+		enroll, test = np.empty(n_trials, dtype=np.int64), np.empty(n_trials, dtype=np.int64)
+		for i, s in enumerate(spk):
+			enroll[i], test[i] = rng.choice(multi_utt[s], 2, replace=False)
+
+		# Non-target trials: utterance pairs resampled until the speakers differ
+		enroll_n, test_n = rng.randint(len(labels), size=n_trials), rng.randint(len(labels), size=n_trials)
+		same = labels[enroll_n]==labels[test_n]
+		while same.any():
+			test_n[same] = rng.randint(len(labels), size=same.sum())
+			same = labels[enroll_n]==labels[test_n]
+
+		self.trials = (np.concatenate([enroll, enroll_n]), np.concatenate([test, test_n]), np.concatenate([np.ones(n_trials), np.zeros(n_trials)]))
+
 if __name__=='__main__':
 
 	import torch.utils.data
@@ -0,0 +1,81 @@
+import argparse
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import model as model_
+from train_loop import TrainLoop
+from utils.distributed import average_gradients
+
+def disc_grads(model, embeddings):
+	return [embeddings.grad.clone()] + [param.grad.clone() if param.grad is not None else torch.zeros_like(param) for param in model.classifier.parameters()]
+
+def run(rank, args):
+
+	os.environ['MASTER_ADDR'] = 'localhost'
+	os.environ['MASTER_PORT'] = str(args.port)
+	dist.init_process_group('gloo', rank=rank, world_size=args.world_size)
+
+	torch.manual_seed(args.seed)
+	np.random.seed(args.seed)
+
+	# Same weights and global batch on every rank. Dropout is disabled so that pairs get the same score on any rank
+	model = model_.TDNN(nh=2, n_h=64, dropout_prob=0.0).double()
+	trainer = TrainLoop(model, None, None, None, cuda=False, device=torch.device('cpu'), pair_selection=args.pair_selection, pair_chunk_size=args.pair_chunk_size, gather_embeddings=True)
+
+	for i in range(args.trials):
+
+		y = torch.LongTensor(np.random.choice(np.arange(3*args.n_speakers*args.world_size), args.n_speakers*args.world_size, replace=i%2==1))
+		y = torch.cat(5*[y], dim=0)
+		embeddings = torch.randn(y.size(0), 512, dtype=torch.float64)
+		out_norm = torch.nn.functional.normalize(torch.randn(y.size(0), 256, dtype=torch.float64), p=2, dim=1)
+
+		# Reference: single process over the global batch
+		trainer.gather_embeddings = False
+		model.zero_grad()
+		ref_embeddings = embeddings.clone().requires_grad_(True)
+		ref_loss, ref_surrogate = trainer.disc_loss(ref_embeddings, out_norm, y)
+		ref_surrogate.backward()
+		ref_grads = disc_grads(model, ref_embeddings)
+
+		# This rank's view-major slice of the global batch
+		local = torch.arange(y.size(0)).view(5, args.world_size, -1)[:, rank, :].reshape(-1)
+		trainer.gather_embeddings = True
+		model.zero_grad()
+		local_embeddings = embeddings[local].clone().requires_grad_(True)
+		loss, surrogate = trainer.disc_loss(local_embeddings, out_norm[local], y[local])
+		surrogate.backward()
+		average_gradients(model)
+		# Encoder gradients are averaged over ranks in training, which is where the world_size factor goes
+		grads = disc_grads(model, local_embeddings)
+		grads[0] /= args.world_size
+
+		global_loss = loss.detach().clone()
+		dist.all_reduce(global_loss)
+		loss_err = abs(ref_loss.item()-global_loss.item()/args.world_size)
+		max_grad_err = max([(ref_grads[0][local]-grads[0]).abs().max().item()] + [(g_1-g_2).abs().max().item() for g_1, g_2 in zip(ref_grads[1:], grads[1:])])
+
+		if rank==0:
+			print('Global batch: {}, loss err: {:.2e}, max grad err: {:.2e}'.format(y.size(0), loss_err, max_grad_err))
+
+		assert loss_err<1e-10
+		assert max_grad_err<1e-10
+
+	dist.destroy_process_group()
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Compare discriminator gradients with embeddings gathered across ranks (gloo, CPU) against a single process')
+	parser.add_argument('--world-size', type=int, default=2, metavar='N', help='Number of processes (default: 2)')
+	parser.add_argument('--n-speakers', type=int, default=3, metavar='N', help='Number of speakers per rank batch (default: 3)')
+	parser.add_argument('--pair-selection', choices=['all_triplets', 'hard_negative_pairs'], default='all_triplets', help='Pairs scored by the discriminator')
+	parser.add_argument('--pair-chunk-size', type=int, default=0, metavar='N', help='Number of pairs per discriminator chunk - active if greater than 0')
+	parser.add_argument('--trials', type=int, default=4, metavar='N', help='Number of random batches (default: 4)')
+	parser.add_argument('--port', type=int, default=29511, metavar='N', help='Master port (default: 29511)')
+	parser.add_argument('--seed', type=int, default=1, metavar='S', help='random seed (default: 1)')
+	args = parser.parse_args()
+
+	mp.spawn(run, args=(args,), nprocs=args.world_size, join=True)
+
+	print('OK')
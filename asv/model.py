@@ -2,8 +2,41 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
+import torch.utils.checkpoint
+import contextlib
 from utils.losses import AMSoftmax, Softmax
 
+@contextlib.contextmanager
+def frozen_bn_stats(module):
+	# Recomputation runs the batch norm layers of a stage in training mode a second time. With zero momentum their running
+	# statistics are left as the first pass updated them
+	bn_layers = [layer for layer in module.modules() if isinstance(layer, nn.modules.batchnorm._BatchNorm)]
+	momenta = [layer.momentum for layer in bn_layers]
+	counts = [layer.num_batches_tracked.clone() if layer.num_batches_tracked is not None else None for layer in bn_layers]
+	for layer in bn_layers:
+		layer.momentum = 0.0
+	try:
+		yield
+	finally:
+		for layer, momentum, count in zip(bn_layers, momenta, counts):
+			layer.momentum = momentum
+			if count is not None:
+				layer.num_batches_tracked.copy_(count)
+
+def forward_stage(stage, x, checkpoint=False):
+	# With checkpoint, only the input of the stage is kept for backward and its activations are recomputed from it
+	if checkpoint and torch.is_grad_enabled():
+		return torch.utils.checkpoint.checkpoint(stage, x, use_reentrant=False, context_fn=lambda: (contextlib.nullcontext(), frozen_bn_stats(stage)))
+	return stage(x)
+
+def project_pairs(layer, embeddings, idx_1, idx_2):
+	# W.[x_1; x_2] + b = W[:, :d].x_1 + W[:, d:].x_2 + b, so each embedding is projected once and projections are gathered and added per pair
+	n_in = embeddings.size(1)
+	out = torch.index_select(F.linear(embeddings, layer.weight[:, :n_in]), 0, idx_1) + torch.index_select(F.linear(embeddings, layer.weight[:, n_in:]), 0, idx_2)
+	if layer.bias is not None:
+		out = out + layer.bias
+	return out
+
 class SelfAttention(nn.Module):
 	def __init__(self, hidden_size):
 		super(SelfAttention, self).__init__()
@@ -128,7 +161,7 @@ class PreActBottleneck(nn.Module):
 		return out
 
 class ResNet_stats(nn.Module):
-	def __init__(self, n_z=256, nh=1, n_h=512, layers=[3,4,6,3], block=PreActBottleneck, proj_size=100, ncoef=23, dropout_prob=0.25, sm_type='softmax', ndiscriminators=1, r_proj_size=0):
+	def __init__(self, n_z=256, nh=1, n_h=512, layers=[3,4,6,3], block=PreActBottleneck, proj_size=100, ncoef=23, dropout_prob=0.25, sm_type='softmax', ndiscriminators=1, r_proj_size=0, checkpoint_stages=()):
 		self.in_planes = 32
 		super(ResNet_stats, self).__init__()
 
@@ -141,6 +174,8 @@ class ResNet_stats(nn.Module):
 		self.latent_size = n_z
 		self.sm_type = sm_type
 		self.ncoef = ncoef
+		# Residual stages (1 to 4) recomputed during backward
+		self.checkpoint_stages = set(checkpoint_stages)
 	
 		self.conv1 = nn.Conv2d(1, 32, kernel_size=(ncoef,3), stride=(1,1), padding=(0,1), bias=False)
 		
@@ -215,10 +250,10 @@ class ResNet_stats(nn.Module):
 	def forward(self, x):
 
 		x = self.conv1(x)
-		x = self.layer1(x)
-		x = self.layer2(x)
-		x = self.layer3(x)
-		x = self.layer4(x)
+		x = forward_stage(self.layer1, x, 1 in self.checkpoint_stages)
+		x = forward_stage(self.layer2, x, 2 in self.checkpoint_stages)
+		x = forward_stage(self.layer3, x, 3 in self.checkpoint_stages)
+		x = forward_stage(self.layer4, x, 4 in self.checkpoint_stages)
 		x = x.squeeze(2)
 		x = torch.cat([x.mean(-1), x.std(-1)], dim=1)
 
@@ -245,8 +280,28 @@ class ResNet_stats(nn.Module):
 		
 			return z
 
+	def forward_bin_pairs(self, embeddings, idx_1, idx_2):
+		# Equivalent to forward_bin(torch.cat([embeddings[idx_1], embeddings[idx_2]], 1)) without building the concatenated pairs
+
+		if self.ndiscriminators>1:
+			out = []
+			for disc in self.classifier:
+				z_ = project_pairs(disc[0], embeddings, idx_1, idx_2)
+				for l in disc[1:]:
+					z_ = l(z_)
+				out.append(z_)
+
+			return out
+
+		else:
+			z = project_pairs(self.classifier[0], embeddings, idx_1, idx_2)
+			for l in self.classifier[1:]:
+				z = l(z)
+		
+			return z
+
 class ResNet_mfcc(nn.Module):
-	def __init__(self, n_z=256, nh=1, n_h=512, layers=[3,4,6,3], block=PreActBottleneck, proj_size=100, ncoef=23, dropout_prob=0.25, sm_type='softmax', ndiscriminators=1, r_proj_size=0):
+	def __init__(self, n_z=256, nh=1, n_h=512, layers=[3,4,6,3], block=PreActBottleneck, proj_size=100, ncoef=23, dropout_prob=0.25, sm_type='softmax', ndiscriminators=1, r_proj_size=0, checkpoint_stages=()):
 		self.in_planes = 32
 		super(ResNet_mfcc, self).__init__()
 
@@ -259,6 +314,8 @@ class ResNet_mfcc(nn.Module):
 		self.latent_size = n_z
 		self.sm_type = sm_type
 		self.ncoef = ncoef
+		# Residual stages (1 to 4) recomputed during backward
+		self.checkpoint_stages = set(checkpoint_stages)
 
 		self.conv1 = nn.Conv2d(1, 32, kernel_size=(ncoef,3), stride=(1,1), padding=(0,1), bias=False)
 		
@@ -335,10 +392,10 @@ class ResNet_mfcc(nn.Module):
 	def forward(self, x):
 	
 		x = self.conv1(x)
-		x = self.layer1(x)
-		x = self.layer2(x)
-		x = self.layer3(x)
-		x = self.layer4(x)
+		x = forward_stage(self.layer1, x, 1 in self.checkpoint_stages)
+		x = forward_stage(self.layer2, x, 2 in self.checkpoint_stages)
+		x = forward_stage(self.layer3, x, 3 in self.checkpoint_stages)
+		x = forward_stage(self.layer4, x, 4 in self.checkpoint_stages)
 		x = x.squeeze(2)
 
 		stats = self.attention(x.permute(0,2,1).contiguous())
@@ -366,8 +423,28 @@ class ResNet_mfcc(nn.Module):
 		
 			return z
 
+	def forward_bin_pairs(self, embeddings, idx_1, idx_2):
+		# Equivalent to forward_bin(torch.cat([embeddings[idx_1], embeddings[idx_2]], 1)) without building the concatenated pairs
+
+		if self.ndiscriminators>1:
+			out = []
+			for disc in self.classifier:
+				z_ = project_pairs(disc[0], embeddings, idx_1, idx_2)
+				for l in disc[1:]:
+					z_ = l(z_)
+				out.append(z_)
+
+			return out
+
+		else:
+			z = project_pairs(self.classifier[0], embeddings, idx_1, idx_2)
+			for l in self.classifier[1:]:
+				z = l(z)
+		
+			return z
+
 class ResNet_lstm(nn.Module):
-	def __init__(self, n_z=256, nh=1, n_h=512, layers=[3,4,6,3], block=PreActBottleneck, proj_size=100, ncoef=23, dropout_prob=0.25, sm_type='softmax', ndiscriminators=1, r_proj_size=0):
+	def __init__(self, n_z=256, nh=1, n_h=512, layers=[3,4,6,3], block=PreActBottleneck, proj_size=100, ncoef=23, dropout_prob=0.25, sm_type='softmax', ndiscriminators=1, r_proj_size=0, checkpoint_stages=()):
 		self.in_planes = 32
 		super(ResNet_lstm, self).__init__()
 
@@ -380,6 +457,8 @@ class ResNet_lstm(nn.Module):
 		self.latent_size = n_z
 		self.sm_type = sm_type
 		self.ncoef = ncoef
+		# Residual stages (1 to 4) recomputed during backward
+		self.checkpoint_stages = set(checkpoint_stages)
 	
 		self.conv1 = nn.Conv2d(1, 32, kernel_size=(ncoef,3), stride=(1,1), padding=(0,1), bias=False)
 		
@@ -457,10 +536,10 @@ class ResNet_lstm(nn.Module):
 
 	def forward(self, x):
 		x = self.conv1(x)
-		x = self.layer1(x)
-		x = self.layer2(x)
-		x = self.layer3(x)
-		x = self.layer4(x)
+		x = forward_stage(self.layer1, x, 1 in self.checkpoint_stages)
+		x = forward_stage(self.layer2, x, 2 in self.checkpoint_stages)
+		x = forward_stage(self.layer3, x, 3 in self.checkpoint_stages)
+		x = forward_stage(self.layer4, x, 4 in self.checkpoint_stages)
 		x = x.squeeze(2).permute(2,0,1)
 
 		batch_size = x.size(1)
@@ -501,8 +580,28 @@ class ResNet_lstm(nn.Module):
 		
 			return z
 
+	def forward_bin_pairs(self, embeddings, idx_1, idx_2):
+		# Equivalent to forward_bin(torch.cat([embeddings[idx_1], embeddings[idx_2]], 1)) without building the concatenated pairs
+
+		if self.ndiscriminators>1:
+			out = []
+			for disc in self.classifier:
+				z_ = project_pairs(disc[0], embeddings, idx_1, idx_2)
+				for l in disc[1:]:
+					z_ = l(z_)
+				out.append(z_)
+
+			return out
+
+		else:
+			z = project_pairs(self.classifier[0], embeddings, idx_1, idx_2)
+			for l in self.classifier[1:]:
+				z = l(z)
+		
+			return z
+
 class ResNet_small(nn.Module):
-	def __init__(self, n_z=256, nh=1, n_h=512, layers=[2,2,2,2], block=PreActBlock, proj_size=0, ncoef=23, dropout_prob=0.25, sm_type='none', ndiscriminators=1, r_proj_size=0):
+	def __init__(self, n_z=256, nh=1, n_h=512, layers=[2,2,2,2], block=PreActBlock, proj_size=0, ncoef=23, dropout_prob=0.25, sm_type='none', ndiscriminators=1, r_proj_size=0, checkpoint_stages=()):
 		self.in_planes = 32
 		super(ResNet_small, self).__init__()
 
@@ -515,6 +614,8 @@ class ResNet_small(nn.Module):
 		self.latent_size = n_z
 		self.sm_type = sm_type
 		self.ncoef = ncoef
+		# Residual stages (1 to 4) recomputed during backward
+		self.checkpoint_stages = set(checkpoint_stages)
 
 		self.conv1 = nn.Conv2d(1, 32, kernel_size=(ncoef,3), stride=(1,1), padding=(0,1), bias=False)
 		
@@ -592,10 +693,10 @@ class ResNet_small(nn.Module):
 	def forward(self, x):
 	
 		x = self.conv1(x)
-		x = self.layer1(x)
-		x = self.layer2(x)
-		x = self.layer3(x)
-		x = self.layer4(x)
+		x = forward_stage(self.layer1, x, 1 in self.checkpoint_stages)
+		x = forward_stage(self.layer2, x, 2 in self.checkpoint_stages)
+		x = forward_stage(self.layer3, x, 3 in self.checkpoint_stages)
+		x = forward_stage(self.layer4, x, 4 in self.checkpoint_stages)
 		x = x.squeeze(2)
 
 		stats = self.attention(x.permute(0,2,1).contiguous())
@@ -623,8 +724,28 @@ class ResNet_small(nn.Module):
 		
 			return z
 
+	def forward_bin_pairs(self, embeddings, idx_1, idx_2):
+		# Equivalent to forward_bin(torch.cat([embeddings[idx_1], embeddings[idx_2]], 1)) without building the concatenated pairs
+
+		if self.ndiscriminators>1:
+			out = []
+			for disc in self.classifier:
+				z_ = project_pairs(disc[0], embeddings, idx_1, idx_2)
+				for l in disc[1:]:
+					z_ = l(z_)
+				out.append(z_)
+
+			return out
+
+		else:
+			z = project_pairs(self.classifier[0], embeddings, idx_1, idx_2)
+			for l in self.classifier[1:]:
+				z = l(z)
+		
+			return z
+
 class ResNet_large(nn.Module):
-	def __init__(self, n_z=256, nh=1, n_h=512, layers=[3,4,23,3], block=PreActBottleneck, proj_size=100, ncoef=23, dropout_prob=0.25, sm_type='softmax', ndiscriminators=1, r_proj_size=0):
+	def __init__(self, n_z=256, nh=1, n_h=512, layers=[3,4,23,3], block=PreActBottleneck, proj_size=100, ncoef=23, dropout_prob=0.25, sm_type='softmax', ndiscriminators=1, r_proj_size=0, checkpoint_stages=()):
 		self.in_planes = 32
 		super(ResNet_large, self).__init__()
 
@@ -637,6 +758,8 @@ class ResNet_large(nn.Module):
 		self.latent_size = n_z
 		self.sm_type = sm_type
 		self.ncoef = ncoef
+		# Residual stages (1 to 4) recomputed during backward
+		self.checkpoint_stages = set(checkpoint_stages)
 
 		self.conv1 = nn.Conv2d(1, 32, kernel_size=(ncoef,3), stride=(1,1), padding=(0,1), bias=False)
 		
@@ -713,10 +836,10 @@ class ResNet_large(nn.Module):
 	def forward(self, x):
 	
 		x = self.conv1(x)
-		x = self.layer1(x)
-		x = self.layer2(x)
-		x = self.layer3(x)
-		x = self.layer4(x)
+		x = forward_stage(self.layer1, x, 1 in self.checkpoint_stages)
+		x = forward_stage(self.layer2, x, 2 in self.checkpoint_stages)
+		x = forward_stage(self.layer3, x, 3 in self.checkpoint_stages)
+		x = forward_stage(self.layer4, x, 4 in self.checkpoint_stages)
 		x = x.squeeze(2)
 
 		stats = self.attention(x.permute(0,2,1).contiguous())
@@ -744,6 +867,26 @@ class ResNet_large(nn.Module):
 		
 			return z
 
+	def forward_bin_pairs(self, embeddings, idx_1, idx_2):
+		# Equivalent to forward_bin(torch.cat([embeddings[idx_1], embeddings[idx_2]], 1)) without building the concatenated pairs
+
+		if self.ndiscriminators>1:
+			out = []
+			for disc in self.classifier:
+				z_ = project_pairs(disc[0], embeddings, idx_1, idx_2)
+				for l in disc[1:]:
+					z_ = l(z_)
+				out.append(z_)
+
+			return out
+
+		else:
+			z = project_pairs(self.classifier[0], embeddings, idx_1, idx_2)
+			for l in self.classifier[1:]:
+				z = l(z)
+		
+			return z
+
 class StatisticalPooling(nn.Module):
 
 	def forward(self, x):
@@ -863,6 +1006,26 @@ class TDNN(nn.Module):
 		
 			return z
 
+	def forward_bin_pairs(self, embeddings, idx_1, idx_2):
+		# Equivalent to forward_bin(torch.cat([embeddings[idx_1], embeddings[idx_2]], 1)) without building the concatenated pairs
+
+		if self.ndiscriminators>1:
+			out = []
+			for disc in self.classifier:
+				z_ = project_pairs(disc[0], embeddings, idx_1, idx_2)
+				for l in disc[1:]:
+					z_ = l(z_)
+				out.append(z_)
+
+			return out
+
+		else:
+			z = project_pairs(self.classifier[0], embeddings, idx_1, idx_2)
+			for l in self.classifier[1:]:
+				z = l(z)
+		
+			return z
+
 	def initialize_params(self):
 
 		for layer in self.modules():
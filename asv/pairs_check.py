@@ -0,0 +1,136 @@
+import argparse
+import numpy as np
+import torch
+import model as model_
+from train_loop import TrainLoop
+from utils.memory_bank import MemoryBank
+from utils.harvester import AllTripletSelector, AllPositivePairSelector, HardNegativePairSelector, TripletTemplateCache, pdist, cos_sim, triplets_to_pairs
+
+def naive_bin_loss(model, embeddings, triplets_idx):
+
+	emb_a = torch.index_select(embeddings, 0, triplets_idx[:, 0])
+	emb_p = torch.index_select(embeddings, 0, triplets_idx[:, 1])
+	emb_n = torch.index_select(embeddings, 0, triplets_idx[:, 2])
+
+	emb_ = torch.cat([torch.cat([emb_a, emb_p],1), torch.cat([emb_a, emb_n],1)],0)
+	y_ = torch.cat([torch.ones(emb_a.size(0)), torch.zeros(emb_a.size(0))],0).to(embeddings.dtype)
+
+	pred_bin = model.forward_bin(emb_)
+
+	if model.ndiscriminators>1:
+		loss_bin = 0.0
+		for pred in pred_bin:
+			loss_bin += torch.nn.BCELoss()(pred.squeeze(), y_)
+	else:
+		loss_bin = torch.nn.BCELoss()(pred_bin.squeeze(), y_)
+
+	return loss_bin
+
+def grads(model, embeddings, loss):
+	model.zero_grad()
+	embeddings.grad = None
+	loss.backward()
+	return [embeddings.grad.clone()] + [param.grad.clone() for param in model.classifier.parameters() if param.grad is not None]
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Compare pair-based discriminator losses against the all-triplets reference')
+	parser.add_argument('--n-speakers', type=int, default=6, metavar='N', help='Number of speakers per batch (default: 6)')
+	parser.add_argument('--n-views', type=int, default=5, metavar='N', help='Number of utterances per speaker (default: 5)')
+	parser.add_argument('--ndiscriminators', type=int, default=1, metavar='N', help='number of discriminators (default: 1)')
+	parser.add_argument('--trials', type=int, default=5, metavar='N', help='Number of random batches (default: 5)')
+	parser.add_argument('--seed', type=int, default=1, metavar='S', help='random seed (default: 1)')
+	args = parser.parse_args()
+
+	torch.manual_seed(args.seed)
+	np.random.seed(args.seed)
+
+	# Dropout is disabled: repeated triplet rows get independent dropout masks in the reference
+	model = model_.TDNN(nh=2, n_h=64, dropout_prob=0.0, ndiscriminators=args.ndiscriminators).double()
+	trainer = TrainLoop(model, None, None, None, cuda=False)
+	harvester = AllTripletSelector()
+	templates = TripletTemplateCache(n_views=args.n_views)
+
+	for i in range(args.trials):
+
+		y = torch.LongTensor(np.random.choice(np.arange(3*args.n_speakers), args.n_speakers, replace=i%2==1))
+		y = torch.cat(args.n_views*[y], dim=0)
+		embeddings = torch.randn(y.size(0), 512, dtype=torch.float64, requires_grad=True)
+
+		triplets_idx = harvester.get_triplets(embeddings.detach(), y)
+
+		ref_loss = naive_bin_loss(model, embeddings, triplets_idx)
+		ref_grads = grads(model, embeddings, ref_loss)
+
+		ap_pairs, ap_counts, an_pairs, an_counts = triplets_to_pairs(triplets_idx)
+
+		for pairs, template_pairs in zip([ap_pairs, ap_counts, an_pairs, an_counts], templates.get_pairs(y)):
+			assert torch.equal(pairs, template_pairs)
+		idx_1 = torch.cat([ap_pairs[:, 0], an_pairs[:, 0]], 0)
+		idx_2 = torch.cat([ap_pairs[:, 1], an_pairs[:, 1]], 0)
+		weights = torch.cat([ap_counts, an_counts], 0).to(embeddings.dtype)
+		y_ = trainer.get_disc_targets(ap_counts, an_counts).to(embeddings.dtype)
+
+		loss = trainer.compute_bin_loss(embeddings, idx_1, idx_2, y_, weights)
+		pair_grads = grads(model, embeddings, loss)
+
+		max_grad_err = max([(g_1-g_2).abs().max().item() for g_1, g_2 in zip(ref_grads, pair_grads)])
+
+		print('Triplets: {}, unique pairs: {}, loss err: {:.2e}, max grad err: {:.2e}'.format(triplets_idx.size(0), idx_1.size(0), abs(ref_loss.item()-loss.item()), max_grad_err))
+
+		assert abs(ref_loss.item()-loss.item())<1e-10
+		assert max_grad_err<1e-10
+
+		trainer.pair_chunk_size = max(idx_1.size(0)//3, 1)
+		model.zero_grad()
+		embeddings.grad = None
+		loss_chunked, surrogate = trainer.compute_bin_loss_chunked(embeddings, idx_1, idx_2, y_, weights)
+		surrogate.backward()
+		chunked_grads = [embeddings.grad.clone()] + [param.grad.clone() for param in model.classifier.parameters() if param.grad is not None]
+
+		max_grad_err = max([(g_1-g_2).abs().max().item() for g_1, g_2 in zip(ref_grads, chunked_grads)])
+
+		print('Chunks of {} pairs, loss err: {:.2e}, max grad err: {:.2e}'.format(trainer.pair_chunk_size, abs(ref_loss.item()-loss_chunked.item()), max_grad_err))
+
+		assert abs(ref_loss.item()-loss_chunked.item())<1e-10
+		assert max_grad_err<1e-10
+
+		positive_pairs, negative_pairs = AllPositivePairSelector(balance=False).get_pairs(embeddings.detach(), y)
+		same_label = (y.view(-1, 1) == y.view(1, -1)).triu(diagonal=1)
+		assert positive_pairs.size(0) == same_label.sum().item() and same_label[positive_pairs[:, 0], positive_pairs[:, 1]].all()
+		assert positive_pairs.size(0)+negative_pairs.size(0) == y.size(0)*(y.size(0)-1)//2
+
+		positive_pairs, hard_negative_pairs = HardNegativePairSelector().get_pairs(embeddings.detach(), y)
+		distances = pdist(embeddings.detach())
+		hard_distances = distances[hard_negative_pairs[:, 0], hard_negative_pairs[:, 1]]
+		assert hard_negative_pairs.size(0) == min(positive_pairs.size(0), negative_pairs.size(0))
+		assert hard_distances.max() <= distances[negative_pairs[:, 0], negative_pairs[:, 1]].sort()[0][hard_negative_pairs.size(0)-1]
+
+		# Gram-matrix distances and similarities against the direct float64 computation, whole and in chunks
+		ref_dist = torch.norm(embeddings.detach()[:, None] - embeddings.detach(), dim=2, p=2)
+		ref_sim = torch.nn.functional.cosine_similarity(embeddings.detach()[:, None], embeddings.detach()[None, :], dim=2)
+		for chunk_size in [None, max(y.size(0)//3, 1)]:
+			assert torch.allclose(pdist(embeddings.detach(), chunk_size=chunk_size), ref_dist, atol=1e-6)
+			assert torch.allclose(cos_sim(embeddings.detach(), chunk_size=chunk_size), ref_sim, atol=1e-10)
+
+		# Bank negatives: with all triplets, pair counts add up to the triplets extended by the bank. Contrastive pairs
+		# take each bank negative once and keep their positives
+		trainer.memory_bank, trainer.total_iters = MemoryBank(size=2*y.size(0)), 1
+		trainer.memory_bank.push(torch.randn(y.size(0), 512, dtype=torch.float64), torch.LongTensor(np.random.choice(np.arange(3*args.n_speakers), y.size(0))), step=0)
+		bank_triplets = trainer.memory_bank.extend_triplets(triplets_idx, y, 1, offset=y.size(0))
+		anchors, bank_idx = trainer.memory_bank.negative_pairs(y, 1)
+
+		trainer.pair_selector = None
+		bank_ap_counts, bank_an_pairs, bank_an_counts = trainer.add_bank_negatives(y, ap_pairs, ap_counts, an_pairs, an_counts)
+		assert bank_ap_counts.sum() == bank_triplets.size(0) and bank_an_counts.sum() == bank_triplets.size(0)
+
+		trainer.pair_selector = AllPositivePairSelector(balance=False)
+		positive_pairs, negative_pairs = trainer.pair_selector.get_pairs(embeddings.detach(), y)
+		ones = lambda pairs: torch.ones(pairs.size(0), dtype=torch.long)
+		bank_ap_counts, bank_an_pairs, bank_an_counts = trainer.add_bank_negatives(y, positive_pairs, ones(positive_pairs), negative_pairs, ones(negative_pairs))
+		assert torch.equal(bank_ap_counts, ones(positive_pairs)) and torch.equal(bank_an_counts, ones(bank_an_pairs))
+		assert torch.equal(bank_an_pairs, torch.cat([negative_pairs, torch.stack([anchors, y.size(0)+bank_idx], 1)], 0))
+		trainer.memory_bank, trainer.pair_selector = None, None
+
+	print('Cached templates: {}'.format(len(templates.templates)))
+	print('OK')
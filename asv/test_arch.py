@@ -18,12 +18,23 @@ parser.add_argument('--hidden-size', type=int, default=512, metavar='S', help='l
 parser.add_argument('--n-hidden', type=int, default=1, metavar='N', help='maximum number of frames per utterance (default: 1)')
 args = parser.parse_args()
 
+def check_pairs(model, emb):
+	model.eval()
+	idx_1, idx_2 = torch.LongTensor([0, 0, 1, 2, 2]), torch.LongTensor([1, 2, 2, 0, 2])
+	pred = model.forward_bin(torch.cat([emb[idx_1], emb[idx_2]],1))
+	pred_pairs = model.forward_bin_pairs(emb, idx_1, idx_2)
+	if model.ndiscriminators>1:
+		pred, pred_pairs = torch.cat(pred, 1), torch.cat(pred_pairs, 1)
+	print('Factorized pairs max abs diff: {}'.format((pred-pred_pairs).abs().max().item()))
+	model.train()
+
 if args.model == 'resnet_stats' or  args.model == 'all':
 	batch = torch.rand(3, 1, args.ncoef, 200)
 	model = model_.ResNet_stats(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=100, ncoef=args.ncoef, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
 	print('resnet_stats')
 	mu, emb = model.forward(batch)
 	print(mu.size())
+	check_pairs(model, emb)
 	emb = torch.cat([emb,emb],1)
 	print(emb.size())
 	pred = model.forward_bin(emb)
@@ -36,6 +47,7 @@ if args.model == 'resnet_mfcc' or  args.model == 'all':
 	print('resnet_mfcc')
 	mu, emb = model.forward(batch)
 	print(mu.size())
+	check_pairs(model, emb)
 	emb = torch.cat([emb,emb],1)
 	print(emb.size())
 	pred = model.forward_bin(emb)
@@ -48,6 +60,7 @@ if args.model == 'resnet_lstm' or  args.model == 'all':
 	print('resnet_lstm')
 	mu, emb = model.forward(batch)
 	print(mu.size())
+	check_pairs(model, emb)
 	emb = torch.cat([emb,emb],1)
 	print(emb.size())
 	pred = model.forward_bin(emb)
@@ -60,6 +73,7 @@ if args.model == 'resnet_small' or  args.model == 'all':
 	print('resnet_small')
 	mu, emb = model.forward(batch)
 	print(mu.size())
+	check_pairs(model, emb)
 	emb = torch.cat([emb,emb],1)
 	print(emb.size())
 	pred = model.forward_bin(emb)
@@ -72,6 +86,7 @@ if args.model == 'resnet_large' or  args.model == 'all':
 	print('resnet_large')
 	mu, emb = model.forward(batch)
 	print(mu.size())
+	check_pairs(model, emb)
 	emb = torch.cat([emb,emb],1)
 	print(emb.size())
 	pred = model.forward_bin(emb)
@@ -84,6 +99,7 @@ if args.model == 'TDNN' or  args.model == 'all':
 	print('TDNN')
 	mu, emb = model.forward(batch)
 	print(mu.size())
+	check_pairs(model, emb)
 	emb = torch.cat([emb,emb],1)
 	print(emb.size())
 	pred = model.forward_bin(emb)
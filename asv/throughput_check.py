@@ -0,0 +1,123 @@
+import argparse
+import time
+import numpy as np
+import torch
+import torch.optim as optim
+from torch.utils.data import Dataset
+import model as model_
+from data_load import Loader_valid
+from train_loop import TrainLoop
+from utils.optimizer import TransformerOptimizer
+from utils.utils import compute_eer
+
+class SyntheticLoader(Dataset):
+	# Random features around one mean per speaker, with the same batch layout as data_load.Loader
+
+	def __init__(self, n_speakers, n_examples, ncoef, n_frames, seed=0):
+		rng = np.random.RandomState(seed)
+		self.n_speakers = n_speakers
+		self.n_frames = n_frames
+		self.means = rng.randn(n_speakers, ncoef, 1).astype(np.float32)
+		self.labels = rng.randint(n_speakers, size=n_examples)
+		self.utt_list = list(range(n_examples))
+		self.rng = rng
+
+	def __getitem__(self, index):
+		spk = self.labels[index]
+		utts = [torch.from_numpy(self.means[spk] + self.rng.randn(self.means.shape[1], self.n_frames).astype(np.float32)).unsqueeze(0) for i in range(5)]
+		return utts[0], utts[1], utts[2], utts[3], utts[4], torch.LongTensor([spk])
+
+	def __len__(self):
+		return len(self.utt_list)
+
+	def update_lists(self):
+		pass
+
+class SyntheticValidLoader(SyntheticLoader):
+	# One utterance per item and a fixed trial list, as data_load.Loader_valid
+
+	create_trials = Loader_valid.create_trials
+
+	def __init__(self, n_speakers, n_examples, ncoef, n_frames, n_trials, seed=0):
+		super(SyntheticValidLoader, self).__init__(n_speakers, n_examples, ncoef, n_frames, seed=seed)
+		self.utt2label = {i: torch.LongTensor([spk]) for i, spk in enumerate(self.labels)}
+		self.create_trials(n_trials, seed)
+
+	def __getitem__(self, index):
+		spk = self.labels[index]
+		return torch.from_numpy(self.means[spk] + self.rng.randn(self.means.shape[1], self.n_frames).astype(np.float32)).unsqueeze(0), self.utt2label[index], index
+
+def run(args, **kwargs):
+
+	torch.manual_seed(args.seed)
+	np.random.seed(args.seed)
+
+	train_dataset = SyntheticLoader(args.n_speakers, args.n_examples, args.ncoef, args.n_frames, seed=args.seed)
+	valid_dataset = SyntheticValidLoader(args.n_speakers, args.batch_size*args.valid_steps, args.ncoef, args.n_frames, n_trials=args.valid_trials, seed=args.seed+1)
+	train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
+	valid_loader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False)
+
+	model = model_.TDNN(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=args.n_speakers, ncoef=args.ncoef, sm_type=args.softmax, dropout_prob=0.25)
+	optimizer = TransformerOptimizer(optim.SGD(model.parameters(), lr=args.lr, momentum=0.9, nesterov=True), lr=args.lr, warmup_steps=args.warmup)
+	trainer = TrainLoop(model, optimizer, train_loader, valid_loader, label_smoothing=args.smoothing, device=torch.device('cpu'), cuda=False, **kwargs)
+
+	losses, n_steps, elapsed = [], 0, 0.0
+	while n_steps < args.steps:
+		for batch in train_loader:
+			if n_steps == args.steps:
+				break
+			start = time.time()
+			losses.append(trainer.train_step(batch)[0].item())
+			# The first steps are excluded from timing (allocations, kernel selection, compilation)
+			elapsed += time.time()-start if n_steps>=args.skip_steps else 0.0
+			n_steps += 1
+
+	e2e_scores, cos_scores, labels, _, _ = trainer.evaluate()
+
+	return (n_steps-args.skip_steps)/elapsed, np.mean(losses[-10:]), compute_eer(labels, e2e_scores), compute_eer(labels, cos_scores), np.isfinite(losses).all()
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Compare float32 and mixed precision, or eager and compiled training steps on synthetic speaker data (CPU)')
+	parser.add_argument('--compare', choices=['mixed_precision', 'compile', 'crop_lengths'], default='mixed_precision', help='Training modes compared (default: mixed_precision)')
+	parser.add_argument('--n-speakers', type=int, default=20, metavar='N', help='Number of synthetic speakers (default: 20)')
+	parser.add_argument('--n-examples', type=int, default=400, metavar='N', help='Number of training examples (default: 400)')
+	parser.add_argument('--batch-size', type=int, default=16, metavar='N', help='input batch size (default: 16)')
+	parser.add_argument('--steps', type=int, default=30, metavar='N', help='Number of training steps per mode (default: 30)')
+	parser.add_argument('--skip-steps', type=int, default=1, metavar='N', help='Number of first steps not timed (default: 1)')
+	parser.add_argument('--valid-steps', type=int, default=4, metavar='N', help='Number of validation batches (default: 4)')
+	parser.add_argument('--valid-trials', type=int, default=500, metavar='N', help='Number of target and of non-target validation trials (default: 500)')
+	parser.add_argument('--ncoef', type=int, default=23, metavar='N', help='number of MFCCs (default: 23)')
+	parser.add_argument('--n-frames', type=int, default=200, metavar='N', help='number of frames per utterance (default: 200)')
+	parser.add_argument('--crop-lengths', type=int, nargs='+', default=[50, 100, 150, 200], metavar='N', help='Crop lengths for --compare crop_lengths (default: 50 100 150 200)')
+	parser.add_argument('--latent-size', type=int, default=256, metavar='S', help='latent layer dimension (default: 256)')
+	parser.add_argument('--hidden-size', type=int, default=512, metavar='S', help='latent layer dimension (default: 512)')
+	parser.add_argument('--n-hidden', type=int, default=1, metavar='N', help='number of hidden layers (default: 1)')
+	parser.add_argument('--softmax', choices=['softmax', 'am_softmax'], default='am_softmax', help='Softmax type')
+	parser.add_argument('--smoothing', type=float, default=0.2, metavar='l', help='Label smoothing (default: 0.2)')
+	parser.add_argument('--lr', type=float, default=0.1, metavar='LR', help='learning rate (default: 0.1)')
+	parser.add_argument('--warmup', type=int, default=10, metavar='N', help='Iterations until reach lr (default: 10)')
+	parser.add_argument('--threads', type=int, default=None, metavar='N', help='Number of CPU threads')
+	parser.add_argument('--seed', type=int, default=1, metavar='S', help='random seed (default: 1)')
+	args = parser.parse_args()
+
+	if args.threads:
+		torch.set_num_threads(args.threads)
+
+	if args.compare == 'compile':
+		# Compilation happens over the first steps (one graph per new input rank or dtype), which --skip-steps should cover
+		modes = [('eager', {}), ('compiled', {'compile_step': True})]
+	elif args.compare == 'crop_lengths':
+		modes = [('continuous crops', {}), ('quantized crops', {'crop_lengths': args.crop_lengths})]
+	else:
+		modes = [('float32', {}), ('bfloat16', {'mixed_precision': True})]
+
+	results = []
+	for name, kwargs in modes:
+		results.append(run(args, **kwargs))
+		print('{}: {:.2f} steps/s, last loss: {:.4f}, E2E EER: {:.4f}, Cos EER: {:.4f}'.format(name, *results[-1][:4]))
+
+	print('Speed-up: {:.2f}x'.format(results[1][0]/results[0][0]))
+
+	assert results[0][-1] and results[1][-1]
+	print('OK')
@@ -2,6 +2,7 @@ from __future__ import print_function
 import argparse
 import torch
 from train_loop import TrainLoop
+from utils.preemption import PREEMPTED_EXIT_CODE
 import torch.optim as optim
 import torch.utils.data
 import model as model_
@@ -12,6 +13,8 @@ import sys
 from torch.utils.tensorboard import SummaryWriter
 from utils.utils import set_np_randomseed, get_freer_gpu, parse_args_for_log
 from utils.optimizer import TransformerOptimizer
+from utils.sampler import ResumableSampler, BucketBatchSampler
+from utils.tuner import tune, write_config
 
 # Training settings
 parser = argparse.ArgumentParser(description='Speaker embbedings with combined loss')
@@ -23,11 +26,14 @@ parser.add_argument('--momentum', type=float, default=0.9, metavar='m', help='Mo
 parser.add_argument('--l2', type=float, default=1e-5, metavar='L2', help='Weight decay coefficient (default: 0.00001)')
 parser.add_argument('--max-gnorm', type=float, default=10., metavar='clip', help='Max gradient norm (default: 10.0)')
 parser.add_argument('--checkpoint-epoch', type=int, default=None, metavar='N', help='epoch to load for checkpointing. If None, training starts from scratch')
+parser.add_argument('--checkpoint-iter', type=int, default=None, metavar='N', help='Iteration of a mid-epoch checkpoint to resume from (see --checkpoint-every)')
+parser.add_argument('--checkpoint-every', type=int, default=0, metavar='N', help='Also checkpoint every N iterations, resumable from the exact batch - active if greater than 0')
 parser.add_argument('--checkpoint-path', type=str, default=None, metavar='Path', help='Path for checkpointing')
 parser.add_argument('--pretrained-path', type=str, default=None, metavar='Path', help='Path for pre trained model')
 parser.add_argument('--logdir', type=str, default=None, metavar='Path', help='Path for checkpointing')
 parser.add_argument('--train-hdf-file', type=str, default='./data/train.hdf', metavar='Path', help='Path to hdf data')
 parser.add_argument('--valid-hdf-file', type=str, default=None, metavar='Path', help='Path to hdf data')
+parser.add_argument('--valid-n-trials', type=int, default=10000, metavar='N', help='Number of fixed target and of non-target validation trials (default: 10000)')
 parser.add_argument('--model', choices=['resnet_stats', 'resnet_mfcc', 'resnet_lstm', 'resnet_small', 'resnet_large', 'TDNN'], default='resnet_lstm', help='Model arch according to input type')
 parser.add_argument('--ndiscriminators', type=int, default=1, metavar='N', help='number of discriminators (default: 1)')
 parser.add_argument('--rproj-size', type=int, default=-1, metavar='S', help='Random projection size - active if greater than 1')
@@ -41,41 +47,110 @@ parser.add_argument('--hidden-size', type=int, default=512, metavar='S', help='l
 parser.add_argument('--n-hidden', type=int, default=1, metavar='N', help='maximum number of frames per utterance (default: 1)')
 parser.add_argument('--dropout-prob', type=float, default=0.25, metavar='p', help='Dropout probability (default: 0.25)')
 parser.add_argument('--n-frames', type=int, default=1000, metavar='N', help='maximum number of frames per utterance (default: 1000)')
+parser.add_argument('--bucketing', action='store_true', default=False, help='Batches utterances of similar length, cropped to the shortest one instead of tiled to --n-frames')
+parser.add_argument('--bucket-pool-size', type=int, default=100, metavar='N', help='Number of batches sorted together by length when bucketing (default: 100)')
+parser.add_argument('--crop-lengths', type=int, nargs='+', default=None, metavar='N', help='Training crops are drawn from these lengths (in frames) instead of uniformly, batches shorter than all of them are tiled up to one. Also enables cuDNN benchmark mode')
 parser.add_argument('--warmup', type=int, default=4000, metavar='N', help='Iterations until reach lr (default: 4000)')
 parser.add_argument('--smoothing', type=float, default=0.2, metavar='l', help='Label smoothing (default: 0.2)')
+parser.add_argument('--pair-budget', type=int, default=0, metavar='N', help='Maximum number of discriminator pairs per step, sampled per positive/negative stratum - active if greater than 0')
+parser.add_argument('--pair-selection', choices=['all_triplets', 'all_pairs', 'hard_negative_pairs'], default='all_triplets', help='Pairs scored by the discriminator: from all triplets, or contrastive pairs with random or hardest negatives')
+parser.add_argument('--pair-chunk-size', type=int, default=0, metavar='N', help='Number of pairs per discriminator chunk with gradient accumulation - active if greater than 0')
+parser.add_argument('--accumulation-steps', type=int, default=1, metavar='N', help='Number of batches whose embeddings are mined together in one optimizer step (default: 1)')
+parser.add_argument('--recompute', action='store_true', default=False, help='Recomputes encoder activations during backward when accumulating batches')
+parser.add_argument('--checkpoint-stages', type=int, nargs='+', default=[], choices=[1, 2, 3, 4], metavar='N', help='Residual stages of ResNet encoders whose activations are recomputed during backward instead of stored (e.g. 1 2)')
 parser.add_argument('--pretrain', action='store_true', default=False, help='Multi class classifitcation training')
 parser.add_argument('--ablation', action='store_true', default=False, help='Drops the multi class classification loss')
 parser.add_argument('--no-cuda', action='store_true', default=False, help='Disables GPU use')
+parser.add_argument('--distributed', action='store_true', default=False, help='Data parallel training over the processes started by torchrun (one per device)')
+parser.add_argument('--dist-backend', choices=['gloo', 'nccl'], default='gloo', help='Backend for distributed training (default: gloo)')
+parser.add_argument('--gather-embeddings', action='store_true', default=False, help='Mines discriminator pairs over the embeddings of all ranks')
+parser.add_argument('--mixed-precision', action='store_true', default=False, help='Enables mixed precision training: float16 with loss scaling on GPU, bfloat16 on CPU')
+parser.add_argument('--compile', action='store_true', default=False, help='Compiles the encoder forward and the discriminator loss with torch.compile (PyTorch>=2.0)')
 parser.add_argument('--no-cp', action='store_true', default=False, help='Disables checkpointing')
+parser.add_argument('--keep-last', type=int, default=0, metavar='N', help='Number of most recent checkpoints kept on disk, older ones are deleted - active if greater than 0')
+parser.add_argument('--keep-best', type=int, default=0, metavar='N', help='Number of best checkpoints per validation EER kept in addition to --keep-last, or to the most recent checkpoint without --keep-last (default: 0)')
+parser.add_argument('--stop-patience', type=int, default=0, metavar='N', help='Stops once validation EERs (training loss without validation data) did not improve for N epochs - active if greater than 0')
+parser.add_argument('--stop-min-delta', type=float, default=0.0, metavar='D', help='Minimum decrease counted as an improvement for --stop-patience (default: 0.0)')
+parser.add_argument('--max-time', type=float, default=0.0, metavar='H', help='Stops after this many hours of training - active if greater than 0')
+parser.add_argument('--max-steps', type=int, default=0, metavar='N', help='Stops after N iterations in total - active if greater than 0')
+parser.add_argument('--profile', action='store_true', default=False, help='Times the phases of training steps (synchronizes the device, slower) and prints a summary per epoch')
+parser.add_argument('--profile-trace', type=int, nargs=2, default=None, metavar=('START', 'END'), help='Records a torch.profiler trace of iterations START to END-1 of this run')
+parser.add_argument('--profile-dir', type=str, default='./profile', metavar='Path', help='Path for torch.profiler traces')
+parser.add_argument('--bank-size', type=int, default=0, metavar='N', help='Size of the memory bank of recent embeddings used as extra negatives - active if greater than 0')
+parser.add_argument('--bank-max-age', type=int, default=0, metavar='N', help='Memory bank entries older than N iterations are not used - active if greater than 0')
+parser.add_argument('--bank-negatives', type=int, default=0, metavar='N', help='Number of memory bank negatives sampled per anchor (default: 0, all of them)')
+parser.add_argument('--no-auto-resume', action='store_true', default=False, help='Disables resuming from the newest checkpoint in --checkpoint-path, e.g. after preemption')
+parser.add_argument('--async-valid', action='store_true', default=False, help='Validates weight snapshots in a separate process while training goes on; early stopping and best checkpoints follow its reports')
+parser.add_argument('--async-valid-device', type=str, default='cpu', metavar='DEVICE', help='Device of the evaluator process, e.g. cpu or cuda:1, or none to start valid_worker.py by hand (default: cpu)')
+parser.add_argument('--average', choices=['ema', 'swa'], default=None, help='Keeps an exponential moving average (ema) or an equal-weight average (swa) of the weights in memory')
+parser.add_argument('--average-decay', type=float, default=0.999, metavar='D', help='Decay of --average ema (default: 0.999)')
+parser.add_argument('--average-every', type=int, default=1, metavar='N', help='Averages the weights every N steps (default: 1)')
+parser.add_argument('--average-start', type=int, default=0, metavar='N', help='First step averaged (default: 0)')
+parser.add_argument('--average-bn-batches', type=int, default=0, metavar='N', help='Recomputes the BatchNorm statistics of the averaged weights over N training batches each epoch - active if greater than 0')
+parser.add_argument('--average-valid', action='store_true', default=False, help='Validates the averaged weights instead of the trained ones, so early stopping and best checkpoints follow them')
+parser.add_argument('--prefetch-factor', type=int, default=2, metavar='N', help='Batches loaded in advance by each data loading worker (default: 2)')
+parser.add_argument('--tune', action='store_true', default=False, help='Probes short runs of training steps over --tune-batch-sizes and --tune-workers, prints the largest batch size fitting in memory and the fewest workers saturating compute, and exits without training')
+parser.add_argument('--tune-batch-sizes', nargs='+', type=int, default=[16, 32, 64, 128, 256, 512], metavar='N', help='Batch sizes probed by --tune, the largest one fitting in memory is recommended')
+parser.add_argument('--tune-workers', nargs='+', type=int, default=[0, 2, 4, 8, 16], metavar='N', help='Numbers of data loading workers probed by --tune')
+parser.add_argument('--tune-prefetch-factors', nargs='+', type=int, default=[2, 4], metavar='N', help='Prefetch factors probed by --tune (default: 2 4)')
+parser.add_argument('--tune-steps', type=int, default=20, metavar='N', help='Training steps measured per --tune probe, after 3 warmup steps (default: 20)')
+parser.add_argument('--tune-memory-fraction', type=float, default=0.9, metavar='F', help='Fraction of the device memory a batch size may peak at to be recommended by --tune (default: 0.9)')
+parser.add_argument('--tune-output', type=str, default=None, metavar='Path', help='JSON file the settings recommended by --tune and every probe are written to')
+parser.add_argument('--log-sync-every', type=int, default=50, metavar='N', help='Steps between copies of logged training scalars to the host (default: 50)')
+parser.add_argument('--log-artifacts-every', type=int, default=1, metavar='N', help='Write histograms, PR curves and embeddings every N validations (default: 1)')
 parser.add_argument('--verbose', type=int, default=2, metavar='N', help='Verbose is activated if > 0')
 args = parser.parse_args()
 args.cuda = True if not args.no_cuda and torch.cuda.is_available() else False
 
+if args.distributed:
+	torch.distributed.init_process_group(backend=args.dist_backend, init_method='env://')
+	rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+	# Only rank 0 prints, logs and checkpoints
+	args.verbose = args.verbose if rank==0 else 0
+else:
+	rank, world_size = 0, 1
+
 if args.verbose > 0:
 	print(args)
 
 torch.manual_seed(args.seed)
 if args.cuda:
 	torch.cuda.manual_seed(args.seed)
+	# With a few input shapes, the cost of trying convolution algorithms per shape is paid once
+	torch.backends.cudnn.benchmark = args.crop_lengths is not None
 
 if args.cuda:
-	device = get_freer_gpu()
+	device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0))) if args.distributed else get_freer_gpu()
 else:
 	device = torch.device('cpu')
 
-if args.logdir:
-	writer = SummaryWriter(log_dir=args.logdir, comment=args.model, purge_step=True if args.checkpoint_epoch is None else False)
+if args.logdir and rank==0:
+	writer = SummaryWriter(log_dir=args.logdir, comment=args.model, purge_step=True if args.checkpoint_epoch is None and args.checkpoint_iter is None else False)
 	args_dict = parse_args_for_log(args)
 	writer.add_hparams(hparam_dict=args_dict, metric_dict={'best_eer':0.0})
 else:
 	writer = None
 
 train_dataset = Loader(hdf5_name = args.train_hdf_file, max_nb_frames = args.n_frames)
-train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers, worker_init_fn=set_np_randomseed)
 
-if args.valid_hdf_file is not None:
-	valid_dataset = Loader_valid(hdf5_name = args.valid_hdf_file, max_nb_frames = args.n_frames)
-	valid_loader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.valid_batch_size, shuffle=True, num_workers=args.workers, worker_init_fn=set_np_randomseed)
+def make_train_loader(batch_size, workers, prefetch_factor):
+	# Also called by --tune with the candidate settings. prefetch_factor is only passed along with workers: torch<2.0
+	# rejects it otherwise, even as None
+	loader_kwargs = {'num_workers': workers, 'worker_init_fn': set_np_randomseed}
+	if workers>0:
+		loader_kwargs['prefetch_factor'] = prefetch_factor
+	if args.bucketing:
+		train_sampler = BucketBatchSampler(train_dataset, batch_size=batch_size, max_frames=args.n_frames, num_replicas=world_size, rank=rank, pool_size=args.bucket_pool_size, seed=args.seed)
+		return torch.utils.data.DataLoader(train_dataset, batch_sampler=train_sampler, **loader_kwargs)
+	train_sampler = ResumableSampler(train_dataset, num_replicas=world_size, rank=rank, seed=args.seed)
+	return torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, sampler=train_sampler, **loader_kwargs)
+
+train_loader = make_train_loader(args.batch_size, args.workers, args.prefetch_factor)
+
+# Validation runs on rank 0 only
+if args.valid_hdf_file is not None and rank==0:
+	valid_dataset = Loader_valid(hdf5_name = args.valid_hdf_file, max_nb_frames = args.n_frames, n_trials = args.valid_n_trials)
+	valid_loader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.valid_batch_size, shuffle=False, num_workers=args.workers, worker_init_fn=set_np_randomseed)
 else:
 	valid_loader=None
 
@@ -86,15 +161,15 @@ if args.pretrained_path is not None:
 	print('\nUsing pretrained config for discriminator. Ignoring args.')
 
 if args.model == 'resnet_stats':
-	model = model_.ResNet_stats(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
+	model = model_.ResNet_stats(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size, checkpoint_stages=args.checkpoint_stages)
 elif args.model == 'resnet_mfcc':
-	model = model_.ResNet_mfcc(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
+	model = model_.ResNet_mfcc(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size, checkpoint_stages=args.checkpoint_stages)
 if args.model == 'resnet_lstm':
-	model = model_.ResNet_lstm(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
+	model = model_.ResNet_lstm(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size, checkpoint_stages=args.checkpoint_stages)
 elif args.model == 'resnet_small':
-	model = model_.ResNet_small(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
+	model = model_.ResNet_small(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size, checkpoint_stages=args.checkpoint_stages)
 elif args.model == 'resnet_large':
-	model = model_.ResNet_large(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
+	model = model_.ResNet_large(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size, checkpoint_stages=args.checkpoint_stages)
 elif args.model == 'TDNN':
 	model = model_.TDNN(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
 
@@ -115,7 +190,7 @@ model = model.to(device)
 
 optimizer = TransformerOptimizer(optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.l2, nesterov=True), lr=args.lr, warmup_steps=args.warmup)
 
-trainer = TrainLoop(model, optimizer, train_loader, valid_loader, max_gnorm=args.max_gnorm, label_smoothing=args.smoothing, verbose=args.verbose, device=device, save_cp=(not args.no_cp), checkpoint_path=args.checkpoint_path, checkpoint_epoch=args.checkpoint_epoch, pretrain=args.pretrain, ablation=args.ablation, cuda=args.cuda, logger=writer)
+trainer = TrainLoop(model, optimizer, train_loader, valid_loader, max_gnorm=args.max_gnorm, label_smoothing=args.smoothing, verbose=args.verbose, device=device, save_cp=(not args.no_cp), checkpoint_path=args.checkpoint_path, checkpoint_epoch=args.checkpoint_epoch, pretrain=args.pretrain, ablation=args.ablation, cuda=args.cuda, logger=writer, pair_budget=args.pair_budget, pair_chunk_size=args.pair_chunk_size, pair_selection=args.pair_selection, mixed_precision=args.mixed_precision, gather_embeddings=args.gather_embeddings, accumulation_steps=args.accumulation_steps, recompute=args.recompute, keep_last=args.keep_last, keep_best=args.keep_best, log_sync_every=args.log_sync_every, log_artifacts_every=args.log_artifacts_every, checkpoint_every=args.checkpoint_every, checkpoint_iter=args.checkpoint_iter, compile_step=args.compile, crop_lengths=args.crop_lengths, stop_patience=args.stop_patience, stop_min_delta=args.stop_min_delta, max_time=args.max_time*3600, max_steps=args.max_steps, profile=args.profile, profile_trace=args.profile_trace, profile_dir=args.profile_dir, bank_size=args.bank_size, bank_max_age=args.bank_max_age, bank_negatives=args.bank_negatives, auto_resume=(not args.no_auto_resume), async_valid=args.async_valid, async_valid_device=None if args.async_valid_device=='none' else args.async_valid_device, average=args.average, average_decay=args.average_decay, average_every=args.average_every, average_start=args.average_start, average_bn_batches=args.average_bn_batches, average_valid=args.average_valid)
 
 if args.verbose > 0:
 	print(' ')
@@ -138,15 +213,35 @@ if args.verbose > 0:
 	print('Max. grad norm: {}'.format(args.max_gnorm))
 	print('Warmup iterations: {}'.format(args.warmup))
 	print('Label smoothing: {}'.format(args.smoothing))
+	print('Pair budget: {}'.format(args.pair_budget))
+	print('Pair chunk size: {}'.format(args.pair_chunk_size))
+	print('Pair selection: {}'.format(args.pair_selection))
+	print('Accumulation steps: {}'.format(args.accumulation_steps))
+	print('Recompute: {}'.format(args.recompute))
+	print('Mixed precision: {}'.format(args.mixed_precision))
+	print('Number of processes: {}'.format(world_size))
+	print('Gather embeddings: {}'.format(args.gather_embeddings))
 	print('Max length: {}'.format(args.n_frames))
 	print('Number of train speakers: {}'.format(train_dataset.n_speakers))
 	print('Number of train examples: {}'.format(len(train_dataset.utt_list)))
-	if args.valid_hdf_file:
+	if valid_loader is not None:
 		print('Number of valid speakers: {}'.format(valid_dataset.n_speakers))
 		print('Number of valid examples: {}'.format(len(valid_dataset.utt_list)))
+		print('Number of valid trials: {}'.format(len(valid_dataset.trials[2])))
 	print(' ')
 
+if args.tune:
+	recommended, results = tune(trainer.train_step, make_train_loader, args.tune_batch_sizes, args.tune_workers, prefetch_factors=args.tune_prefetch_factors, n_steps=args.tune_steps, device=device, memory_fraction=args.tune_memory_fraction)
+	print('\nRecommended: --batch-size {} --workers {} --prefetch-factor {}'.format(recommended['batch_size'], recommended['workers'], recommended['prefetch_factor'] or args.prefetch_factor))
+	if args.tune_output is not None:
+		write_config(recommended, results, args.tune_output, workers_arg='workers')
+	sys.exit(0)
+
 best_eer = trainer.train(n_epochs=args.epochs, save_every=args.save_every)
 
-if args.logdir:
+# Requeue-friendly exit status, the next run resumes from the newest checkpoint
+if trainer.preempted:
+	sys.exit(PREEMPTED_EXIT_CODE)
+
+if writer is not None:
 	writer.add_hparams(hparam_dict=args_dict, metric_dict={'best_eer':best_eer})
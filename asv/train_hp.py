@@ -2,6 +2,7 @@ from __future__ import print_function
 import argparse
 import torch
 from train_loop import TrainLoop
+from utils.preemption import PREEMPTED_EXIT_CODE
 import torch.optim as optim
 import torch.utils.data
 import model as model_
@@ -13,10 +14,12 @@ import pickle
 from time import sleep
 from utils.utils import *
 from utils.optimizer import TransformerOptimizer
+from utils.sampler import ResumableSampler
 
 # Training settings
 parser = argparse.ArgumentParser(description='Train for hp search')
 parser.add_argument('--batch-size', type=int, default=64, metavar='N', help='input batch size for training (default: 64)')
+parser.add_argument('--seed', type=int, default=1, metavar='S', help='random seed of the training order (default: 1)')
 parser.add_argument('--valid-batch-size', type=int, default=64, metavar='N', help='input batch size for training (default: 64)')
 parser.add_argument('--epochs', type=int, default=500, metavar='N', help='number of epochs to train (default: 500)')
 parser.add_argument('--lr', type=float, default=0.001, metavar='LR', help='learning rate (default: 0.001)')
@@ -35,12 +38,44 @@ parser.add_argument('--n-hidden', type=int, default=1, metavar='N', help='maximu
 parser.add_argument('--dropout-prob', type=float, default=0.25, metavar='p', help='Dropout probability (default: 0.25)')
 parser.add_argument('--n-frames', type=int, default=800, metavar='N', help='maximum number of frames per utterance (default: 800)')
 parser.add_argument('--smoothing', type=float, default=0.2, metavar='l', help='Label smoothing (default: 0.2)')
+parser.add_argument('--pair-budget', type=int, default=0, metavar='N', help='Maximum number of discriminator pairs per step, sampled per positive/negative stratum - active if greater than 0')
+parser.add_argument('--pair-selection', choices=['all_triplets', 'all_pairs', 'hard_negative_pairs'], default='all_triplets', help='Pairs scored by the discriminator: from all triplets, or contrastive pairs with random or hardest negatives')
+parser.add_argument('--pair-chunk-size', type=int, default=0, metavar='N', help='Number of pairs per discriminator chunk with gradient accumulation - active if greater than 0')
+parser.add_argument('--accumulation-steps', type=int, default=1, metavar='N', help='Number of batches whose embeddings are mined together in one optimizer step (default: 1)')
+parser.add_argument('--recompute', action='store_true', default=False, help='Recomputes encoder activations during backward when accumulating batches')
+parser.add_argument('--checkpoint-stages', type=int, nargs='+', default=[], choices=[1, 2, 3, 4], metavar='N', help='Residual stages of ResNet encoders whose activations are recomputed during backward instead of stored (e.g. 1 2)')
 parser.add_argument('--warmup', type=int, default=4000, metavar='N', help='Iterations until reach lr (default: 4000)')
 parser.add_argument('--train-hdf-file', type=str, default='./data/train.hdf', metavar='Path', help='Path to hdf data')
 parser.add_argument('--valid-hdf-file', type=str, default=None, metavar='Path', help='Path to hdf data')
+parser.add_argument('--valid-n-trials', type=int, default=10000, metavar='N', help='Number of fixed target and of non-target validation trials (default: 10000)')
 parser.add_argument('--cuda', type=str, default=None)
+parser.add_argument('--mixed-precision', action='store_true', default=False, help='Enables mixed precision training: float16 with loss scaling on GPU, bfloat16 on CPU')
+parser.add_argument('--compile', action='store_true', default=False, help='Compiles the encoder forward and the discriminator loss with torch.compile (PyTorch>=2.0)')
 parser.add_argument('--out-file', type=str, default='./eer.p')
 parser.add_argument('--checkpoint-path', type=str, default=None, metavar='Path', help='Path for checkpointing')
+parser.add_argument('--keep-last', type=int, default=0, metavar='N', help='Number of most recent checkpoints kept on disk, older ones are deleted - active if greater than 0')
+parser.add_argument('--keep-best', type=int, default=0, metavar='N', help='Number of best checkpoints per validation EER kept in addition to --keep-last, or to the most recent checkpoint without --keep-last (default: 0)')
+parser.add_argument('--stop-patience', type=int, default=0, metavar='N', help='Stops once validation EERs (training loss without validation data) did not improve for N epochs - active if greater than 0')
+parser.add_argument('--stop-min-delta', type=float, default=0.0, metavar='D', help='Minimum decrease counted as an improvement for --stop-patience (default: 0.0)')
+parser.add_argument('--max-time', type=float, default=0.0, metavar='H', help='Stops after this many hours of training - active if greater than 0')
+parser.add_argument('--max-steps', type=int, default=0, metavar='N', help='Stops after N iterations in total - active if greater than 0')
+parser.add_argument('--profile', action='store_true', default=False, help='Times the phases of training steps (synchronizes the device, slower) and prints a summary per epoch')
+parser.add_argument('--profile-trace', type=int, nargs=2, default=None, metavar=('START', 'END'), help='Records a torch.profiler trace of iterations START to END-1 of this run')
+parser.add_argument('--profile-dir', type=str, default='./profile', metavar='Path', help='Path for torch.profiler traces')
+parser.add_argument('--bank-size', type=int, default=0, metavar='N', help='Size of the memory bank of recent embeddings used as extra negatives - active if greater than 0')
+parser.add_argument('--bank-max-age', type=int, default=0, metavar='N', help='Memory bank entries older than N iterations are not used - active if greater than 0')
+parser.add_argument('--bank-negatives', type=int, default=0, metavar='N', help='Number of memory bank negatives sampled per anchor (default: 0, all of them)')
+parser.add_argument('--no-auto-resume', action='store_true', default=False, help='Disables resuming from the newest checkpoint in --checkpoint-path, e.g. after preemption')
+parser.add_argument('--async-valid', action='store_true', default=False, help='Validates weight snapshots in a separate process while training goes on; early stopping and best checkpoints follow its reports')
+parser.add_argument('--async-valid-device', type=str, default='cpu', metavar='DEVICE', help='Device of the evaluator process, e.g. cpu or cuda:1, or none to start valid_worker.py by hand (default: cpu)')
+parser.add_argument('--average', choices=['ema', 'swa'], default=None, help='Keeps an exponential moving average (ema) or an equal-weight average (swa) of the weights in memory')
+parser.add_argument('--average-decay', type=float, default=0.999, metavar='D', help='Decay of --average ema (default: 0.999)')
+parser.add_argument('--average-every', type=int, default=1, metavar='N', help='Averages the weights every N steps (default: 1)')
+parser.add_argument('--average-start', type=int, default=0, metavar='N', help='First step averaged (default: 0)')
+parser.add_argument('--average-bn-batches', type=int, default=0, metavar='N', help='Recomputes the BatchNorm statistics of the averaged weights over N training batches each epoch - active if greater than 0')
+parser.add_argument('--average-valid', action='store_true', default=False, help='Validates the averaged weights instead of the trained ones, so early stopping and best checkpoints follow them')
+parser.add_argument('--log-sync-every', type=int, default=50, metavar='N', help='Steps between copies of logged training scalars to the host (default: 50)')
+parser.add_argument('--log-artifacts-every', type=int, default=1, metavar='N', help='Write histograms, PR curves and embeddings every N validations (default: 1)')
 parser.add_argument('--logdir', type=str, default=None, metavar='Path', help='Path for checkpointing')
 parser.add_argument('--cp-name', type=str, default=None)
 parser.add_argument('--verbose', type=int, default=2, metavar='N', help='Verbose is activated if > 0')
@@ -57,21 +92,23 @@ else:
 	writer = None
 
 train_dataset = Loader(hdf5_name = args.train_hdf_file, max_nb_frames = args.n_frames)
-train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers, worker_init_fn=set_np_randomseed)
+# Resumable order, so a run resumed from an iteration checkpoint continues from the next batch of the interrupted epoch
+train_sampler = ResumableSampler(train_dataset, num_replicas=1, rank=0, seed=args.seed)
+train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, sampler=train_sampler, num_workers=args.workers, worker_init_fn=set_np_randomseed)
 
-valid_dataset = Loader_valid(hdf5_name = args.valid_hdf_file, max_nb_frames = args.n_frames)
-valid_loader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.valid_batch_size, shuffle=True, num_workers=args.workers, worker_init_fn=set_np_randomseed)
+valid_dataset = Loader_valid(hdf5_name = args.valid_hdf_file, max_nb_frames = args.n_frames, n_trials = args.valid_n_trials)
+valid_loader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.valid_batch_size, shuffle=False, num_workers=args.workers, worker_init_fn=set_np_randomseed)
 
 if args.model == 'resnet_stats':
-	model = model_.ResNet_stats(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
+	model = model_.ResNet_stats(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size, checkpoint_stages=args.checkpoint_stages)
 elif args.model == 'resnet_mfcc':
-	model = model_.ResNet_mfcc(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
+	model = model_.ResNet_mfcc(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size, checkpoint_stages=args.checkpoint_stages)
 if args.model == 'resnet_lstm':
-	model = model_.ResNet_lstm(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
+	model = model_.ResNet_lstm(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size, checkpoint_stages=args.checkpoint_stages)
 elif args.model == 'resnet_small':
-	model = model_.ResNet_small(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
+	model = model_.ResNet_small(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size, checkpoint_stages=args.checkpoint_stages)
 elif args.model == 'resnet_large':
-	model = model_.ResNet_large(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
+	model = model_.ResNet_large(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size, checkpoint_stages=args.checkpoint_stages)
 elif args.model == 'TDNN':
 	model = model_.TDNN(n_z=args.latent_size, nh=args.n_hidden, n_h=args.hidden_size, proj_size=train_dataset.n_speakers, ncoef=args.ncoef, dropout_prob=args.dropout_prob, sm_type=args.softmax, ndiscriminators=args.ndiscriminators, r_proj_size=args.rproj_size)
 
@@ -85,7 +122,7 @@ if args.cuda:
 
 optimizer = TransformerOptimizer(optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.l2, nesterov=True), lr=args.lr, warmup_steps=args.warmup)
 
-trainer = TrainLoop(model, optimizer, train_loader, valid_loader, max_gnorm=args.max_gnorm, label_smoothing=args.smoothing, verbose=-1, device=device, cp_name=args.cp_name, save_cp=True, checkpoint_path=args.checkpoint_path, pretrain=False, cuda=args.cuda, logger=writer)
+trainer = TrainLoop(model, optimizer, train_loader, valid_loader, max_gnorm=args.max_gnorm, label_smoothing=args.smoothing, verbose=-1, device=device, cp_name=args.cp_name, save_cp=True, checkpoint_path=args.checkpoint_path, pretrain=False, cuda=args.cuda, logger=writer, pair_budget=args.pair_budget, pair_chunk_size=args.pair_chunk_size, pair_selection=args.pair_selection, mixed_precision=args.mixed_precision, accumulation_steps=args.accumulation_steps, recompute=args.recompute, keep_last=args.keep_last, keep_best=args.keep_best, log_sync_every=args.log_sync_every, log_artifacts_every=args.log_artifacts_every, compile_step=args.compile, stop_patience=args.stop_patience, stop_min_delta=args.stop_min_delta, max_time=args.max_time*3600, max_steps=args.max_steps, profile=args.profile, profile_trace=args.profile_trace, profile_dir=args.profile_dir, bank_size=args.bank_size, bank_max_age=args.bank_max_age, bank_negatives=args.bank_negatives, auto_resume=(not args.no_auto_resume), async_valid=args.async_valid, async_valid_device=None if args.async_valid_device=='none' else args.async_valid_device, average=args.average, average_decay=args.average_decay, average_every=args.average_every, average_start=args.average_start, average_bn_batches=args.average_bn_batches, average_valid=args.average_valid)
 
 print(' ')
 print('CP name: {}'.format(args.cp_name))
@@ -106,15 +143,27 @@ print('l2: {}'.format(args.l2))
 print('Max. grad norm: {}'.format(args.max_gnorm))
 print('Warmup iterations: {}'.format(args.warmup))
 print('Label smoothing: {}'.format(args.smoothing))
+print('Pair budget: {}'.format(args.pair_budget))
+print('Pair chunk size: {}'.format(args.pair_chunk_size))
+print('Pair selection: {}'.format(args.pair_selection))
+print('Accumulation steps: {}'.format(args.accumulation_steps))
+print('Recompute: {}'.format(args.recompute))
+print('Mixed precision: {}'.format(args.mixed_precision))
 print('Max length: {}'.format(args.n_frames))
 print('Number of train speakers: {}'.format(train_dataset.n_speakers))
 print('Number of train examples: {}'.format(len(train_dataset.utt_list)))
 if args.valid_hdf_file:
 	print('Number of valid speakers: {}'.format(valid_dataset.n_speakers))
 	print('Number of valid examples: {}'.format(len(valid_dataset.utt_list)))
+	print('Number of valid trials: {}'.format(len(valid_dataset.trials[2])))
 print(' ')
 
 best_eer = trainer.train(n_epochs=args.epochs, save_every=args.epochs+10)
+
+# Requeue-friendly exit status, the next run resumes from the newest checkpoint
+if trainer.preempted:
+	sys.exit(PREEMPTED_EXIT_CODE)
+
 if args.logdir:
 	writer.add_hparams(hparam_dict=args_dict, metric_dict={'best_eer':best_eer[0]})
 
@@ -4,14 +4,29 @@ import torch.nn.functional as F
 import numpy as np
 
 import os
+import time
 from tqdm import tqdm
 from utils.losses import LabelSmoothingLoss
-from utils.harvester import AllTripletSelector
+from utils.harvester import AllPositivePairSelector, HardNegativePairSelector, TripletTemplateCache, sample_pairs
+from utils.memory_bank import MemoryBank
 from utils.utils import compute_eer
+from utils.evaluator import OutOfBandValidator, evaluate_trials, fuse_scores
+from utils.checkpointer import AsyncCheckpointer
+from utils.stopping import EarlyStopping
+from utils.metrics import MetricsLogger
+from utils.profiler import StepProfiler
+from utils.preemption import PreemptionHandler, latest_checkpoint
+from utils.averaging import WeightAverager, swapped_model
+from utils.steplog import StepLog, history_state, load_history, close_history
+from utils.distributed import get_world_size, get_rank, gather_views, broadcast_model, average_gradients, all_reduce_mean, broadcast_seed, broadcast_flag
+
+def views_cat(tensors, n_views=5):
+	# Concatenates view-major batches (n_views blocks of the same examples) into a single view-major batch
+	return torch.cat([x.view(n_views, -1, *x.size()[1:]) for x in tensors], 1).view(-1, *tensors[0].size()[1:])
 
 class TrainLoop(object):
 
-	def __init__(self, model, optimizer, train_loader, valid_loader, max_gnorm=10.0, label_smoothing=0.0, verbose=-1, device=0, cp_name=None, save_cp=False, checkpoint_path=None, checkpoint_epoch=None, pretrain=False, ablation=False, cuda=True, logger=None):
+	def __init__(self, model, optimizer, train_loader, valid_loader, max_gnorm=10.0, label_smoothing=0.0, verbose=-1, device=0, cp_name=None, save_cp=False, checkpoint_path=None, checkpoint_epoch=None, pretrain=False, ablation=False, cuda=True, logger=None, pair_budget=0, pair_chunk_size=0, pair_selection='all_triplets', mixed_precision=False, gather_embeddings=False, accumulation_steps=1, recompute=False, keep_last=0, keep_best=0, log_sync_every=50, log_artifacts_every=1, checkpoint_every=0, checkpoint_iter=None, compile_step=False, crop_lengths=None, stop_patience=0, stop_min_delta=0.0, max_time=0, max_steps=0, profile=False, profile_trace=None, profile_dir='./profile', bank_size=0, bank_max_age=0, bank_negatives=0, auto_resume=False, async_valid=False, async_valid_device='cpu', average=None, average_decay=0.999, average_every=1, average_start=0, average_bn_batches=0, average_valid=False):
 		if checkpoint_path is None:
 			# Save to current directory
 			self.checkpoint_path = os.getcwd()
@@ -21,6 +36,8 @@ class TrainLoop(object):
 				os.mkdir(self.checkpoint_path)
 
 		self.save_epoch_fmt = os.path.join(self.checkpoint_path, cp_name) if cp_name else os.path.join(self.checkpoint_path, 'checkpoint_{}ep.pt')
+		self.save_iter_fmt = os.path.join(self.checkpoint_path, cp_name) if cp_name else os.path.join(self.checkpoint_path, 'checkpoint_{}it.pt')
+		self.step_log_fmt = os.path.join(self.checkpoint_path, os.path.splitext(cp_name)[0]+'_{}.f32') if cp_name else os.path.join(self.checkpoint_path, 'steps_{}.f32')
 		self.cuda_mode = cuda
 		self.pretrain = pretrain
 		self.ablation = ablation
@@ -30,14 +47,74 @@ class TrainLoop(object):
 		self.train_loader = train_loader
 		self.valid_loader = valid_loader
 		self.total_iters = 0
+		# Position in the current epoch (loader batches), the seed of its example list, and RNG states to restore
+		# once its loader iterator exists. Set from mid-epoch checkpoints
+		self.epoch_step = 0
+		self.epoch_seed = None
+		self.rng_state = None
+		self.checkpoint_every = checkpoint_every
 		self.cur_epoch = 0
-		self.harvester = AllTripletSelector()
-		self.verbose = verbose
-		self.save_cp = save_cp
+		self.pair_templates = TripletTemplateCache(n_views=5)
+
+		if pair_selection=='all_triplets':
+			self.pair_selector = None
+		elif pair_selection=='all_pairs':
+			self.pair_selector = AllPositivePairSelector(balance=True)
+		elif pair_selection=='hard_negative_pairs':
+			self.pair_selector = HardNegativePairSelector()
+		else:
+			raise NotImplementedError
+
+		# Extra negatives for the discriminator from recent batches
+		self.memory_bank = MemoryBank(bank_size, max_age=bank_max_age) if bank_size>0 else None
+		self.bank_negatives = bank_negatives
+		self.world_size = get_world_size()
+		self.rank = get_rank()
+		self.gather_embeddings = gather_embeddings and self.world_size>1
+		self.verbose = verbose if self.rank==0 else -1
+		self.save_cp = save_cp and self.rank==0
 		self.device = device
 		self.logger = logger
-		self.history = {'train_loss': [], 'train_loss_batch': [], 'ce_loss': [], 'ce_loss_batch': [], 'bin_loss': [], 'bin_loss_batch': []}
+		self.metrics = MetricsLogger(writer=logger, sync_every=log_sync_every, artifact_every=log_artifacts_every)
+		# Per-step values are kept in float32 step logs, on disk next to the checkpoints when saving them
+		self.history = {'train_loss': [], 'train_loss_batch': self.step_log('train_loss_batch'), 'ce_loss': [], 'ce_loss_batch': self.step_log('ce_loss_batch'), 'bin_loss': [], 'bin_loss_batch': self.step_log('bin_loss_batch')}
 		self.disc_label_smoothing = label_smoothing*0.5
+		self.checkpointer = AsyncCheckpointer(keep_last=keep_last, keep_best=keep_best)
+		# Early stopping monitors the validation EERs, or the training loss without validation data
+		self.stopping = EarlyStopping(patience=stop_patience, min_delta=stop_min_delta, max_time=max_time, max_steps=max_steps)
+		self.monitored = ['e2e_eer', 'cos_eer'] if self.valid_loader is not None else ['train_loss']
+		self.profiler = StepProfiler(enabled=profile, device=device if cuda else None, metrics=self.metrics, trace_steps=profile_trace, trace_dir=profile_dir)
+		self.preemption = PreemptionHandler()
+		self.preempted = False
+		self.preemption_flag = None
+		# Weights averaged in memory (EMA or SWA), optionally validated in place of the trained ones
+		self.averager = WeightAverager(self.model, mode=average, decay=average_decay, every=average_every, start=average_start) if average else None
+		self.average_bn_batches = average_bn_batches
+		self.average_valid = average_valid and self.averager is not None
+		# Out-of-band validation: weight snapshots are validated by a separate process on async_valid_device (None:
+		# started by hand with valid_worker.py) and the results are applied once reported
+		self.validator = OutOfBandValidator(self.checkpoint_path) if async_valid and self.valid_loader is not None else None
+		self.async_valid_device = async_valid_device
+		self.pair_budget = pair_budget
+		self.pair_chunk_size = pair_chunk_size
+		self.accumulation_steps = accumulation_steps
+		self.crop_lengths = sorted(crop_lengths) if crop_lengths else None
+		self.recompute = recompute
+
+		# Mixed precision: float16 autocast with loss scaling on GPU, bfloat16 autocast (no scaling needed) on CPU.
+		# Losses (AM-softmax, label smoothing, BCE) are computed in float32 outside of autocast
+		self.mixed_precision = mixed_precision
+		self.amp_device_type = 'cuda' if self.cuda_mode else 'cpu'
+		self.amp_dtype = torch.float16 if self.cuda_mode else torch.bfloat16
+		self.scaler = torch.cuda.amp.GradScaler(enabled=(mixed_precision and self.cuda_mode))
+
+		# Optional torch.compile of the encoder forward and of the pair scoring plus BCE. Pair mining has data dependent
+		# shapes and stays eager. With dynamic=True, new crop lengths and pair counts do not trigger recompilation
+		if compile_step:
+			self.forward_encoder = torch.compile(self.model.forward, dynamic=True)
+			self.bin_loss_sum = torch.compile(self.bin_loss_sum, dynamic=True)
+		else:
+			self.forward_encoder = self.model.forward
 
 		if label_smoothing>0.0:
 			self.ce_criterion = LabelSmoothingLoss(label_smoothing, lbl_set_size=train_loader.dataset.n_speakers)
@@ -51,14 +128,52 @@ class TrainLoop(object):
 
 		if checkpoint_epoch is not None:
 			self.load_checkpoint(self.save_epoch_fmt.format(checkpoint_epoch))
+		elif checkpoint_iter is not None:
+			self.load_checkpoint(self.save_iter_fmt.format(checkpoint_iter))
+		elif auto_resume:
+			# Newest epoch or mid-epoch checkpoint, e.g. written when the previous run was preempted
+			checkpoint = latest_checkpoint([self.save_epoch_fmt.format('*'), self.save_iter_fmt.format('*')])
+			if checkpoint is not None:
+				if self.verbose>0:
+					print('Resuming from {}'.format(checkpoint))
+				self.load_checkpoint(checkpoint)
+
+		if self.world_size>1:
+			broadcast_model(self.model)
 
 	def train(self, n_epochs=1, save_every=1):
 
+		self.history['stop_reason'] = None
+		self.preemption.install()
+
+		if self.validator is not None:
+			self.validator.start(self.model, self.valid_loader, device=self.async_valid_device, pair_chunk_size=self.pair_chunk_size, mixed_precision=self.mixed_precision, launch=self.async_valid_device is not None)
+			# Reports of a previous run that are not in the resumed history yet
+			self.collect_reports(save_every, resumed=True)
+
 		while (self.cur_epoch < n_epochs):
 
-			np.random.seed()
+			if self.epoch_step==0:
+				# Every rank builds the same example list so the distributed sampler shards it without overlap
+				self.epoch_seed = broadcast_seed(self.device if self.cuda_mode else None) if self.world_size>1 else np.random.RandomState().randint(2**31)
+			np.random.seed(self.epoch_seed)
 			self.train_loader.dataset.update_lists()
 
+			# A resumable sampler skips the batches already done in this epoch; any other sampler restarts it.
+			# Batch samplers (BucketBatchSampler) count batches, samplers count examples
+			if hasattr(self.train_loader.batch_sampler, 'set_start'):
+				sampler, start = self.train_loader.batch_sampler, self.epoch_step
+			else:
+				sampler, start = self.train_loader.sampler, self.epoch_step*self.train_loader.batch_size
+			if hasattr(sampler, 'set_epoch'):
+				sampler.set_epoch(self.cur_epoch)
+			if hasattr(sampler, 'set_start'):
+				sampler.set_start(start)
+			else:
+				self.epoch_step = 0
+
+			epoch_start = time.time()
+
 			if self.verbose>1:
 				print(' ')
 				print('Epoch {}/{}'.format(self.cur_epoch+1, n_epochs))
@@ -67,6 +182,12 @@ class TrainLoop(object):
 			else:
 				train_iter = enumerate(self.train_loader)
 
+			if self.rng_state is not None:
+				# Creating the loader iterator draws from the torch generator, so the saved states are restored after it
+				self.set_rng_state(self.rng_state[:2])
+				np.random.set_state(self.rng_state[2])
+				self.rng_state = None
+
 			if self.pretrain:
 
 				ce_epoch=0.0
@@ -74,110 +195,163 @@ class TrainLoop(object):
 					ce = self.pretrain_step(batch)
 					self.history['train_loss_batch'].append(ce)
 					ce_epoch+=ce
-					if self.logger:
-						self.logger.add_scalar('Train/Cross entropy', ce, self.total_iters)
-						self.logger.add_scalar('Info/LR', self.optimizer.optimizer.param_groups[0]['lr'], self.total_iters)
+					self.metrics.add_scalars(self.total_iters, **{'Train/Cross entropy': ce, 'Info/LR': self.optimizer.optimizer.param_groups[0]['lr']})
 
 					self.total_iters += 1
+					if self.preemption_requested():
+						return self.preempt()
+					if self.budget_reached():
+						break
 
 				self.history['train_loss'].append(ce_epoch/(t+1))
+				self.metrics.clear()
 
 				if self.verbose>1:
 					print('Train loss: {:0.4f}'.format(self.history['train_loss'][-1]))
 
 			else:
 
-				train_loss_epoch=0.0
-				ce_loss_epoch=0.0
-				bin_loss_epoch=0.0
+				micro_batches=[]
+				self.profiler.begin_epoch()
 				for t, batch in train_iter:
-					train_loss, ce_loss, bin_loss = self.train_step(batch)
-					self.history['train_loss_batch'].append(train_loss)
-					self.history['ce_loss_batch'].append(ce_loss)
-					self.history['bin_loss_batch'].append(bin_loss)
-					train_loss_epoch+=train_loss
-					ce_loss_epoch+=ce_loss
-					bin_loss_epoch+=bin_loss
-					if self.logger:
-						self.logger.add_scalar('Train/Total train Loss', train_loss, self.total_iters)
-						self.logger.add_scalar('Train/Binary class. Loss', bin_loss, self.total_iters)
-						self.logger.add_scalar('Train/Cross enropy', ce_loss, self.total_iters)
-						self.logger.add_scalar('Info/LR', self.optimizer.optimizer.param_groups[0]['lr'], self.total_iters)
+					self.epoch_step += 1
+					if self.accumulation_steps>1:
+						# Loader batches are grouped into one step. An incomplete group at the end of the epoch is dropped
+						micro_batches.append(batch)
+						if len(micro_batches)<self.accumulation_steps:
+							continue
+						self.profiler.begin_step()
+						train_loss, ce_loss, bin_loss = self.train_step_accumulated(micro_batches)
+						micro_batches=[]
+					else:
+						self.profiler.begin_step()
+						train_loss, ce_loss, bin_loss = self.train_step(batch)
+					self.profiler.end_step(self.total_iters)
+					# Losses stay on the device and are copied to the host every log_sync_every steps
+					self.metrics.add_scalars(self.total_iters, **{'Train/Total train Loss': train_loss, 'Train/Binary class. Loss': bin_loss, 'Train/Cross enropy': ce_loss, 'Info/LR': self.optimizer.optimizer.param_groups[0]['lr']})
 
 					self.total_iters += 1
-
-				self.history['train_loss'].append(train_loss_epoch/(t+1))
-				self.history['ce_loss'].append(ce_loss_epoch/(t+1))
-				self.history['bin_loss'].append(bin_loss_epoch/(t+1))
+					if self.averager is not None:
+						self.averager.update(self.model, self.total_iters)
+					if self.preemption_requested():
+						return self.preempt()
+					if self.budget_reached():
+						break
+
+					if self.save_cp and self.checkpoint_every>0 and self.total_iters % self.checkpoint_every == 0:
+						self.checkpointing(self.save_iter_fmt.format(self.total_iters))
+
+				for key, tag in [('train_loss', 'Train/Total train Loss'), ('ce_loss', 'Train/Cross enropy'), ('bin_loss', 'Train/Binary class. Loss')]:
+					values = self.metrics.collect(tag)
+					self.history[key+'_batch'].extend(values)
+					if len(values)>0:
+						self.history[key].append(np.mean(values))
+					elif len(self.history[key])>0:
+						# No step this epoch (e.g. resumed from a checkpoint written after its last step): the previous
+						# epoch loss is carried rather than the nan mean of nothing
+						self.history[key].append(self.history[key][-1])
+				self.metrics.clear()
 
 				if self.verbose>1:
 					print(' ')
+					print('Logging overhead: {:0.2f}% of train time'.format(100.*self.metrics.pop_overhead()/(time.time()-epoch_start)))
+					if hasattr(self.train_loader.dataset, 'tiled_fraction'):
+						print('Tiled frames: {:0.2f}%'.format(100.*self.train_loader.dataset.tiled_fraction(getattr(self.train_loader.batch_sampler, 'batches', None))))
 					print('Total train loss: {:0.4f}'.format(self.history['train_loss'][-1]))
 					print('CE loss: {:0.4f}'.format(self.history['ce_loss'][-1]))
 					print('Binary classification loss: {:0.4f}'.format(self.history['bin_loss'][-1]))
 					print(' ')
+					if self.profiler.enabled:
+						print(self.profiler.summary())
+						print(' ')
 
-			if self.valid_loader is not None:
+			if self.averager is not None and self.average_bn_batches>0:
+				self.averager.recalibrate_bn(self.train_loader, self.average_bn_batches, self.device if self.cuda_mode else None)
 
-				e2e_scores, cos_scores, labels, emb, y_ = None, None, None, None, None
+			with swapped_model(self, self.averager.model if self.average_valid else None):
 
-				for t, batch in enumerate(self.valid_loader):
-					e2e_scores_batch, cos_scores_batch, labels_batch, emb_batch, y_batch = self.valid(batch)
+				if self.valid_loader is not None and self.validator is not None:
 
-					try:
-						e2e_scores = np.concatenate([e2e_scores, e2e_scores_batch], 0)
-						cos_scores = np.concatenate([cos_scores, cos_scores_batch], 0)
-						labels = np.concatenate([labels, labels_batch], 0)
-						emb = np.concatenate([emb, emb_batch], 0)
-						y_ = np.concatenate([y_, y_batch], 0)
-					except:
-						e2e_scores, cos_scores, labels, emb, y_ = e2e_scores_batch, cos_scores_batch, labels_batch, emb_batch, y_batch
+					# Training carries on while the snapshot is validated
+					self.validator.submit(self.model, self.cur_epoch+1, self.total_iters)
 
-				fus_scores = (e2e_scores + 0.5*(cos_scores+1.))*0.5
+				elif self.valid_loader is not None:
 
-				self.history['e2e_eer'].append(compute_eer(labels, e2e_scores))
-				self.history['cos_eer'].append(compute_eer(labels, cos_scores))
-				self.history['fus_eer'].append(compute_eer(labels, fus_scores))
+					e2e_scores, cos_scores, labels, emb, y_ = self.evaluate()
 
-				if self.logger:
-					self.logger.add_scalar('Valid/E2E EER', self.history['e2e_eer'][-1], self.total_iters-1)
-					self.logger.add_scalar('Valid/Best E2E EER', np.min(self.history['e2e_eer']), self.total_iters-1)
-					self.logger.add_scalar('Valid/Cosine EER', self.history['cos_eer'][-1], self.total_iters-1)
-					self.logger.add_scalar('Valid/Best Cosine EER', np.min(self.history['cos_eer']), self.total_iters-1)
-					self.logger.add_scalar('Valid/Fus EER', self.history['fus_eer'][-1], self.total_iters-1)
-					self.logger.add_scalar('Valid/Best Fus EER', np.min(self.history['fus_eer']), self.total_iters-1)
-					self.logger.add_pr_curve('E2E ROC', labels=labels, predictions=e2e_scores, global_step=self.total_iters-1)
-					self.logger.add_pr_curve('Cosine ROC', labels=labels, predictions=cos_scores, global_step=self.total_iters-1)
-					self.logger.add_pr_curve('Fus ROC', labels=labels, predictions=fus_scores, global_step=self.total_iters-1)
+					fus_scores = fuse_scores(e2e_scores, cos_scores)
 
-					if emb.shape[0]>20000:
-						idxs = np.random.choice(np.arange(emb.shape[0]), size=20000, replace=False)
-						emb, y_ = emb[idxs, :], y_[idxs]
+					self.history['e2e_eer'].append(compute_eer(labels, e2e_scores))
+					self.history['cos_eer'].append(compute_eer(labels, cos_scores))
+					self.history['fus_eer'].append(compute_eer(labels, fus_scores))
 
-					self.logger.add_histogram('Valid/Embeddings', values=emb, global_step=self.total_iters-1)
-					self.logger.add_histogram('Valid/COS_Scores', values=cos_scores, global_step=self.total_iters-1)
-					self.logger.add_histogram('Valid/E2E_Scores', values=e2e_scores, global_step=self.total_iters-1)
-					self.logger.add_histogram('Valid/FUS_Scores', values=fus_scores, global_step=self.total_iters-1)
-					self.logger.add_histogram('Valid/Labels', values=labels, global_step=self.total_iters-1)
+					self.log_valid(self.total_iters-1)
 
-					if self.verbose>1:
-						self.logger.add_embedding(mat=emb, metadata=list(y_), global_step=self.total_iters-1)
-
-				if self.verbose>1:
-					print(' ')
-					print('Current e2e EER, best e2e EER, and epoch: {:0.4f}, {:0.4f}, {}'.format(self.history['e2e_eer'][-1], np.min(self.history['e2e_eer']), 1+np.argmin(self.history['e2e_eer'])))
-					print('Current cos EER, best cos EER, and epoch: {:0.4f}, {:0.4f}, {}'.format(self.history['cos_eer'][-1], np.min(self.history['cos_eer']), 1+np.argmin(self.history['cos_eer'])))
-					print('Current fus EER, best fus EER, and epoch: {:0.4f}, {:0.4f}, {}'.format(self.history['fus_eer'][-1], np.min(self.history['fus_eer']), 1+np.argmin(self.history['fus_eer'])))
+					if self.logger:
+						# Written from the logging thread, subsampled and every log_artifacts_every epochs
+						self.metrics.add_artifact('add_pr_curve', 'E2E ROC', self.total_iters-1, labels=labels, predictions=e2e_scores)
+						self.metrics.add_artifact('add_pr_curve', 'Cosine ROC', self.total_iters-1, labels=labels, predictions=cos_scores)
+						self.metrics.add_artifact('add_pr_curve', 'Fus ROC', self.total_iters-1, labels=labels, predictions=fus_scores)
+						self.metrics.add_artifact('add_histogram', 'Valid/Embeddings', self.total_iters-1, values=emb)
+						self.metrics.add_artifact('add_histogram', 'Valid/COS_Scores', self.total_iters-1, values=cos_scores)
+						self.metrics.add_artifact('add_histogram', 'Valid/E2E_Scores', self.total_iters-1, values=e2e_scores)
+						self.metrics.add_artifact('add_histogram', 'Valid/FUS_Scores', self.total_iters-1, values=fus_scores)
+						self.metrics.add_artifact('add_histogram', 'Valid/Labels', self.total_iters-1, values=labels)
+
+						if self.verbose>1:
+							self.metrics.add_artifact('add_embedding', 'default', self.total_iters-1, mat=emb, metadata=list(y_))
 
 			if self.verbose>1:
 				print('Current LR: {}'.format(self.optimizer.optimizer.param_groups[0]['lr']))
 
+			self.epoch_step = 0
 			self.cur_epoch += 1
 
-			if self.valid_loader is not None and self.save_cp and (self.cur_epoch % save_every == 0 or self.history['e2e_eer'][-1] < np.min([np.inf]+self.history['e2e_eer'][:-1]) or self.history['cos_eer'][-1] < np.min([np.inf]+self.history['cos_eer'][:-1])):
+			if self.validator is not None:
+				# Every epoch is saved before its results are known, then kept or deleted once reported
+				if self.save_cp:
+					self.checkpointing(pending=True)
+				self.collect_reports(save_every)
+
+			stop_reason = self.stop_reason()
+			if stop_reason is not None:
+				self.history['stop_reason'] = stop_reason
+				self.history['best_epoch'] = self.stopping.best_epoch(self.history, self.monitored)
+				self.history['last_improvement'] = self.stopping.last_improvement(self.history, self.monitored)
+
+			if self.validator is not None:
+				# Saved above, pending its validation results
+				pass
+			elif self.valid_loader is not None and self.save_cp and (self.cur_epoch % save_every == 0 or self.history['e2e_eer'][-1] < np.min([np.inf]+self.history['e2e_eer'][:-1]) or self.history['cos_eer'][-1] < np.min([np.inf]+self.history['cos_eer'][:-1])):
 					self.checkpointing()
 			elif self.save_cp and self.cur_epoch % save_every == 0:
 					self.checkpointing()
+			elif self.save_cp and stop_reason is not None:
+					self.checkpointing()
+
+			if stop_reason is not None:
+				if self.verbose>1:
+					print('Stopping after epoch {}: {}. Best epoch: {}'.format(self.cur_epoch, stop_reason, self.history['best_epoch']))
+				break
+
+		if self.validator is not None:
+			# Results of the last epochs, which may change the best epoch
+			self.collect_reports(save_every, wait=True)
+			self.validator.close()
+			if self.history['stop_reason'] is not None:
+				self.history['best_epoch'] = self.stopping.best_epoch(self.history, self.monitored)
+				self.history['last_improvement'] = self.stopping.last_improvement(self.history, self.monitored)
+
+		if self.history['stop_reason'] is None:
+			self.history['stop_reason'] = 'completed {} epochs'.format(n_epochs)
+			self.history['best_epoch'] = self.stopping.best_epoch(self.history, self.monitored)
+			self.history['last_improvement'] = self.stopping.last_improvement(self.history, self.monitored)
+
+		self.profiler.close()
+		self.preemption.restore()
+		self.checkpointer.wait()
+		self.metrics.flush()
+		close_history(self.history)
 
 		if self.verbose>1:
 			print('Training done!')
@@ -202,67 +376,368 @@ class TrainLoop(object):
 		utterances = torch.cat([utterances, utterances_1, utterances_2, utterances_3, utterances_4], dim=0)
 		y = torch.cat(5*[y], dim=0).squeeze().contiguous()
 
-		ridx = np.random.randint(utterances.size(3)//4, utterances.size(3))
-		utterances = utterances[:,:,:,:ridx].contiguous()
+		ridx = self.draw_crop_length(utterances.size(3))
+		utterances = self.crop_frames(utterances, ridx)
+
+		y_cpu = y
 
 		if self.cuda_mode:
-			utterances = utterances.to(self.device, non_blocking=True)
-			y = y.to(self.device, non_blocking=True)
+			with self.profiler.phase('h2d'):
+				utterances = utterances.to(self.device, non_blocking=True)
+				y = y.to(self.device, non_blocking=True)
 
-		out, embeddings = self.model.forward(utterances)
-		out_norm = F.normalize(out, p=2, dim=1)
+		with self.profiler.phase('forward'):
+			with torch.autocast(device_type=self.amp_device_type, dtype=self.amp_dtype, enabled=self.mixed_precision):
+				out, embeddings = self.forward_encoder(utterances)
 
-		if not self.ablation:
-			ce_loss = self.ce_criterion(self.model.out_proj(out_norm, y), y)
-		else:
-			ce_loss = 0.0
+			out, embeddings = out.float(), embeddings.float()
+			out_norm = F.normalize(out, p=2, dim=1)
+
+			if not self.ablation:
+				ce_loss = self.ce_criterion(self.model.out_proj(out_norm, y), y)
+			else:
+				ce_loss = 0.0
 
-		# Get all triplets now for bin classifier
-		triplets_idx = self.harvester.get_triplets(out_norm.detach(), y)
+		loss_bin, loss_bin_surrogate = self.disc_loss(embeddings, out_norm, y, y_cpu)
 
-		if self.cuda_mode:
-			triplets_idx = triplets_idx.to(self.device, non_blocking=True)
+		with self.profiler.phase('backward'):
+			self.scaler.scale(ce_loss + loss_bin_surrogate).backward()
+		self.optimizer_step()
 
-		try:
+		return self.report_losses(ce_loss, loss_bin)
+
+	def train_step_accumulated(self, batches):
+
+		# One step over several loader batches. Their embeddings are concatenated (view-major, as for a single batch)
+		# before pair mining, so the discriminator loss is the one of a batch holding all of them. With recompute, the
+		# encoder runs without storing activations and each micro-batch is replayed afterwards to backpropagate the
+		# gradients of its embeddings
+		self.model.train()
+		self.optimizer.zero_grad()
 
-			emb_a = torch.index_select(embeddings, 0, triplets_idx[:, 0])
-			emb_p = torch.index_select(embeddings, 0, triplets_idx[:, 1])
-			emb_n = torch.index_select(embeddings, 0, triplets_idx[:, 2])
+		# A single crop length for the whole step, as for one large batch. Bucketed batches can differ in length
+		n_frames = min([batch[0].size(3) for batch in batches])
+		ridx = self.draw_crop_length(n_frames)
 
-			emb_ap = torch.cat([emb_a, emb_p],1)
-			emb_an = torch.cat([emb_a, emb_n],1)
-			emb_ = torch.cat([emb_ap, emb_an],0)
+		micro_batches = []
+		for batch in batches:
+			utterances, utterances_1, utterances_2, utterances_3, utterances_4, y = batch
 
-			y_ = torch.cat([torch.rand(emb_ap.size(0))*self.disc_label_smoothing+(1.0-self.disc_label_smoothing), torch.rand(emb_an.size(0))*self.disc_label_smoothing],0) if isinstance(self.ce_criterion, LabelSmoothingLoss) else torch.cat([torch.ones(emb_ap.size(0)), torch.zeros(emb_an.size(0))],0)
+			utterances = torch.cat([utterances, utterances_1, utterances_2, utterances_3, utterances_4], dim=0)
+			y = torch.cat(5*[y], dim=0).squeeze().contiguous()
 
-			if isinstance(self.ce_criterion, LabelSmoothingLoss):
-				y_ = torch.clamp(y_, min=0.0, max=1.0)
+			utterances = self.crop_frames(utterances, ridx)
 
 			if self.cuda_mode:
-				y_ = y_.to(self.device, non_blocking=True)
+				with self.profiler.phase('h2d'):
+					utterances = utterances.to(self.device, non_blocking=True)
+
+			micro_batches.append((utterances, y))
+
+		y_cpu = views_cat([y for utterances, y in micro_batches])
+		y = y_cpu.to(self.device, non_blocking=True) if self.cuda_mode else y_cpu
 
-			loss_bin = 0.0
-			pred_bin = self.model.forward_bin(emb_)
+		with self.profiler.phase('forward'):
+			outs, embeddings, rng_states = [], [], []
+			for utterances, y_micro in micro_batches:
+				rng_states.append(self.get_rng_state())
+				with torch.set_grad_enabled(not self.recompute), torch.autocast(device_type=self.amp_device_type, dtype=self.amp_dtype, enabled=self.mixed_precision):
+					out, emb = self.forward_encoder(utterances)
+				outs.append(out.float())
+				embeddings.append(emb.float())
 
-			if self.model.ndiscriminators>1:
-				for pred in pred_bin:
-					loss_bin += torch.nn.BCELoss()(pred.squeeze(), y_)
+			if self.recompute:
+				outs = [out.requires_grad_(True) for out in outs]
+				embeddings = [emb.requires_grad_(True) for emb in embeddings]
+				bn_buffers = [buffer.clone() for buffer in self.model.buffers()]
+
+			out_norm = F.normalize(views_cat(outs), p=2, dim=1)
+
+			if not self.ablation:
+				ce_loss = self.ce_criterion(self.model.out_proj(out_norm, y), y)
 			else:
-				loss_bin = torch.nn.BCELoss()(pred_bin.squeeze(), y_)
+				ce_loss = 0.0
+
+		loss_bin, loss_bin_surrogate = self.disc_loss(views_cat(embeddings), out_norm, y, y_cpu)
+
+		with self.profiler.phase('backward'):
+			self.scaler.scale(ce_loss + loss_bin_surrogate).backward()
+
+		if self.recompute:
+			# Replays use the dropout masks of the first pass. Running statistics of batch norm layers are only updated once
+			with self.profiler.phase('recompute'):
+				rng_state = self.get_rng_state()
+				for (utterances, y_micro), micro_rng_state, out_leaf, emb_leaf in zip(micro_batches, rng_states, outs, embeddings):
+					self.set_rng_state(micro_rng_state)
+					with torch.autocast(device_type=self.amp_device_type, dtype=self.amp_dtype, enabled=self.mixed_precision):
+						out, emb = self.forward_encoder(utterances)
+					outputs = [(x.float(), leaf.grad) for x, leaf in [(out, out_leaf), (emb, emb_leaf)] if leaf.grad is not None]
+					if outputs:
+						torch.autograd.backward(*zip(*outputs))
+
+				self.set_rng_state(rng_state)
+				with torch.no_grad():
+					for buffer, saved_buffer in zip(self.model.buffers(), bn_buffers):
+						buffer.copy_(saved_buffer)
+
+		self.optimizer_step()
+
+		return self.report_losses(ce_loss, loss_bin)
+
+	def draw_crop_length(self, n_frames):
+		# Uniform in [n_frames//4, n_frames), or one of crop_lengths so that the encoder sees a few input shapes and
+		# per-shape kernel selection (cuDNN benchmark, oneDNN primitives, compiled graphs) is reused across steps.
+		# Batches shorter than every crop length (e.g. short buckets) get the largest crop length reached by tiling
+		# them the fewest times, see crop_frames
+		if self.crop_lengths:
+			lengths = [length for length in self.crop_lengths if length<=n_frames]
+			if not lengths:
+				n_tiles = int(np.ceil(self.crop_lengths[0]/n_frames))
+				return max([length for length in self.crop_lengths if length<=n_tiles*n_frames])
+			return lengths[np.random.randint(len(lengths))]
+		return np.random.randint(n_frames//4, n_frames)
+
+	def crop_frames(self, utterances, length):
+		# Batches shorter than length are tiled along time first, as the loaders do with short utterances
+		if utterances.size(3)<length:
+			utterances = utterances.repeat(1, 1, 1, int(np.ceil(length/utterances.size(3))))
+		return utterances[:,:,:,:length].contiguous()
+
+	def budget_reached(self):
+		# Ranks stop together. Step counts agree on every rank, elapsed time is taken from rank 0
+		if self.world_size>1 and self.stopping.max_time>0:
+			return broadcast_flag(self.stopping.budget_reason(self.total_iters) is not None, self.device if self.cuda_mode else None)
+		return self.stopping.budget_reason(self.total_iters) is not None
+
+	def preemption_requested(self):
+		# Signals may reach the ranks at different times, so a request on any rank applies to every rank. The flags are
+		# exchanged every step within the gradient all-reduce (see optimizer_step), so the checkpoint is written well
+		# within the grace period before SIGKILL. Steps without it (pretraining) broadcast the flag of rank 0
+		if self.world_size>1:
+			if self.preemption_flag is not None:
+				flag, self.preemption_flag = self.preemption_flag, None
+				return bool(flag.item())
+			return broadcast_flag(self.preemption.requested, self.device if self.cuda_mode else None)
+		return self.preemption.requested
+
+	def preempt(self):
+		# Called between steps: the mid-epoch checkpoint resumes from the next batch (see auto_resume). The caller exits
+		# with utils.preemption.PREEMPTED_EXIT_CODE when self.preempted is set
+		self.preempted = True
+		self.history['stop_reason'] = 'preempted by signal {}'.format(self.preemption.received) if self.preemption.requested else 'preempted on another rank'
+		if self.save_cp:
+			self.checkpointing(self.save_iter_fmt.format(self.total_iters))
+		if self.validator is not None:
+			# Snapshots not validated yet are picked up by the next run
+			self.validator.close()
+		self.profiler.close()
+		self.preemption.restore()
+		self.checkpointer.wait()
+		self.metrics.flush()
+		close_history(self.history)
+		if self.verbose>1:
+			print('Preempted after {} iterations ({})'.format(self.total_iters, self.history['stop_reason']))
+
+	def stop_reason(self):
+		# Rank 0 is the only one validating, so its decision applies to every rank
+		stop_reason = self.stopping.stop_reason(self.history, self.monitored, self.total_iters)
+		if self.world_size>1:
+			stop = broadcast_flag(stop_reason is not None, self.device if self.cuda_mode else None)
+			stop_reason = (stop_reason or 'stopped by rank 0') if stop else None
+		return stop_reason
+
+	def get_rng_state(self):
+		return torch.get_rng_state(), torch.cuda.get_rng_state(self.device) if self.cuda_mode else None
+
+	def set_rng_state(self, state):
+		torch.set_rng_state(state[0])
+		if self.cuda_mode and state[1] is not None:
+			torch.cuda.set_rng_state(state[1], self.device)
+
+	def optimizer_step(self):
+
+		if self.world_size>1:
+			with self.profiler.phase('allreduce'):
+				self.preemption_flag = average_gradients(self.model, flag=self.preemption.requested)
+		with self.profiler.phase('clip'):
+			self.scaler.unscale_(self.optimizer)
+			grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_gnorm)
+		with self.profiler.phase('step'):
+			self.scaler.step(self.optimizer)
+			self.scaler.update()
+
+		if self.logger:
+			self.metrics.add_scalars(self.total_iters, **{'Info/Grad_norm': grad_norm})
+
+	def report_losses(self, ce_loss, loss_bin):
+
+		if self.world_size>1:
+			# Reported losses are averaged over ranks
+			ce_loss = all_reduce_mean(ce_loss.detach()) if not self.ablation else 0.0
+			loss_bin = all_reduce_mean(loss_bin.detach())
+
+		loss = ce_loss + loss_bin
+
+		# Detached device tensors, see utils.metrics
+		return loss.detach(), ce_loss.detach() if not self.ablation else 0.0, loss_bin.detach()/self.model.ndiscriminators
+
+	def disc_loss(self, embeddings, out_norm, y, y_cpu=None):
+
+		if self.gather_embeddings:
+			# Pairs are mined over the global batch. Gradients of the gathered embeddings are summed over ranks and
+			# routed back to the rank that computed them
+			local_size = y.size(0)//5
+			with self.profiler.phase('gather'):
+				embeddings = gather_views(embeddings, grad=True)
+				out_norm = gather_views(out_norm.detach())
+				y = gather_views(y)
+				y_cpu = y.cpu()
+		elif y_cpu is None:
+			y_cpu = y.cpu()
+
+		try:
+
+			with self.profiler.phase('mining'):
+				if self.pair_selector is None:
+					# All-triplets pairs for bin classifier. They only depend on the label layout, so templates are reused across steps
+					ap_pairs, ap_counts, an_pairs, an_counts = self.pair_templates.get_pairs(y_cpu, device=y.device)
+				else:
+					# Contrastive pairs, each scored once
+					ap_pairs, an_pairs = self.pair_selector.get_pairs(out_norm.detach(), y)
+					ap_counts, an_counts = torch.ones(ap_pairs.size(0), dtype=torch.long, device=y.device), torch.ones(an_pairs.size(0), dtype=torch.long, device=y.device)
+
+				if self.memory_bank is not None:
+					ap_counts, an_pairs, an_counts = self.add_bank_negatives(y, ap_pairs, ap_counts, an_pairs, an_counts)
+					batch_embeddings = embeddings
+					if self.memory_bank.embeddings is not None:
+						# Bank rows come after the batch, without gradient. They are copied before the batch is pushed
+						embeddings = torch.cat([embeddings, self.memory_bank.embeddings], 0)
+					self.memory_bank.push(batch_embeddings, y, self.total_iters)
+
+				n_rows = ap_counts.sum()+an_counts.sum()
+
+				if self.gather_embeddings:
+					# Each rank scores the pairs anchored on its own examples. Gradients are averaged over ranks, so the
+					# partial losses are scaled by world_size to add up to the global loss
+					ap_local = (ap_pairs[:, 0]//local_size)%self.world_size == self.rank
+					an_local = (an_pairs[:, 0]//local_size)%self.world_size == self.rank
+					ap_pairs, ap_counts, an_pairs, an_counts = ap_pairs[ap_local], ap_counts[ap_local], an_pairs[an_local], an_counts[an_local]
+					n_rows = n_rows.float()/self.world_size
+
+				if self.pair_budget>0:
+					# Positives and negatives are sampled as separate strata so both keep their share of the loss
+					n_ap = min(ap_pairs.size(0), self.pair_budget//2)
+					n_an = min(an_pairs.size(0), self.pair_budget-n_ap)
+					ap_idx, ap_weights = sample_pairs(ap_counts, n_ap)
+					an_idx, an_weights = sample_pairs(an_counts, n_an)
+					ap_pairs, ap_counts, an_pairs, an_counts = ap_pairs[ap_idx], ap_counts[ap_idx], an_pairs[an_idx], an_counts[an_idx]
+					weights = torch.cat([ap_weights, an_weights], 0)
+				else:
+					weights = torch.cat([ap_counts, an_counts], 0).float()
+
+				# Unique anchor-positive pairs first, then unique anchor-negative pairs, each weighted by the number of triplets it appears in
+				idx_1 = torch.cat([ap_pairs[:, 0], an_pairs[:, 0]], 0)
+				idx_2 = torch.cat([ap_pairs[:, 1], an_pairs[:, 1]], 0)
+
+				y_ = self.get_disc_targets(ap_counts, an_counts)
+
+			self.profiler.count('n_pairs', idx_1.size(0))
+			self.profiler.count('n_triplet_rows', n_rows)
+
+			# With chunks, this includes the backward pass through the discriminator
+			with self.profiler.phase('disc_forward'):
+				if self.pair_chunk_size>0 and idx_1.size(0)>self.pair_chunk_size:
+					loss_bin, loss_bin_surrogate = self.compute_bin_loss_chunked(embeddings, idx_1, idx_2, y_, weights, n_rows)
+				else:
+					loss_bin = self.compute_bin_loss(embeddings, idx_1, idx_2, y_, weights, n_rows)
+					loss_bin_surrogate = loss_bin
 
 		except IndexError:
 
 			loss_bin = torch.ones(1).to(self.device, non_blocking=True)
+			# The gathered embeddings stay in the graph so that every rank takes part in the backward all-reduce
+			loss_bin_surrogate = loss_bin + 0.0*embeddings.sum() if self.gather_embeddings else loss_bin
 
-		loss = ce_loss + loss_bin
-		loss.backward()
-		grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_gnorm)
-		self.optimizer.step()
+		return loss_bin, loss_bin_surrogate
 
-		if self.logger:
-			self.logger.add_scalar('Info/Grad_norm', grad_norm, self.total_iters)
+	def add_bank_negatives(self, y, ap_pairs, ap_counts, an_pairs, an_counts):
+
+		# Bank entry i is row batch_size+i of the embeddings scored by the discriminator
+		anchors, bank_idx = self.memory_bank.negative_pairs(y, self.total_iters, self.bank_negatives)
+
+		if self.pair_selector is not None:
+			# Contrastive pairs are scored once each: every (a, n) is one more negative pair, positives are unchanged
+			bank_pairs = torch.stack([anchors, y.size(0)+bank_idx], 1)
+			return ap_counts, torch.cat([an_pairs, bank_pairs], 0), torch.cat([an_counts, torch.ones_like(anchors)], 0)
+
+		# Bank negatives n of anchor a make the triplets (a, p, n) with every positive pair (a, p) of the batch: the
+		# multiplicity of (a, p) grows by the number of bank negatives of a, and (a, n) appears once per positive of a
+		n_negatives = torch.bincount(anchors, minlength=y.size(0))
+		n_positives = torch.bincount(ap_pairs[:, 0], minlength=y.size(0))
+
+		bank_counts = n_positives[anchors]
+		keep = bank_counts>0
+		bank_pairs = torch.stack([anchors[keep], y.size(0)+bank_idx[keep]], 1)
+
+		ap_counts = ap_counts + n_negatives[ap_pairs[:, 0]]
+
+		return ap_counts, torch.cat([an_pairs, bank_pairs], 0), torch.cat([an_counts, bank_counts[keep]], 0)
+
+	def get_disc_targets(self, ap_counts, an_counts):
+
+		if isinstance(self.ce_criterion, LabelSmoothingLoss):
+			# Smoothed targets are drawn once per triplet row. BCE is linear in the target, so k repetitions of a pair
+			# are equivalent to a single row weighted by k with the mean of its k targets
+			counts = torch.cat([ap_counts, an_counts], 0)
+			rows = torch.repeat_interleave(torch.arange(counts.size(0), device=counts.device), counts)
+			y_ = torch.zeros(counts.size(0), device=counts.device).index_add_(0, rows, torch.rand(rows.size(0), device=counts.device))/counts.float()
+			y_ = y_*self.disc_label_smoothing
+			y_[:ap_counts.size(0)] += 1.0-self.disc_label_smoothing
+			y_ = torch.clamp(y_, min=0.0, max=1.0)
+		else:
+			y_ = torch.cat([torch.ones(ap_counts.size(0), device=ap_counts.device), torch.zeros(an_counts.size(0), device=an_counts.device)], 0)
+
+		return y_
+
+	def compute_bin_loss(self, embeddings, idx_1, idx_2, y_, weights, n_rows=None):
+
+		# Weighted sum over unique pairs, normalized by the number of rows the triplet-level loss would average over
+		return self.bin_loss_sum(embeddings, idx_1, idx_2, y_, weights)/(weights.sum() if n_rows is None else n_rows)
+
+	def bin_loss_sum(self, embeddings, idx_1, idx_2, y_, weights):
+
+		loss_bin = 0.0
+
+		with torch.autocast(device_type=self.amp_device_type, dtype=self.amp_dtype, enabled=self.mixed_precision):
+			pred_bin = self.model.forward_bin_pairs(embeddings, idx_1, idx_2)
+
+		if self.model.ndiscriminators>1:
+			for pred in pred_bin:
+				loss_bin += F.binary_cross_entropy(pred.squeeze(1).float(), y_, weight=weights, reduction='sum')
+		else:
+			loss_bin = F.binary_cross_entropy(pred_bin.squeeze(1).float(), y_, weight=weights, reduction='sum')
 
-		return loss.item(), ce_loss.item() if not self.ablation else 0.0, loss_bin.item()/self.model.ndiscriminators
+		return loss_bin
+
+	def compute_bin_loss_chunked(self, embeddings, idx_1, idx_2, y_, weights, n_rows=None):
+
+		# The discriminator loss is evaluated and backpropagated pair_chunk_size pairs at a time into a detached copy of
+		# the embeddings, so only one chunk of discriminator activations is alive at any time. The accumulated gradient
+		# w.r.t. the embeddings is returned as a surrogate, (embeddings*grad).sum(), to be backpropagated through the encoder.
+		n_rows = weights.sum() if n_rows is None else n_rows
+		embeddings_ = embeddings.detach().requires_grad_(True)
+		loss_bin = 0.0
+
+		for i in range(0, idx_1.size(0), self.pair_chunk_size):
+			chunk = slice(i, i+self.pair_chunk_size)
+			loss_chunk = self.compute_bin_loss(embeddings_, idx_1[chunk], idx_2[chunk], y_[chunk], weights[chunk], n_rows)
+			self.scaler.scale(loss_chunk).backward()
+			loss_bin += loss_chunk.detach()
+
+		# The surrogate is scaled again together with the CE loss, so the loss scale is taken out of the accumulated gradient
+		grad_scale = self.scaler.get_scale() if self.scaler.is_enabled() else 1.0
+
+		return loss_bin, (embeddings*embeddings_.grad).sum()/grad_scale
 
 	def pretrain_step(self, batch):
 
@@ -274,8 +749,8 @@ class TrainLoop(object):
 		utterances = torch.cat([utterances, utterances_1, utterances_2, utterances_3, utterances_4], dim=0)
 		y = torch.cat(5*[y], dim=0).squeeze().contiguous()
 
-		ridx = np.random.randint(utterances.size(3)//4, utterances.size(3))
-		utterances = utterances[:,:,:,:ridx].contiguous()
+		ridx = self.draw_crop_length(utterances.size(3))
+		utterances = self.crop_frames(utterances, ridx)
 
 		if self.cuda_mode:
 			utt, y = utt.to(self.device), y.to(self.device).squeeze()
@@ -290,56 +765,61 @@ class TrainLoop(object):
 		return loss.item()
 
 
-	def valid(self, batch):
-
-		self.model.eval()
-
-		with torch.no_grad():
-
-			utterances, utterances_1, utterances_2, utterances_3, utterances_4, y = batch
-
-			utterances = torch.cat([utterances, utterances_1, utterances_2, utterances_3, utterances_4], dim=0)
-			y = torch.cat(5*[y], dim=0).squeeze().contiguous()
-
-			ridx = np.random.randint(utterances.size(3)//4, utterances.size(3))
-			utterances = utterances[:,:,:,:ridx].contiguous()
-
-			if self.cuda_mode:
-				utterances = utterances.to(self.device)
-				y = y.to(self.device)
-
-			out, embeddings = self.model.forward(utterances)
-			out_norm = F.normalize(out, p=2, dim=1)
-
-			# Get all triplets now for bin classifier
-			triplets_idx = self.harvester.get_triplets(out_norm.detach(), y)
-			triplets_idx = triplets_idx.to(self.device)
+	def evaluate(self):
+		return evaluate_trials(self.model, self.valid_loader, self.device if self.cuda_mode else None, self.pair_chunk_size, self.mixed_precision)
 
-			emb_a = torch.index_select(embeddings, 0, triplets_idx[:, 0])
-			emb_p = torch.index_select(embeddings, 0, triplets_idx[:, 1])
-			emb_n = torch.index_select(embeddings, 0, triplets_idx[:, 2])
+	def log_valid(self, step):
 
-			emb_ap = torch.cat([emb_a, emb_p],1)
-			emb_an = torch.cat([emb_a, emb_n],1)
+		if self.logger:
+			self.metrics.add_scalars(step, **{'Valid/E2E EER': self.history['e2e_eer'][-1], 'Valid/Best E2E EER': np.min(self.history['e2e_eer']), 'Valid/Cosine EER': self.history['cos_eer'][-1], 'Valid/Best Cosine EER': np.min(self.history['cos_eer']), 'Valid/Fus EER': self.history['fus_eer'][-1], 'Valid/Best Fus EER': np.min(self.history['fus_eer'])})
 
-			if self.model.ndiscriminators>1:
-				e2e_scores_p = torch.cat(self.model.forward_bin(emb_ap), 1).mean(1).squeeze()
-				e2e_scores_n = torch.cat(self.model.forward_bin(emb_an), 1).mean(1).squeeze()
-			else:
-				e2e_scores_p = self.model.forward_bin(emb_ap).squeeze()
-				e2e_scores_n = self.model.forward_bin(emb_an).squeeze()
+		if self.verbose>1:
+			print(' ')
+			print('Current e2e EER, best e2e EER, and epoch: {:0.4f}, {:0.4f}, {}'.format(self.history['e2e_eer'][-1], np.min(self.history['e2e_eer']), 1+np.argmin(self.history['e2e_eer'])))
+			print('Current cos EER, best cos EER, and epoch: {:0.4f}, {:0.4f}, {}'.format(self.history['cos_eer'][-1], np.min(self.history['cos_eer']), 1+np.argmin(self.history['cos_eer'])))
+			print('Current fus EER, best fus EER, and epoch: {:0.4f}, {:0.4f}, {}'.format(self.history['fus_eer'][-1], np.min(self.history['fus_eer']), 1+np.argmin(self.history['fus_eer'])))
+
+	def collect_reports(self, save_every=1, wait=False, resumed=False):
+		# Applies out-of-band validation reports in epoch order: history, logs, and the fate of pending epoch
+		# checkpoints. With wait=True, blocks until every epoch done is reported
+		while len(self.history['e2e_eer'])<self.cur_epoch:
+			epoch = len(self.history['e2e_eer'])+1
+			report = self.validator.report(epoch, wait=wait)
+
+			if report is None and resumed and self.validator.lost(epoch):
+				# Snapshot lost with the previous run: the epoch never counts as the best one
+				print('No validation snapshot nor report for epoch {}'.format(epoch))
+				report = {'e2e_eer': np.inf, 'cos_eer': np.inf, 'fus_eer': np.inf, 'total_iters': None}
+			elif report is None:
+				break
+
+			new_best = report['e2e_eer'] < np.min([np.inf]+self.history['e2e_eer']) or report['cos_eer'] < np.min([np.inf]+self.history['cos_eer'])
+			for key in ['e2e_eer', 'cos_eer', 'fus_eer']:
+				self.history[key].append(report[key])
+
+			if report['total_iters'] is not None:
+				if self.verbose>1:
+					print(' ')
+					print('Validation of epoch {} reported'.format(epoch))
+				self.log_valid(report['total_iters']-1)
 
-			cos_scores_p = torch.nn.functional.cosine_similarity(emb_a, emb_p)
-			cos_scores_n = torch.nn.functional.cosine_similarity(emb_a, emb_n)
+			if self.save_cp:
+				# The newest epoch checkpoint is kept to resume from
+				path = self.save_epoch_fmt.format(epoch)
+				keep = epoch % save_every == 0 or new_best or path==self.save_epoch_fmt.format(self.cur_epoch)
+				self.checkpointer.update(path, scores={'e2e_eer': report['e2e_eer'], 'cos_eer': report['cos_eer']}, keep=keep)
 
-		return np.concatenate([e2e_scores_p.detach().cpu().numpy(), e2e_scores_n.detach().cpu().numpy()], 0), np.concatenate([cos_scores_p.detach().cpu().numpy(), cos_scores_n.detach().cpu().numpy()], 0), np.concatenate([np.ones(e2e_scores_p.size(0)), np.zeros(e2e_scores_n.size(0))], 0), embeddings.detach().cpu().numpy(), y.detach().cpu().numpy()
+	def step_log(self, key):
+		# Checkpoints only reference the log files, so their size does not grow with the number of steps
+		return StepLog(path=self.step_log_fmt.format(key) if self.save_cp else None)
 
-	def checkpointing(self):
+	def checkpointing(self, path=None, pending=False):
 
 		# Checkpointing
 		if self.verbose>1:
 			print('Checkpointing...')
 		ckpt = {'model_state': self.model.state_dict(),
+		'averaged_state': self.averager.state_dict() if self.averager is not None else None,
 		'optimizer_state': self.optimizer.state_dict(),
 		'ndiscriminators': self.model.ndiscriminators,
 		'r_proj_size': self.model.r_proj_size,
@@ -349,13 +829,25 @@ class TrainLoop(object):
 		'latent_size': self.model.latent_size,
 		'sm_type': self.model.sm_type,
 		'ncoef': self.model.ncoef,
-		'history': self.history,
+		'scaler_state': self.scaler.state_dict(),
+		'history': history_state(self.history),
 		'total_iters': self.total_iters,
-		'cur_epoch': self.cur_epoch}
-		try:
-			torch.save(ckpt, self.save_epoch_fmt.format(self.cur_epoch))
-		except:
-			torch.save(ckpt, self.save_epoch_fmt)
+		'cur_epoch': self.cur_epoch,
+		'step_num': self.optimizer.step_num,
+		'epoch_step': self.epoch_step,
+		'epoch_seed': self.epoch_seed,
+		'stopping_state': self.stopping.state_dict(),
+		'rng_state': self.get_rng_state() + (np.random.get_state(),),
+		'epoch_metrics': self.epoch_metrics()}
+		# Written in the background; best checkpoints are ranked by validation EER for retention. Mid-epoch
+		# checkpoints have no validation scores of their own, pending ones get theirs once validated out of band
+		scores = {'e2e_eer': self.history['e2e_eer'][-1], 'cos_eer': self.history['cos_eer'][-1]} if self.valid_loader is not None and self.epoch_step==0 and not pending else None
+		self.checkpointer.save(ckpt, path if path is not None else self.save_epoch_fmt.format(self.cur_epoch), scores=scores, pending=pending)
+
+	def epoch_metrics(self):
+		# Per-step values of the current epoch not yet moved to history
+		self.metrics.sync()
+		return {tag: list(values) for tag, values in self.metrics.values.items()}
 
 	def load_checkpoint(self, ckpt):
 
@@ -364,13 +856,27 @@ class TrainLoop(object):
 			ckpt = torch.load(ckpt, map_location = lambda storage, loc: storage)
 			# Load model state
 			self.model.load_state_dict(ckpt['model_state'])
+			# Averaged weights, absent from checkpoints of runs without averaging
+			if self.averager is not None and ckpt.get('averaged_state'):
+				self.averager.load_state_dict(ckpt['averaged_state'])
 			# Load optimizer state
 			self.optimizer.load_state_dict(ckpt['optimizer_state'])
-			self.optimizer.step_num = ckpt['total_iters']
+			self.optimizer.step_num = ckpt.get('step_num', ckpt['total_iters'])
+			# Load loss scaler state if available; checkpoints without it (or from float32 runs) start with a fresh scale
+			if 'scaler_state' in ckpt and ckpt['scaler_state']:
+				self.scaler.load_state_dict(ckpt['scaler_state'])
 			# Load history
-			self.history = ckpt['history']
+			self.history = load_history(self.history, ckpt['history'])
 			self.total_iters = ckpt['total_iters']
 			self.cur_epoch = ckpt['cur_epoch']
+			# Mid-epoch state, absent from older checkpoints
+			self.epoch_step = ckpt.get('epoch_step', 0)
+			self.epoch_seed = ckpt.get('epoch_seed', None)
+			# Training time of the time budget, absent from older checkpoints
+			if ckpt.get('stopping_state'):
+				self.stopping.load_state_dict(ckpt['stopping_state'])
+			self.rng_state = ckpt.get('rng_state', None) if self.epoch_step>0 else None
+			self.metrics.values = ckpt.get('epoch_metrics', {})
 			if self.cuda_mode:
 				self.model = self.model.to(self.device)
 			if self.model.ndiscriminators > 1 and self.model.r_proj_size > 0:
@@ -0,0 +1,81 @@
+import torch
+import torch.distributed as dist
+
+def get_world_size():
+	return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+def get_rank():
+	return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+class GatherLayer(torch.autograd.Function):
+	"""
+	all_gather that keeps gradients: every rank receives the gradient of its own loss w.r.t. the gathered tensor,
+	so backward sums it over ranks and returns the slice of this rank's input.
+	"""
+
+	@staticmethod
+	def forward(ctx, x):
+		out = [torch.zeros_like(x) for i in range(dist.get_world_size())]
+		dist.all_gather(out, x.contiguous())
+		return tuple(out)
+
+	@staticmethod
+	def backward(ctx, *grads):
+		grad = torch.stack(grads, 0)
+		dist.all_reduce(grad)
+		return grad[dist.get_rank()]
+
+def gather_views(x, n_views=5, grad=False):
+	# Batches are laid out view-major (n_views blocks of the same examples). Rank blocks are interleaved inside
+	# each view, so the global batch keeps that layout: row i belongs to rank (i//local_size)%world_size
+	if grad:
+		chunks = GatherLayer.apply(x)
+	else:
+		chunks = [torch.zeros_like(x) for i in range(dist.get_world_size())]
+		dist.all_gather(chunks, x.contiguous())
+
+	x = torch.stack(chunks, 0)
+	x = x.view(x.size(0), n_views, -1, *x.size()[2:]).transpose(0, 1)
+
+	return x.reshape(-1, *x.size()[3:])
+
+def broadcast_model(model):
+	# Replicas start from rank 0's weights and buffers
+	for tensor in list(model.parameters())+list(model.buffers()):
+		dist.broadcast(tensor.data, 0)
+
+def average_gradients(model, flag=None):
+	# One flat all-reduce per step. Parameters without gradient contribute zeros so every rank reduces the same buffer.
+	# A flag (e.g. a preemption request) rides along as one extra element: returns whether it is set on any rank, as a
+	# device tensor so the host is not synchronized here
+	params = [param for param in model.parameters() if param.requires_grad]
+	grads = [(param.grad if param.grad is not None else torch.zeros_like(param)).view(-1) for param in params]
+	if flag is not None:
+		grads.append(torch.full((1,), float(flag), dtype=grads[0].dtype, device=grads[0].device))
+	flat = torch.cat(grads, 0)
+	dist.all_reduce(flat)
+	flag = flat[-1]>0 if flag is not None else None
+	flat /= dist.get_world_size()
+
+	offset = 0
+	for param in params:
+		param.grad = flat[offset:offset+param.numel()].view_as(param)
+		offset += param.numel()
+
+	return flag
+
+def all_reduce_mean(tensor):
+	tensor = tensor.clone()
+	dist.all_reduce(tensor)
+	return tensor/dist.get_world_size()
+
+def broadcast_seed(device=None):
+	seed = torch.randint(2**31-1, (1,), dtype=torch.long, device=device)
+	dist.broadcast(seed, 0)
+	return seed.item()
+
+def broadcast_flag(flag, device=None):
+	# Decision of rank 0, e.g. to stop training, applied on every rank
+	flag = torch.tensor([int(flag)], dtype=torch.long, device=device)
+	dist.broadcast(flag, 0)
+	return bool(flag.item())
@@ -0,0 +1,158 @@
+import os
+import sys
+import copy
+import glob
+import json
+import time
+import traceback
+import subprocess
+import numpy as np
+import torch
+import torch.nn.functional as F
+from utils.utils import compute_eer
+from utils.checkpointer import AsyncCheckpointer
+
+def fuse_scores(e2e_scores, cos_scores):
+	return (e2e_scores + 0.5*(cos_scores+1.))*0.5
+
+def evaluate_trials(model, loader, device=None, pair_chunk_size=0, mixed_precision=False):
+	# Each validation utterance is embedded once, then the fixed trial list of the dataset is scored. Returns e2e
+	# and cosine scores, trial labels, embeddings and speaker labels
+
+	device_type = torch.device(device).type if device is not None else 'cpu'
+	amp_dtype = torch.float16 if device_type=='cuda' else torch.bfloat16
+
+	model.eval()
+
+	dataset = loader.dataset
+	embeddings, y_ = None, np.empty(len(dataset), dtype=np.int64)
+
+	with torch.no_grad():
+		for utterances, y, idx in loader:
+			if device is not None:
+				utterances = utterances.to(device)
+			with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=mixed_precision):
+				out, emb_batch = model.forward(utterances)
+			if embeddings is None:
+				embeddings = torch.empty(len(dataset), emb_batch.size(1), device=emb_batch.device)
+			embeddings[idx.to(emb_batch.device)] = emb_batch.float()
+			y_[idx.numpy()] = y.view(-1).numpy()
+
+	enroll, test, labels = dataset.trials
+	enroll, test = torch.from_numpy(enroll).to(embeddings.device), torch.from_numpy(test).to(embeddings.device)
+	e2e_scores, cos_scores = np.empty(len(labels), dtype=np.float32), np.empty(len(labels), dtype=np.float32)
+	chunk_size = pair_chunk_size if pair_chunk_size>0 else len(labels)
+
+	with torch.no_grad():
+		for i in range(0, len(labels), chunk_size):
+			idx_1, idx_2 = enroll[i:i+chunk_size], test[i:i+chunk_size]
+			with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=mixed_precision):
+				e2e_scores_chunk = model.forward_bin_pairs(embeddings, idx_1, idx_2)
+			if model.ndiscriminators>1:
+				e2e_scores_chunk = torch.cat(e2e_scores_chunk, 1).mean(1)
+			e2e_scores[i:i+chunk_size] = e2e_scores_chunk.float().view(-1).cpu().numpy()
+			cos_scores[i:i+chunk_size] = F.cosine_similarity(embeddings[idx_1], embeddings[idx_2]).cpu().numpy()
+
+	return e2e_scores, cos_scores, labels, embeddings.cpu().numpy(), y_
+
+def trial_eers(e2e_scores, cos_scores, labels):
+	return {'e2e_eer': float(compute_eer(labels, e2e_scores)), 'cos_eer': float(compute_eer(labels, cos_scores)), 'fus_eer': float(compute_eer(labels, fuse_scores(e2e_scores, cos_scores)))}
+
+def write_json(report, path):
+	tmp_path = os.path.join(os.path.dirname(path), '.{}.tmp'.format(os.path.basename(path)))
+	with open(tmp_path, 'w') as f:
+		json.dump(report, f)
+	os.replace(tmp_path, path)
+
+def run_evaluator(directory, device='cpu', poll_interval=1.0, once=False):
+	# Scores the snapshots of directory oldest first, writes their report and deletes them. Loops until killed, or
+	# returns once no snapshot is left with once=True
+	validator = OutOfBandValidator(directory, poll_interval=poll_interval)
+	setup = torch.load(validator.setup_path, map_location='cpu', weights_only=False)
+	model = setup['model'].to(device)
+	loader = torch.utils.data.DataLoader(setup['dataset'], batch_size=setup['batch_size'], shuffle=False, num_workers=setup['num_workers'])
+
+	while True:
+		snapshots = sorted(glob.glob(validator.snapshot_fmt.format('*')), key=os.path.getmtime)
+		if not snapshots:
+			if once:
+				break
+			time.sleep(poll_interval)
+			continue
+
+		snapshot = torch.load(snapshots[0], map_location='cpu')
+		start = time.time()
+		try:
+			model.load_state_dict(snapshot['model_state'])
+			e2e_scores, cos_scores, labels, _, _ = evaluate_trials(model, loader, device, setup['pair_chunk_size'], setup['mixed_precision'])
+			report = trial_eers(e2e_scores, cos_scores, labels)
+		except Exception:
+			report = {'error': traceback.format_exc()}
+		report.update({'epoch': snapshot['epoch'], 'total_iters': snapshot['total_iters'], 'valid_time': time.time()-start})
+		write_json(report, validator.report_fmt.format(snapshot['epoch']))
+		os.remove(snapshots[0])
+
+class OutOfBandValidator(object):
+	"""
+	Validation outside of the training loop. At the end of an epoch the TrainLoop only writes a snapshot of the model
+	weights (from a background thread) and carries on, while an evaluator process (valid_worker.py) loads each
+	snapshot on its own device (CPU or another GPU), scores the validation trials and writes a JSON report with the
+	EERs next to the checkpoints. The model and validation data are written once to valid_setup.pt, so the evaluator
+	needs nothing but the directory and can also run on another host sharing it. Snapshots and reports are files: a
+	run resumed after preemption picks up the snapshots not validated yet.
+	"""
+
+	def __init__(self, directory, poll_interval=1.0):
+		self.directory = directory
+		self.setup_path = os.path.join(directory, 'valid_setup.pt')
+		self.snapshot_fmt = os.path.join(directory, 'valid_snapshot_{}ep.pt')
+		self.report_fmt = os.path.join(directory, 'valid_report_{}ep.json')
+		self.poll_interval = poll_interval
+		self.writer = None
+		self.process = None
+
+	def start(self, model, loader, device='cpu', pair_chunk_size=0, mixed_precision=False, launch=True):
+		# With launch=False the evaluator is started separately: python valid_worker.py --checkpoint-path directory
+		self.writer = AsyncCheckpointer()
+		setup = {'model': copy.deepcopy(model).cpu(), 'dataset': loader.dataset, 'batch_size': loader.batch_size, 'num_workers': loader.num_workers, 'pair_chunk_size': pair_chunk_size, 'mixed_precision': mixed_precision}
+		torch.save(setup, self.setup_path)
+		if launch:
+			script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'valid_worker.py')
+			self.process = subprocess.Popen([sys.executable, script, '--checkpoint-path', self.directory, '--device', str(device), '--poll-interval', str(self.poll_interval)])
+
+	def submit(self, model, epoch, total_iters):
+		self.writer.save({'model_state': model.state_dict(), 'epoch': epoch, 'total_iters': total_iters}, self.snapshot_fmt.format(epoch))
+
+	def lost(self, epoch):
+		# Neither reported nor waiting to be validated, e.g. after a crash while its snapshot was being written
+		return not os.path.isfile(self.report_fmt.format(epoch)) and not os.path.isfile(self.snapshot_fmt.format(epoch))
+
+	def report(self, epoch, wait=False):
+		# Report of the given epoch, None if not available yet. With wait=True, blocks until it is
+		path = self.report_fmt.format(epoch)
+		while wait and not os.path.isfile(path):
+			self.check_alive()
+			time.sleep(self.poll_interval)
+		if not os.path.isfile(path):
+			return None
+		with open(path, 'r') as f:
+			report = json.load(f)
+		if 'error' in report:
+			raise RuntimeError('Out-of-band validation of epoch {} failed:\n{}'.format(epoch, report['error']))
+		return report
+
+	def check_alive(self):
+		if self.writer is not None:
+			self.writer.check_error()
+		if self.process is not None and self.process.poll() is not None:
+			raise RuntimeError('Evaluator process exited with code {}'.format(self.process.returncode))
+
+	def close(self):
+		# Snapshots not validated yet stay on disk for the next run
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+		if self.process is not None:
+			self.process.terminate()
+			self.process.wait()
+			self.process = None
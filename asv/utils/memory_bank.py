@@ -0,0 +1,100 @@
+import torch
+
+class MemoryBank(object):
+	"""
+	FIFO queue of the detached embeddings and labels of recent training batches, used as extra negatives for the
+	discriminator: current-batch anchors are paired with bank entries of other classes, so the number of negatives is
+	no longer tied to the batch size. Entries older than max_age steps are ignored (0: no limit), since they were
+	computed by an older encoder. Storage is allocated on the first push, on the device of the embeddings. The bank
+	is not checkpointed and refills within size/batch_size steps after a restart.
+	"""
+
+	def __init__(self, size, max_age=0):
+		self.size = size
+		self.max_age = max_age
+		self.embeddings = None
+		self.labels = None
+		self.steps = None
+		self.ptr = 0
+
+	def push(self, embeddings, labels, step):
+		embeddings, labels = embeddings.detach()[-self.size:], labels.detach().view(-1)[-self.size:]
+
+		if self.embeddings is None:
+			self.embeddings = embeddings.new_zeros(self.size, embeddings.size(1))
+			# Label -1 marks empty slots
+			self.labels = labels.new_full((self.size,), -1)
+			self.steps = torch.zeros(self.size, dtype=torch.long, device=labels.device)
+
+		positions = (self.ptr + torch.arange(embeddings.size(0), device=labels.device)) % self.size
+		self.embeddings[positions] = embeddings.to(self.embeddings.dtype)
+		self.labels[positions] = labels
+		self.steps[positions] = step
+		self.ptr = (self.ptr + embeddings.size(0)) % self.size
+
+	def negatives(self, labels, step, n_negatives=0):
+		# Bank indices of the negatives of each anchor, [N x k] with a [N x k] mask of the valid ones. k is n_negatives
+		# (sampled uniformly among the valid ones), or the bank size to take all of them with n_negatives=0
+		labels = labels.view(-1)
+		if self.embeddings is None:
+			empty = torch.zeros(labels.size(0), 0, dtype=torch.long, device=labels.device)
+			return empty, empty.bool()
+
+		valid = self.labels >= 0
+		if self.max_age>0:
+			valid = valid & (step-self.steps <= self.max_age)
+		mask = valid.unsqueeze(0) & (labels.view(-1, 1) != self.labels.view(1, -1))
+
+		if n_negatives>0 and n_negatives<self.size:
+			scores = torch.rand(mask.size(), device=mask.device).masked_fill(~mask, -1.0)
+			scores, bank_idx = scores.topk(n_negatives, dim=1)
+			return bank_idx, scores >= 0.0
+
+		return torch.arange(self.size, device=mask.device).expand_as(mask), mask
+
+	def negative_pairs(self, labels, step, n_negatives=0):
+		# Flat (anchor index, bank index) pairs
+		bank_idx, mask = self.negatives(labels, step, n_negatives)
+		anchors = torch.arange(bank_idx.size(0), device=bank_idx.device).view(-1, 1).expand_as(bank_idx)
+		return anchors[mask], bank_idx[mask]
+
+	def extend_triplets(self, triplets, labels, step, n_negatives=0, offset=0):
+		# Triplets (a, p, offset+n) for every unique anchor-positive pair of triplets and every bank negative n of a
+		bank_idx, mask = self.negatives(labels, step, n_negatives)
+		ap_pairs = torch.unique(triplets[:, :2], dim=0)
+		bank_idx, mask = bank_idx[ap_pairs[:, 0]], mask[ap_pairs[:, 0]]
+		bank_triplets = torch.stack([ap_pairs[:, :1].expand_as(bank_idx)[mask], ap_pairs[:, 1:].expand_as(bank_idx)[mask], offset+bank_idx[mask]], 1)
+		return torch.cat([triplets, bank_triplets], 0)
+
+if __name__ == '__main__':
+
+	bank = MemoryBank(size=10, max_age=2)
+	labels = torch.LongTensor([0, 0, 1, 1])
+
+	bank_idx, mask = bank.negatives(labels, 0)
+	assert mask.sum() == 0
+
+	bank.push(torch.randn(4, 8), torch.LongTensor([0, 1, 2, 3]), step=0)
+	bank.push(torch.randn(4, 8), torch.LongTensor([4, 5, 6, 7]), step=1)
+	bank.push(torch.randn(4, 8), torch.LongTensor([0, 1, 8, 9]), step=2)
+	# Wrapped around: the first two entries of the first batch were overwritten
+	assert bank.labels.tolist() == [8, 9, 2, 3, 4, 5, 6, 7, 0, 1] and bank.ptr == 2
+
+	anchors, bank_idx = bank.negative_pairs(labels, step=2)
+	assert (bank.labels[bank_idx] != labels[anchors]).all()
+	# 9 other-class entries for each anchor of class 0 or 1
+	assert anchors.size(0) == 4*9
+
+	# Entries of step 0 are too old at step 3
+	anchors, bank_idx = bank.negative_pairs(labels, step=3)
+	assert (bank.steps[bank_idx] >= 1).all() and anchors.size(0) == 4*7
+
+	bank_idx, mask = bank.negatives(labels, step=2, n_negatives=3)
+	assert bank_idx.size() == (4, 3) and mask.all()
+	assert (bank.labels[bank_idx] != labels.view(-1, 1)).all()
+
+	triplets = torch.LongTensor([[0, 1, 2], [0, 1, 3], [2, 3, 0], [2, 3, 1]])
+	extended = bank.extend_triplets(triplets, labels, step=2, n_negatives=3, offset=4)
+	assert extended.size(0) == 4+2*3 and (extended[4:, 2] >= 4).all()
+
+	print('OK')
@@ -0,0 +1,143 @@
+import time
+import threading
+import queue
+import numpy as np
+import torch
+
+class MetricsLogger(object):
+	"""
+	Training metrics with few host-device syncs. Per-step values are kept as device tensors and copied to the host
+	in a single transfer every sync_every steps. Events are written to the SummaryWriter (if any) by a background
+	thread. Heavy artifacts (histograms, PR curves, embeddings) are written once every artifact_every calls per tag,
+	with at most max_points rows.
+
+	Time spent on the calling thread is accumulated in self.overhead.
+	"""
+
+	def __init__(self, writer=None, sync_every=50, artifact_every=1, max_points=20000):
+		self.writer = writer
+		self.sync_every = sync_every
+		self.artifact_every = artifact_every
+		self.max_points = max_points
+		self.pending = []
+		self.values = {}
+		self.artifact_calls = {}
+		self.overhead = 0.0
+
+		if self.writer is not None:
+			self.queue = queue.Queue()
+			self.thread = threading.Thread(target=self.worker, daemon=True)
+			self.thread.start()
+
+	def add_scalars(self, step, **scalars):
+		start = time.time()
+		self.pending.append((step, scalars))
+		self.overhead += time.time()-start
+		if len(self.pending) >= self.sync_every:
+			self.sync()
+
+	def sync(self):
+		start = time.time()
+
+		# All pending tensors go to the host in one copy. Python numbers are passed through
+		tensors = [value.detach().float().reshape(()) for step, scalars in self.pending for value in scalars.values() if torch.is_tensor(value)]
+		host_values = iter(torch.stack(tensors).cpu().tolist() if tensors else [])
+
+		for step, scalars in self.pending:
+			for tag, value in scalars.items():
+				value = next(host_values) if torch.is_tensor(value) else float(value)
+				self.values.setdefault(tag, []).append(value)
+				if self.writer is not None:
+					self.queue.put(('add_scalar', (tag, value, step), {}))
+
+		self.pending = []
+		self.overhead += time.time()-start
+
+	def collect(self, tag):
+		# Host values of tag added since the last call
+		self.sync()
+		return self.values.pop(tag, [])
+
+	def clear(self):
+		self.sync()
+		self.values = {}
+
+	def add_artifact(self, method, tag, step, **kwargs):
+		# method is the SummaryWriter method name, e.g. 'add_histogram'. Array arguments sharing the first dimension
+		# are subsampled with the same indices
+		if self.writer is None:
+			return
+
+		start = time.time()
+		self.artifact_calls[tag] = self.artifact_calls.get(tag, 0)+1
+
+		if (self.artifact_calls[tag]-1) % self.artifact_every == 0:
+			n_rows = max([len(value) for value in kwargs.values() if isinstance(value, (np.ndarray, list))] + [0])
+			if n_rows > self.max_points:
+				idxs = np.sort(np.random.choice(n_rows, size=self.max_points, replace=False))
+				kwargs = {key: (np.asarray(value)[idxs] if isinstance(value, np.ndarray) else [value[i] for i in idxs]) if isinstance(value, (np.ndarray, list)) and len(value)==n_rows else value for key, value in kwargs.items()}
+			self.queue.put((method, (), dict(kwargs, tag=tag, global_step=step)))
+
+		self.overhead += time.time()-start
+
+	def worker(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				self.queue.task_done()
+				break
+			method, args, kwargs = item
+			try:
+				getattr(self.writer, method)(*args, **kwargs)
+			except Exception as err:
+				print('Logging {} failed: {}'.format(kwargs['tag'] if 'tag' in kwargs else args[0], err))
+			finally:
+				self.queue.task_done()
+
+	def flush(self):
+		self.sync()
+		if self.writer is not None:
+			self.queue.join()
+			self.writer.flush()
+
+	def pop_overhead(self):
+		overhead, self.overhead = self.overhead, 0.0
+		return overhead
+
+if __name__ == '__main__':
+
+	class Writer(object):
+		def __init__(self):
+			self.events = []
+		def add_scalar(self, tag, value, step):
+			self.events.append((tag, value, step))
+		def add_histogram(self, tag, values, global_step):
+			self.events.append((tag, len(values), global_step))
+		def flush(self):
+			pass
+
+	writer = Writer()
+	metrics = MetricsLogger(writer, sync_every=10, artifact_every=2, max_points=100)
+	model = torch.nn.Linear(256, 256)
+	x = torch.randn(512, 256)
+
+	step_time, losses = 0.0, []
+	for step in range(200):
+		start = time.time()
+		loss = model(x).pow(2).mean()
+		loss.backward()
+		losses.append(loss.item())
+		step_time += time.time()-start
+		metrics.add_scalars(step, **{'Train/Loss': loss.detach(), 'Info/LR': 0.1})
+
+	for epoch in range(3):
+		metrics.add_artifact('add_histogram', 'Valid/Scores', epoch, values=np.random.rand(1000))
+
+	metrics.flush()
+
+	assert np.allclose(metrics.collect('Train/Loss'), losses)
+	assert len([event for event in writer.events if event[0]=='Train/Loss']) == 200
+	assert [event for event in writer.events if event[0]=='Valid/Scores'] == [('Valid/Scores', 100, 0), ('Valid/Scores', 100, 2)]
+
+	print('Logging overhead: {:.2f}% of step time'.format(100.*metrics.pop_overhead()/step_time))
+	print('OK')
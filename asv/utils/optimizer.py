@@ -24,6 +24,11 @@ class TransformerOptimizer(object):
 		for param_group in self.optimizer.param_groups:
 			param_group['lr'] = lr
 
+	@property
+	def param_groups(self):
+		# Exposed so that the wrapper can be passed to torch.cuda.amp.GradScaler
+		return self.optimizer.param_groups
+
 	def load_state_dict(self, state_dict):
 		self.optimizer.load_state_dict(state_dict)
 
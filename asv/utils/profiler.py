@@ -0,0 +1,151 @@
+import time
+import resource
+import contextlib
+import torch
+
+class Phase(object):
+
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+
+	def __enter__(self):
+		self.profiler.synchronize()
+		self.start = time.perf_counter()
+
+	def __exit__(self, *exc):
+		self.profiler.synchronize()
+		self.profiler.current[self.name] = self.profiler.current.get(self.name, 0.0) + time.perf_counter()-self.start
+
+class StepProfiler(object):
+	"""
+	Wall-clock time of the phases of training steps, delimited with `with profiler.phase(name):`. The device is
+	synchronized around each phase so that asynchronous CUDA work is charged to the phase that launched it, which
+	slows training down: profiling is opt-in, and phase() is a no-op otherwise. Time between the end of a step and
+	the start of the next one is reported as 'data' (waiting for the DataLoader). Counts (e.g. triplets) are added
+	with count(). Per-step values go to the MetricsLogger, if any, under Profile/ and are averaged per epoch by
+	summary(), together with the peak memory.
+
+	trace_steps=(start, end) additionally records a torch.profiler trace of the steps in [start, end) to trace_dir,
+	readable with TensorBoard.
+	"""
+
+	def __init__(self, enabled=False, device=None, metrics=None, trace_steps=None, trace_dir='./profile'):
+		self.enabled = enabled or trace_steps is not None
+		self.device = device if device is not None and torch.device(device).type=='cuda' else None
+		self.metrics = metrics
+		self.current = {}
+		self.totals = {}
+		self.n_steps = 0
+		self.last_end = None
+		self.null = contextlib.nullcontext()
+
+		self.trace = None
+		if trace_steps is not None:
+			start, end = trace_steps
+			self.trace = torch.profiler.profile(schedule=torch.profiler.schedule(wait=max(start-1, 0), warmup=min(start, 1), active=end-start, repeat=1), on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir), record_shapes=True, profile_memory=True)
+			self.trace.__enter__()
+
+	def synchronize(self):
+		if self.device is not None:
+			torch.cuda.synchronize(self.device)
+
+	def phase(self, name):
+		return Phase(self, name) if self.enabled else self.null
+
+	def count(self, name, value):
+		if self.enabled:
+			self.current[name] = self.current.get(name, 0.0) + float(value)
+
+	def begin_epoch(self):
+		self.last_end = time.perf_counter()
+
+	def begin_step(self):
+		if self.enabled and self.last_end is not None:
+			self.current['data'] = time.perf_counter()-self.last_end
+
+	def end_step(self, step):
+		if not self.enabled:
+			return
+
+		self.current['peak_memory_mb'] = self.peak_memory()
+
+		if self.metrics is not None:
+			self.metrics.add_scalars(step, **{'Profile/'+name: value for name, value in self.current.items()})
+
+		for name, value in self.current.items():
+			self.totals[name] = self.totals.get(name, 0.0)+value
+		self.n_steps += 1
+		self.current = {}
+
+		if self.trace is not None:
+			self.trace.step()
+
+		self.last_end = time.perf_counter()
+
+	def peak_memory(self):
+		# Allocated device memory on GPU (peak since the previous step), peak resident set size of the process on CPU
+		if self.device is not None:
+			peak = torch.cuda.max_memory_allocated(self.device)/2**20
+			torch.cuda.reset_peak_memory_stats(self.device)
+			return peak
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+	def summary(self):
+		# Table of the per-step means since the previous call
+		if not self.enabled or self.n_steps==0:
+			return ''
+
+		means = {name: total/self.n_steps for name, total in self.totals.items()}
+		times = {name: mean for name, mean in means.items() if name not in ['peak_memory_mb'] and not name.startswith('n_')}
+		step_time = sum(times.values())
+
+		lines = ['{:<16}{:>12}{:>8}'.format('Phase', 'ms/step', '%')]
+		for name in sorted(times, key=times.get, reverse=True):
+			lines.append('{:<16}{:>12.2f}{:>8.1f}'.format(name, 1e3*times[name], 100.*times[name]/max(step_time, 1e-12)))
+		lines.append('{:<16}{:>12.2f}'.format('total', 1e3*step_time))
+		for name in sorted(means):
+			if name not in times:
+				lines.append('{:<16}{:>12.1f}'.format(name, means[name]))
+
+		self.totals, self.n_steps = {}, 0
+
+		return '\n'.join(lines)
+
+	def close(self):
+		if self.trace is not None:
+			self.trace.__exit__(None, None, None)
+			self.trace = None
+
+if __name__ == '__main__':
+
+	profiler = StepProfiler(enabled=True)
+	model = torch.nn.Sequential(torch.nn.Linear(512, 512), torch.nn.ReLU(), torch.nn.Linear(512, 512))
+	optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+
+	profiler.begin_epoch()
+	for step in range(20):
+		time.sleep(0.002)
+		profiler.begin_step()
+		with profiler.phase('forward'):
+			loss = model(torch.randn(256, 512)).pow(2).mean()
+		with profiler.phase('backward'):
+			loss.backward()
+		with profiler.phase('step'):
+			optimizer.step()
+			optimizer.zero_grad()
+		profiler.count('n_triplets', 100)
+		profiler.end_step(step)
+
+	table = profiler.summary()
+	print(table)
+	assert 'data' in table and 'forward' in table and 'n_triplets' in table
+
+	# Disabled: no timing, no synchronization
+	profiler = StepProfiler()
+	with profiler.phase('forward'):
+		pass
+	profiler.end_step(0)
+	assert profiler.summary() == ''
+
+	print('OK')
@@ -0,0 +1,161 @@
+import math
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+class ResumableSampler(Sampler):
+	"""
+	Shuffled sampler whose order only depends on (seed, epoch), so an interrupted epoch can be replayed from any
+	position: set_start(n) skips the first n indices of this rank without loading them, until set_start is called again.
+	With num_replicas>1 the permutation is padded and sharded as torch.utils.data.distributed.DistributedSampler.
+	"""
+
+	def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0):
+		if num_replicas is None:
+			num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+		if rank is None:
+			rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+		self.dataset = dataset
+		self.num_replicas = num_replicas
+		self.rank = rank
+		self.shuffle = shuffle
+		self.seed = seed
+		self.epoch = 0
+		self.start = 0
+
+	def __iter__(self):
+		if self.shuffle:
+			g = torch.Generator()
+			g.manual_seed(self.seed + self.epoch)
+			indices = torch.randperm(len(self.dataset), generator=g).tolist()
+		else:
+			indices = list(range(len(self.dataset)))
+
+		total_size = self.num_samples*self.num_replicas
+		indices += indices[:(total_size-len(indices))]
+		indices = indices[self.rank:total_size:self.num_replicas]
+
+		return iter(indices[self.start:])
+
+	def __len__(self):
+		return self.num_samples - self.start
+
+	@property
+	def num_samples(self):
+		# The dataset length changes between epochs (Loader.update_lists)
+		return int(math.ceil(len(self.dataset)/self.num_replicas))
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+
+	def set_start(self, start):
+		self.start = start
+
+class BucketBatchSampler(Sampler):
+	"""
+	Batches of examples of similar length. Each epoch, a (seed, epoch) permutation of the examples is split into pools
+	of pool_size batches, each pool is sorted by example length (dataset.lengths, shortest utterance of each example)
+	and cut into batches, and the order of the batches is shuffled. Items are (index, n_frames) pairs, n_frames being
+	the shortest length in the batch (at most max_frames): the dataset crops every utterance of the batch to it, so
+	no frames need to be tiled. Batches are sharded over replicas and can be skipped with set_start as in
+	ResumableSampler, counting batches instead of examples.
+	"""
+
+	def __init__(self, dataset, batch_size, max_frames, num_replicas=None, rank=None, pool_size=100, seed=0):
+		if num_replicas is None:
+			num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+		if rank is None:
+			rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+		self.dataset = dataset
+		self.batch_size = batch_size
+		self.max_frames = max_frames
+		self.num_replicas = num_replicas
+		self.rank = rank
+		self.pool_size = pool_size
+		self.seed = seed
+		self.epoch = 0
+		self.start = 0
+		self.batches = []
+
+	def __iter__(self):
+		g = torch.Generator()
+		g.manual_seed(self.seed + self.epoch)
+
+		lengths = np.asarray(self.dataset.lengths)
+		perm = torch.randperm(len(lengths), generator=g).numpy()
+		pool = self.batch_size*self.pool_size
+
+		batches = []
+		for i in range(0, len(perm), pool):
+			idxs = perm[i:i+pool]
+			idxs = idxs[np.argsort(lengths[idxs], kind='stable')]
+			for j in range(0, len(idxs), self.batch_size):
+				batch = idxs[j:j+self.batch_size]
+				batches.append((batch.tolist(), int(min(lengths[batch].min(), self.max_frames))))
+
+		batches = [batches[k] for k in torch.randperm(len(batches), generator=g).tolist()]
+
+		total_size = int(math.ceil(len(batches)/self.num_replicas))*self.num_replicas
+		batches += batches[:(total_size-len(batches))]
+		# Kept for reporting (Loader.tiled_fraction)
+		self.batches = batches[self.rank:total_size:self.num_replicas][self.start:]
+
+		for batch, n_frames in self.batches:
+			yield [(idx, n_frames) for idx in batch]
+
+	def __len__(self):
+		n_examples, pool = len(self.dataset), self.batch_size*self.pool_size
+		n_batches = (n_examples//pool)*self.pool_size + int(math.ceil((n_examples%pool)/self.batch_size))
+		return int(math.ceil(n_batches/self.num_replicas)) - self.start
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+
+	def set_start(self, start):
+		self.start = start
+
+if __name__ == '__main__':
+
+	dataset = list(range(103))
+
+	for num_replicas in [1, 3]:
+		for rank in range(num_replicas):
+			sampler = ResumableSampler(dataset, num_replicas=num_replicas, rank=rank, seed=1)
+			sampler.set_epoch(2)
+			full = list(sampler)
+			sampler.set_start(40)
+			assert len(sampler) == len(full)-40
+			assert list(sampler) == full[40:]
+			sampler.set_start(0)
+			assert list(sampler) == full
+
+	shards = []
+	for rank in range(3):
+		sampler = ResumableSampler(dataset, num_replicas=3, rank=rank, seed=1)
+		shards += list(sampler)
+	assert set(shards) == set(dataset) and len(shards) == 105
+
+	class Lengths(object):
+		def __init__(self, lengths):
+			self.lengths = lengths
+		def __len__(self):
+			return len(self.lengths)
+
+	lengths = Lengths(np.random.RandomState(0).randint(100, 1000, size=1003))
+	for num_replicas in [1, 3]:
+		for rank in range(num_replicas):
+			sampler = BucketBatchSampler(lengths, batch_size=8, max_frames=800, num_replicas=num_replicas, rank=rank, pool_size=10, seed=1)
+			batches = list(sampler)
+			assert len(batches) == len(sampler)
+			assert all([n_frames <= min(800, lengths.lengths[idx]) for batch in batches for idx, n_frames in batch])
+			sampler.set_start(5)
+			assert list(sampler) == batches[5:] and len(sampler) == len(batches)-5
+
+	sampler = BucketBatchSampler(lengths, batch_size=8, max_frames=800, pool_size=10, seed=1)
+	idxs = [idx for batch in sampler for idx, n_frames in batch]
+	assert sorted(idxs) == list(range(1003))
+	used = np.mean([np.mean([n_frames/lengths.lengths[idx] for idx, n_frames in batch]) for batch in sampler])
+	print('Mean fraction of frames used per example: {:.3f}'.format(used))
+
+	print('OK')
@@ -0,0 +1,92 @@
+import time
+import numpy as np
+
+class EarlyStopping(object):
+	"""
+	Stopping criteria checked by the TrainLoops. Early stopping: none of the monitored history entries (lower is
+	better) improved on its best value by more than min_delta over the last patience epochs. Budgets: max_time
+	seconds of training, or max_steps iterations in total. Training time is counted since this object was created,
+	plus that of the run it was resumed from (see state_dict). Criteria set to 0 are inactive. The best epoch reported
+	is the one with the lowest value of the first monitored entry.
+	"""
+
+	def __init__(self, patience=0, min_delta=0.0, max_time=0, max_steps=0):
+		self.patience = patience
+		self.min_delta = min_delta
+		self.max_time = max_time
+		self.max_steps = max_steps
+		self.start_time = time.time()
+
+	def state_dict(self):
+		# Saved with the checkpoints, so that the time budget of a resumed run includes the time already trained
+		return {'elapsed': time.time()-self.start_time}
+
+	def load_state_dict(self, state):
+		self.start_time = time.time()-state['elapsed']
+
+	def last_improvement(self, history, metrics):
+		# Last epoch (1-based) in which one of the metrics improved on its previous best by more than min_delta, which
+		# patience counts from
+		last_epoch = 0
+		for metric in metrics:
+			best = np.inf
+			for epoch, value in enumerate(history[metric], 1):
+				if value < best-self.min_delta:
+					best, last_epoch = value, max(last_epoch, epoch)
+		return last_epoch
+
+	def best_epoch(self, history, metrics):
+		# Epoch (1-based) with the lowest value of the primary metric, metrics[0]; 0 before the first one
+		values = np.asarray(history[metrics[0]], dtype=float)
+		if values.size==0 or np.isnan(values).all():
+			return 0
+		return int(np.nanargmin(values))+1
+
+	def budget_reason(self, total_iters):
+		# Cheap enough to be checked after every step
+		if self.max_steps>0 and total_iters>=self.max_steps:
+			return 'step budget of {} iterations'.format(self.max_steps)
+		if self.max_time>0 and time.time()-self.start_time>=self.max_time:
+			return 'time budget of {:.0f}s'.format(self.max_time)
+		return None
+
+	def stop_reason(self, history, metrics, total_iters):
+		# Checked at the end of each epoch
+		n_epochs = len(history[metrics[0]])
+		if self.patience>0 and n_epochs-self.last_improvement(history, metrics)>=self.patience:
+			return 'no improvement of {} larger than {} in {} epochs'.format('/'.join(metrics), self.min_delta, self.patience)
+		return self.budget_reason(total_iters)
+
+if __name__ == '__main__':
+
+	stopping = EarlyStopping(patience=3, min_delta=0.01)
+	history = {'e2e_eer': [], 'cos_eer': []}
+	e2e_eer = [0.30, 0.20, 0.15, 0.145, 0.142, 0.16, 0.15]
+	cos_eer = [0.35, 0.25, 0.20, 0.18, 0.185, 0.178, 0.19]
+
+	reasons = []
+	for e2e, cos in zip(e2e_eer, cos_eer):
+		history['e2e_eer'].append(e2e)
+		history['cos_eer'].append(cos)
+		reasons.append(stopping.stop_reason(history, ['e2e_eer', 'cos_eer'], 0))
+
+	# The last improvement larger than 0.01 is cos_eer at epoch 4, so training stops after epoch 7. The lowest e2e_eer
+	# is that of epoch 5
+	assert stopping.last_improvement(history, ['e2e_eer', 'cos_eer']) == 4
+	assert stopping.best_epoch(history, ['e2e_eer', 'cos_eer']) == 5
+	assert stopping.best_epoch({'train_loss': []}, ['train_loss']) == 0
+	assert reasons[:6] == [None]*6 and reasons[6] is not None
+	print(reasons[6])
+
+	assert EarlyStopping(max_steps=100).budget_reason(100) is not None
+	assert EarlyStopping(max_steps=100).budget_reason(99) is None
+	assert EarlyStopping(max_time=1e-9).budget_reason(0) is not None
+
+	# Resumed runs count the elapsed time of the checkpoint
+	resumed = EarlyStopping(max_time=3600)
+	resumed.load_state_dict({'elapsed': 10})
+	assert resumed.budget_reason(0) is None and resumed.state_dict()['elapsed']>=10
+	resumed.load_state_dict({'elapsed': 3600})
+	assert resumed.budget_reason(0) is not None
+
+	print('OK')
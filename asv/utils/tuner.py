@@ -0,0 +1,179 @@
+import gc
+import os
+import json
+import time
+import resource
+import torch
+
+def is_oom(err):
+	return isinstance(err, torch.cuda.OutOfMemoryError) or 'out of memory' in str(err) or "can't allocate memory" in str(err)
+
+def synchronize(device):
+	if device is not None and torch.device(device).type=='cuda':
+		torch.cuda.synchronize(device)
+
+def reset_peak_memory(device):
+	if device is not None and torch.device(device).type=='cuda':
+		torch.cuda.reset_peak_memory_stats(device)
+
+def peak_memory(device):
+	# Allocated device memory on GPU, peak resident set size of the process on CPU (never decreases, so probes run
+	# in increasing order of batch size), in MB
+	if device is not None and torch.device(device).type=='cuda':
+		return torch.cuda.max_memory_allocated(device)/2**20
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+def total_memory(device):
+	if device is not None and torch.device(device).type=='cuda':
+		return torch.cuda.get_device_properties(device).total_memory/2**20
+	return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/2**20
+
+def probe(train_step, loader, n_steps=20, warmup=3, device=None):
+	# Runs warmup+n_steps training steps on batches of loader and measures the last n_steps: samples (rows of the
+	# labels, the last element of a batch) per second, fraction of the time spent waiting for the loader, and peak
+	# memory. Warmup steps absorb worker startup and cudnn autotuning
+	reset_peak_memory(device)
+	iterator = iter(loader)
+	data_time, step_time, n_samples = 0.0, 0.0, 0
+
+	for i in range(warmup+n_steps):
+		start = time.perf_counter()
+		try:
+			batch = next(iterator)
+		except StopIteration:
+			iterator = iter(loader)
+			batch = next(iterator)
+		fetched = time.perf_counter()
+		train_step(batch)
+		synchronize(device)
+		if i>=warmup:
+			data_time += fetched-start
+			step_time += time.perf_counter()-start
+			n_samples += len(batch[-1])
+
+	# Shuts the workers down
+	del iterator
+
+	return {'samples_per_sec': n_samples/step_time, 'data_fraction': data_time/step_time, 'step_time': step_time/n_steps, 'peak_memory_mb': peak_memory(device)}
+
+def tune(train_step, make_loader, batch_sizes, workers, prefetch_factors=(2,), n_steps=20, warmup=3, device=None, memory_fraction=0.9, tolerance=0.05, max_data_fraction=0.02, verbose=True):
+	"""
+	Short probes of train_step with the loaders returned by make_loader(batch_size, workers, prefetch_factor), to pick
+	the settings of a training run on this host. Batch sizes are probed in increasing order with the most workers,
+	until one runs out of memory or peaks above memory_fraction of the device memory: memory is superlinear in the
+	batch size with all-triplets losses, so the largest batch probed under that limit is the recommended one. Worker
+	counts are then probed in increasing order at that batch size, and the smallest one within tolerance of the best
+	throughput (i.e. saturating compute) is recommended, with its smallest prefetch factor. Increasing the workers
+	stops once the loader waits less than max_data_fraction of the time.
+
+	make_loader gets prefetch_factor=None with no workers, and should not pass it to the DataLoader then: torch<2.0
+	rejects it, even as None.
+
+	Probes train the model: the trainer should not be used for training afterwards.
+	"""
+
+	def run(batch_size, n_workers, prefetch_factor):
+		prefetch_factor = prefetch_factor if n_workers>0 else None
+		loader = make_loader(batch_size, n_workers, prefetch_factor)
+		try:
+			result = probe(train_step, loader, n_steps=n_steps, warmup=warmup, device=device)
+		except RuntimeError as err:
+			if not is_oom(err):
+				raise
+			result = {'oom': True}
+		finally:
+			del loader
+			gc.collect()
+			if device is not None and torch.device(device).type=='cuda':
+				torch.cuda.empty_cache()
+
+		result.update({'batch_size': batch_size, 'workers': n_workers, 'prefetch_factor': prefetch_factor})
+		if verbose:
+			if result.get('oom'):
+				print('Batch size {}, {} workers, prefetch {}: out of memory'.format(batch_size, n_workers, result['prefetch_factor']))
+			else:
+				print('Batch size {}, {} workers, prefetch {}: {:.1f} samples/s, {:.1%} waiting for data, {:.0f}MB peak memory'.format(batch_size, n_workers, result['prefetch_factor'], result['samples_per_sec'], result['data_fraction'], result['peak_memory_mb']))
+		return result
+
+	memory_limit = memory_fraction*total_memory(device)
+	batch_results = []
+
+	for batch_size in sorted(batch_sizes):
+		result = run(batch_size, max(workers), prefetch_factors[0])
+		batch_results.append(result)
+		if result.get('oom') or result['peak_memory_mb']>memory_limit:
+			break
+
+	safe = [result for result in batch_results if not result.get('oom') and result['peak_memory_mb']<=memory_limit]
+	if not safe:
+		raise RuntimeError('No batch size in {} fits in {:.0f}MB'.format(sorted(batch_sizes), memory_limit))
+	batch_size = safe[-1]['batch_size']
+
+	worker_results = []
+	for n_workers in sorted(workers):
+		results = [run(batch_size, n_workers, prefetch_factor) for prefetch_factor in (sorted(prefetch_factors) if n_workers>0 else [None])]
+		worker_results += results
+		fractions = [result['data_fraction'] for result in results if not result.get('oom')]
+		if fractions and min(fractions)<max_data_fraction:
+			break
+
+	worker_results = [result for result in worker_results if not result.get('oom')]
+	if not worker_results:
+		raise RuntimeError('Batch size {} ran out of memory with every worker count'.format(batch_size))
+	best = max(result['samples_per_sec'] for result in worker_results)
+	recommended = min([result for result in worker_results if result['samples_per_sec']>=(1.0-tolerance)*best], key=lambda result: (result['workers'], result['prefetch_factor'] or 0))
+
+	return recommended, batch_results+worker_results
+
+def write_config(recommended, results, path, workers_arg='workers'):
+	# Recommended values under the names of the train.py arguments, and every probe
+	config = {'batch_size': recommended['batch_size'], workers_arg: recommended['workers'], 'prefetch_factor': recommended['prefetch_factor'] or 2, 'probes': results}
+	with open(path, 'w') as f:
+		json.dump(config, f, indent=1)
+
+if __name__ == '__main__':
+
+	import tempfile
+
+	model = torch.nn.Sequential(torch.nn.Linear(16, 32), torch.nn.ReLU(), torch.nn.Linear(32, 4))
+	optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+	dataset = torch.utils.data.TensorDataset(torch.randn(2048, 16), torch.randint(0, 4, (2048,)))
+
+	def train_step(batch):
+		x, y = batch
+		if x.size(0)>=256:
+			raise RuntimeError('CUDA out of memory. Tried to allocate 2.00 GiB')
+		optimizer.zero_grad()
+		loss = torch.nn.functional.cross_entropy(model(x), y)
+		loss.backward()
+		optimizer.step()
+		return loss.item()
+
+	def make_loader(batch_size, workers, prefetch_factor):
+		loader_kwargs = {'num_workers': workers}
+		if workers>0:
+			loader_kwargs['prefetch_factor'] = prefetch_factor
+		return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, **loader_kwargs)
+
+	result = probe(train_step, make_loader(32, 0, None), n_steps=5, warmup=1)
+	assert result['samples_per_sec']>0 and 0.0<=result['data_fraction']<=1.0 and result['peak_memory_mb']>0
+
+	# Out of memory at 256: 128 is the largest batch size
+	recommended, results = tune(train_step, make_loader, [32, 64, 128, 256, 512], [0, 1], prefetch_factors=[2], n_steps=5, warmup=1, verbose=False)
+	assert recommended['batch_size'] == 128
+	assert [result['batch_size'] for result in results[:4]] == [32, 64, 128, 256] and results[3]['oom']
+	assert recommended['workers'] in [0, 1]
+
+	try:
+		tune(train_step, make_loader, [256, 512], [0], n_steps=5, warmup=1, verbose=False)
+		assert False
+	except RuntimeError as err:
+		assert 'No batch size' in str(err)
+
+	with tempfile.TemporaryDirectory() as path:
+		write_config(recommended, results, os.path.join(path, 'tuned.json'), workers_arg='n_workers')
+		with open(os.path.join(path, 'tuned.json'), 'r') as f:
+			config = json.load(f)
+		assert config['batch_size'] == 128 and 'n_workers' in config and len(config['probes']) == len(results)
+
+	print('OK')
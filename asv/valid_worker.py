@@ -0,0 +1,17 @@
+import argparse
+from utils.evaluator import run_evaluator
+
+# Evaluator process of out-of-band validation (train.py --async-valid): scores the weight snapshots written to
+# --checkpoint-path and writes a report per epoch. Started by the TrainLoop, or by hand (e.g. on another host sharing
+# the checkpoint directory) with --async-valid-device none
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Out-of-band validation of training snapshots')
+	parser.add_argument('--checkpoint-path', type=str, default=None, metavar='Path', help='Checkpoint directory of the training run')
+	parser.add_argument('--device', type=str, default='cpu', metavar='DEVICE', help='Device to validate on, e.g. cpu or cuda:1 (default: cpu)')
+	parser.add_argument('--poll-interval', type=float, default=1.0, metavar='S', help='Seconds between checks for new snapshots (default: 1.0)')
+	parser.add_argument('--once', action='store_true', default=False, help='Exits once every snapshot present is validated')
+	args = parser.parse_args()
+
+	run_evaluator(args.checkpoint_path, device=args.device, poll_interval=args.poll_interval, once=args.once)
@@ -1,14 +1,47 @@
 "Implementation from https://raw.githubusercontent.com/adambielski/siamese-triplet/master/utils.py"
 
+from collections import OrderedDict
 from itertools import combinations
 
 import numpy as np
 import torch
 
 
-def pdist(vectors):
-	#distance_matrix = -2 * vectors.mm(torch.t(vectors)) + vectors.pow(2).sum(dim=1).view(1, -1) + vectors.pow(2).sum(dim=1).view(-1, 1)
-	return torch.norm(vectors[:, None] - vectors, dim=2, p=2)
+def pdist(vectors, chunk_size=None, eps=1e-12):
+	"""
+	Euclidean distance matrix from the Gram matrix: ||x||^2 - 2<x, y> + ||y||^2.
+	Only NxN values (chunk_size x N at a time if chunk_size is given) are materialized instead of NxNxD.
+	Squared distances are clamped at zero to absorb cancellation errors, and the sqrt is masked below eps
+	so that gradients stay finite for coincident points (e.g. the diagonal).
+	"""
+	sq_norms = vectors.pow(2).sum(dim=1)
+	chunk_size = vectors.size(0) if chunk_size is None else max(int(chunk_size), 1)
+
+	distance_matrix = []
+	for i in range(0, vectors.size(0), chunk_size):
+		sq_dist = sq_norms[i:i+chunk_size].view(-1, 1) - 2 * vectors[i:i+chunk_size].mm(torch.t(vectors)) + sq_norms.view(1, -1)
+		rows = torch.arange(sq_dist.size(0), device=vectors.device)
+		diagonal = torch.zeros_like(sq_dist, dtype=torch.bool)
+		diagonal[rows, rows+i] = True
+		sq_dist = torch.clamp(sq_dist.masked_fill(diagonal, 0.0), min=0.0)
+		nonzero = sq_dist > eps
+		distance_matrix.append(torch.where(nonzero, torch.clamp(sq_dist, min=eps).sqrt(), torch.zeros_like(sq_dist)))
+
+	return torch.cat(distance_matrix, 0) if len(distance_matrix)>0 else vectors.new_zeros(0, 0)
+
+def cos_sim(vectors, chunk_size=None, eps=1e-8):
+	"""
+	Cosine similarity matrix from the Gram matrix of the L2-normalized vectors, clamped to [-1, 1].
+	Chunked over rows as in pdist.
+	"""
+	vectors = vectors / torch.clamp(vectors.norm(p=2, dim=1, keepdim=True), min=eps)
+	chunk_size = vectors.size(0) if chunk_size is None else max(int(chunk_size), 1)
+
+	similarity_matrix = []
+	for i in range(0, vectors.size(0), chunk_size):
+		similarity_matrix.append(torch.clamp(vectors[i:i+chunk_size].mm(torch.t(vectors)), -1.0, 1.0))
+
+	return torch.cat(similarity_matrix, 0) if len(similarity_matrix)>0 else vectors.new_zeros(0, 0)
 
 class PairSelector:
 	"""
@@ -23,6 +56,16 @@ class PairSelector:
 	def get_pairs(self, embeddings, labels):
 		raise NotImplementedError
 
+def upper_triangular_pairs(labels):
+	"""
+	All pairs (i, j), i < j, split by label agreement, on the device of labels.
+	return positive_pairs, negative_pairs
+	"""
+	all_pairs = torch.triu_indices(labels.size(0), labels.size(0), offset=1, device=labels.device).t()
+	same_label = labels[all_pairs[:, 0]] == labels[all_pairs[:, 1]]
+
+	return all_pairs[same_label], all_pairs[~same_label]
+
 class AllPositivePairSelector(PairSelector):
 	"""
 	Discards embeddings and generates all possible pairs given labels.
@@ -33,13 +76,11 @@ class AllPositivePairSelector(PairSelector):
 		self.balance = balance
 
 	def get_pairs(self, embeddings, labels):
-		labels = labels.cpu().data.numpy()
-		all_pairs = np.array(list(combinations(range(len(labels)), 2)))
-		all_pairs = torch.LongTensor(all_pairs)
-		positive_pairs = all_pairs[(labels[all_pairs[:, 0]] == labels[all_pairs[:, 1]]).nonzero()]
-		negative_pairs = all_pairs[(labels[all_pairs[:, 0]] != labels[all_pairs[:, 1]]).nonzero()]
+		if embeddings is not None:
+			labels = labels.to(embeddings.device)
+		positive_pairs, negative_pairs = upper_triangular_pairs(labels)
 		if self.balance:
-			negative_pairs = negative_pairs[torch.randperm(len(negative_pairs))[:len(positive_pairs)]]
+			negative_pairs = negative_pairs[torch.randperm(len(negative_pairs), device=negative_pairs.device)[:len(positive_pairs)]]
 
 		return positive_pairs, negative_pairs
 
@@ -49,25 +90,21 @@ class HardNegativePairSelector(PairSelector):
 	matching the number of positive pairs.
 	"""
 
-	def __init__(self, cpu=True):
+	def __init__(self, cpu=False, chunk_size=None):
 		super(HardNegativePairSelector, self).__init__()
 		self.cpu = cpu
+		self.chunk_size = chunk_size
 
 	def get_pairs(self, embeddings, labels):
 		if self.cpu:
 			embeddings = embeddings.cpu()
-		distance_matrix = pdist(embeddings)
+		distance_matrix = pdist(embeddings, chunk_size=self.chunk_size)
 
-		labels = labels.cpu().data.numpy()
-		all_pairs = np.array(list(combinations(range(len(labels)), 2)))
-		all_pairs = torch.LongTensor(all_pairs)
-		positive_pairs = all_pairs[(labels[all_pairs[:, 0]] == labels[all_pairs[:, 1]]).nonzero()]
-		negative_pairs = all_pairs[(labels[all_pairs[:, 0]] != labels[all_pairs[:, 1]]).nonzero()]
+		positive_pairs, negative_pairs = upper_triangular_pairs(labels.to(embeddings.device))
 
 		negative_distances = distance_matrix[negative_pairs[:, 0], negative_pairs[:, 1]]
-		negative_distances = negative_distances.cpu().data.numpy()
-		top_negatives = np.argpartition(negative_distances, len(positive_pairs))[:len(positive_pairs)]
-		top_negative_pairs = negative_pairs[torch.LongTensor(top_negatives)]
+		top_negatives = torch.topk(negative_distances, min(len(positive_pairs), len(negative_pairs)), largest=False, sorted=False)[1]
+		top_negative_pairs = negative_pairs[top_negatives]
 
 		return positive_pairs, top_negative_pairs
 
@@ -113,6 +150,84 @@ class AllTripletSelector(TripletSelector):
 		return torch.LongTensor(np.array(triplets))
 
 
+def triplets_to_pairs(triplets):
+	"""
+	Unique anchor-positive and anchor-negative pairs in a [N_triplets x 3] index tensor, along with
+	the number of triplets each pair appears in.
+	return ap_pairs, ap_counts, an_pairs, an_counts
+	"""
+	ap_pairs, ap_counts = torch.unique(triplets[:, :2], dim=0, return_counts=True)
+	an_pairs, an_counts = torch.unique(triplets[:, [0, 2]], dim=0, return_counts=True)
+
+	return ap_pairs, ap_counts, an_pairs, an_counts
+
+
+def sample_pairs(counts, n_samples):
+	"""
+	Uniformly samples n_samples out of the pairs with multiplicities counts, without replacement. Weights are the
+	multiplicities scaled by the inverse inclusion probability, so weighted sums over the sample are unbiased
+	estimates of the weighted sums over all pairs.
+	"""
+	if n_samples <= 0:
+		return torch.empty(0, dtype=torch.long, device=counts.device), counts.new_empty(0, dtype=torch.float)
+
+	if n_samples >= counts.size(0):
+		return torch.arange(counts.size(0), device=counts.device), counts.float()
+
+	sample_idx = torch.randperm(counts.size(0), device=counts.device)[:n_samples]
+
+	return sample_idx, counts[sample_idx].float()*(float(counts.size(0))/n_samples)
+
+
+class TripletTemplateCache(object):
+	"""
+	All-triplets pairs for batches laid out as n_views consecutive copies of a base label vector, i.e. labels = cat(n_views*[y]).
+	Pairs and multiplicities (see triplets_to_pairs) only depend on which entries of y are equal, so they are computed once
+	per equality pattern, kept on the device and reused. Batches with any other layout fall back to AllTripletSelector.
+	"""
+
+	def __init__(self, n_views=5, max_templates=64):
+		self.n_views = n_views
+		self.max_templates = max_templates
+		self.templates = OrderedDict()
+		self.selector = AllTripletSelector()
+
+	def layout_key(self, labels):
+		labels = labels.cpu().data.numpy()
+
+		if len(labels) % self.n_views != 0:
+			return None
+
+		views = labels.reshape(self.n_views, -1)
+
+		if not (views == views[:1]).all():
+			return None
+
+		# Relabel the base vector by order of first occurrence so that only its equality pattern remains
+		_, first_idx, inverse = np.unique(views[0], return_index=True, return_inverse=True)
+		rank = np.empty(len(first_idx), dtype=np.int64)
+		rank[np.argsort(first_idx)] = np.arange(len(first_idx))
+
+		return (self.n_views, tuple(rank[inverse].tolist()))
+
+	def get_pairs(self, labels, device=None):
+		key = self.layout_key(labels)
+
+		if key is None:
+			triplets = self.selector.get_triplets(None, labels)
+			return tuple(x.to(device) for x in triplets_to_pairs(triplets.to(device)))
+
+		if key not in self.templates:
+			template_labels = torch.LongTensor(self.n_views*list(key[1]))
+			self.templates[key] = tuple(x.to(device) for x in triplets_to_pairs(self.selector.get_triplets(None, template_labels).to(device)))
+			if len(self.templates) > self.max_templates:
+				self.templates.popitem(last=False)
+		else:
+			self.templates.move_to_end(key)
+
+		return self.templates[key]
+
+
 def hardest_negative(loss_values):
 	hard_negative = np.argmax(loss_values)
 	return hard_negative if loss_values[hard_negative] > 0 else None
@@ -136,16 +251,17 @@ class FunctionNegativeTripletSelector(TripletSelector):
 	and return a negative index for that pair
 	"""
 
-	def __init__(self, margin, negative_selection_fn, cpu=True):
+	def __init__(self, margin, negative_selection_fn, cpu=True, chunk_size=None):
 		super(FunctionNegativeTripletSelector, self).__init__()
 		self.cpu = cpu
 		self.margin = margin
 		self.negative_selection_fn = negative_selection_fn
+		self.chunk_size = chunk_size
 
 	def get_triplets(self, embeddings, labels):
 		if self.cpu:
 			embeddings = embeddings.cpu()
-		distance_matrix = pdist(embeddings)
+		distance_matrix = pdist(embeddings, chunk_size=self.chunk_size)
 		distance_matrix = distance_matrix.cpu()
 
 		entropy_indices = torch.min(distance_matrix+1e4*torch.eye(labels.size(0)), dim=1)[1]
@@ -180,14 +296,49 @@ class FunctionNegativeTripletSelector(TripletSelector):
 		return torch.LongTensor(triplets), entropy_indices
 
 
-def HardestNegativeTripletSelector(margin, cpu=False):
-	return FunctionNegativeTripletSelector(margin=margin, negative_selection_fn=hardest_negative, cpu=cpu)
+def HardestNegativeTripletSelector(margin, cpu=False, chunk_size=None):
+	return FunctionNegativeTripletSelector(margin=margin, negative_selection_fn=hardest_negative, cpu=cpu, chunk_size=chunk_size)
+
+
+def RandomNegativeTripletSelector(margin, cpu=False, chunk_size=None):
+	return FunctionNegativeTripletSelector(margin=margin, negative_selection_fn=random_hard_negative, cpu=cpu, chunk_size=chunk_size)
+
+
+def SemihardNegativeTripletSelector(margin, cpu=False, chunk_size=None):
+	return FunctionNegativeTripletSelector(margin=margin, negative_selection_fn=lambda x: semihard_negative(x, margin), cpu=cpu, chunk_size=chunk_size)
+
+
+if __name__ == '__main__':
+
+	# Parity check of the Gram-matrix based distances against a float64 reference
+	torch.manual_seed(1)
+
+	for n, d, chunk_size in [(1, 512, None), (37, 512, None), (300, 512, 64), (300, 16, 7)]:
+		x = torch.randn(n, d)
+
+		ref_dist = torch.norm(x.double()[:, None] - x.double(), dim=2, p=2)
+		ref_sim = torch.nn.functional.cosine_similarity(x.double()[:, None], x.double()[None, :], dim=2)
+
+		dist = pdist(x, chunk_size=chunk_size)
+		sim = cos_sim(x, chunk_size=chunk_size)
 
+		print('N={}, D={}, chunk={}: max dist err {:.2e}, max cos err {:.2e}'.format(n, d, chunk_size, (dist.double()-ref_dist).abs().max().item(), (sim.double()-ref_sim).abs().max().item()))
 
-def RandomNegativeTripletSelector(margin, cpu=False):
-	return FunctionNegativeTripletSelector(margin=margin, negative_selection_fn=random_hard_negative, cpu=cpu)
+		assert torch.allclose(dist.double(), ref_dist, atol=1e-3, rtol=1e-4)
+		assert torch.allclose(sim.double(), ref_sim, atol=1e-5)
+		assert torch.allclose(pdist(x.double(), chunk_size=chunk_size), ref_dist, atol=1e-6)
+		assert torch.allclose(cos_sim(x.double(), chunk_size=chunk_size), ref_sim, atol=1e-10)
+		assert dist.min().item() >= 0.0
 
+		x[n//2] = x[0] # coincident points should not produce inf/nan gradients
+		x.requires_grad_(True)
+		pdist(x, chunk_size=chunk_size).sum().backward()
+		assert torch.isfinite(x.grad).all()
 
-def SemihardNegativeTripletSelector(margin, cpu=False):
-	return FunctionNegativeTripletSelector(margin=margin, negative_selection_fn=lambda x: semihard_negative(x, margin), cpu=cpu)
+	# Budgets smaller than a stratum, including none at all (--pair-budget 1)
+	counts = torch.LongTensor([3, 1, 2, 4])
+	for n_samples in [0, 2, 4]:
+		sample_idx, weights = sample_pairs(counts, n_samples)
+		assert sample_idx.size(0) == weights.size(0) == n_samples
 
+	print('OK')
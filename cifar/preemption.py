@@ -0,0 +1,70 @@
+import os
+import glob
+import signal
+import threading
+
+# Exit status of a preempted run: SGE reschedules jobs exiting with 99, and slurm batch scripts can requeue on it
+# (scontrol requeue $SLURM_JOB_ID)
+PREEMPTED_EXIT_CODE = 99
+
+class PreemptionHandler(object):
+	"""
+	Records termination signals instead of dying, so the TrainLoop can finish the current step, write a resumable
+	checkpoint and exit with PREEMPTED_EXIT_CODE. slurm sends SIGTERM on preemption and, with --signal=USR1@<seconds>,
+	SIGUSR1 ahead of the time limit; SGE sends SIGUSR1 ahead of SIGKILL with -notify. DataLoader workers are forked
+	after install() and inherit the handler, so they keep serving batches until the main process exits.
+	"""
+
+	def __init__(self, signals=(signal.SIGTERM, signal.SIGUSR1)):
+		self.signals = signals
+		self.received = None
+		self.previous = {}
+
+	def install(self):
+		# Handlers can only be set from the main thread
+		if threading.current_thread() is not threading.main_thread():
+			return
+		for signum in self.signals:
+			self.previous[signum] = signal.signal(signum, self.handler)
+
+	def handler(self, signum, frame):
+		self.received = signum
+
+	@property
+	def requested(self):
+		return self.received is not None
+
+	def restore(self):
+		for signum, previous in self.previous.items():
+			signal.signal(signum, previous)
+		self.previous = {}
+
+def latest_checkpoint(patterns):
+	# Most recently written file matching any of the glob patterns, None if there is none. Files being written by
+	# AsyncCheckpointer are hidden (.name.tmp) and never match
+	files = set([path for pattern in patterns for path in glob.glob(pattern)])
+	return max(files, key=os.path.getmtime) if files else None
+
+if __name__ == '__main__':
+
+	import tempfile
+	import time
+
+	handler = PreemptionHandler()
+	handler.install()
+	assert not handler.requested
+	os.kill(os.getpid(), signal.SIGUSR1)
+	time.sleep(0.1)
+	assert handler.requested and handler.received == signal.SIGUSR1
+	handler.restore()
+	assert signal.getsignal(signal.SIGUSR1) == signal.SIG_DFL
+
+	with tempfile.TemporaryDirectory() as path:
+		assert latest_checkpoint([os.path.join(path, 'checkpoint_*ep.pt')]) is None
+		for name in ['checkpoint_1ep.pt', 'checkpoint_250it.pt', 'checkpoint_2ep.pt', '.checkpoint_3ep.pt.tmp']:
+			open(os.path.join(path, name), 'w').close()
+			time.sleep(0.01)
+		latest = latest_checkpoint([os.path.join(path, 'checkpoint_{}ep.pt'.format('*')), os.path.join(path, 'checkpoint_{}it.pt'.format('*'))])
+		assert os.path.basename(latest) == 'checkpoint_2ep.pt'
+
+	print('OK')
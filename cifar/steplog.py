@@ -0,0 +1,193 @@
+import os
+import numpy as np
+
+class StepLog(object):
+	"""
+	Per-step values of a metric (e.g. the loss of every batch) in a growable float32 array, in place of a list of
+	Python floats. With a path, values are also appended to that file (raw float32) as they come in, and the
+	checkpoint state only holds the segments of the file holding the values (path, byte offset, count), the number of
+	values and a summary of at most max_points bin means, so checkpoints keep the same size and save time over
+	training. The file is only ever appended to: every checkpoint referencing it stays loadable, whichever one a run
+	resumes from. Without a path the array itself is checkpointed.
+	"""
+
+	def __init__(self, path=None, max_points=1000, capacity=1024):
+		self.path = path
+		self.max_points = max_points
+		self.data = np.empty(capacity, dtype=np.float32)
+		self.length = 0
+		self.file = None
+		# Segments of earlier runs holding the first values, and the values appended by this one from offset on
+		self.segments = []
+		self.offset = 0
+		self.n_written = 0
+
+	def append(self, value):
+		self.extend([value])
+
+	def extend(self, values):
+		values = np.asarray(values, dtype=np.float32).reshape(-1)
+		if self.length+values.size>self.data.size:
+			# Capacity doubled: appends are amortized O(1)
+			data = np.empty(max(2*self.data.size, self.length+values.size), dtype=np.float32)
+			data[:self.length] = self.data[:self.length]
+			self.data = data
+		self.data[self.length:self.length+values.size] = values
+		self.length += values.size
+
+		if self.path is not None:
+			if self.file is None:
+				# Appended after anything left by earlier runs, which their checkpoints may still reference
+				self.file = open(self.path, 'ab')
+				self.offset = self.file.seek(0, os.SEEK_END)
+			self.file.write(values.tobytes())
+			self.n_written += values.size
+
+	def close(self):
+		# Values appended afterwards go to a new segment at the end of the file
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+		if self.n_written>0:
+			self.segments.append([self.path, self.offset, self.n_written])
+			self.n_written = 0
+
+	def values(self):
+		return self.data[:self.length]
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, idx):
+		return self.values()[idx]
+
+	def __iter__(self):
+		return iter(self.values())
+
+	def summary(self):
+		# Means of at most max_points consecutive bins of steps, and the first step of each bin
+		n_bins = min(self.max_points, self.length)
+		if n_bins==0:
+			return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+		starts = (np.arange(n_bins)*self.length)//n_bins
+		counts = np.diff(np.append(starts, self.length))
+		return (np.add.reduceat(self.values(), starts)/counts).astype(np.float32), starts
+
+	def state_dict(self):
+		if self.path is None:
+			return {'values': self.values().copy()}
+		if self.file is not None:
+			self.file.flush()
+		segments = self.segments + ([[self.path, self.offset, self.n_written]] if self.n_written>0 else [])
+		means, steps = self.summary()
+		return {'segments': [list(segment) for segment in segments], 'length': self.length, 'summary': means, 'summary_steps': steps}
+
+	def load_state_dict(self, state):
+		# Also takes the lists of older checkpoints
+		if isinstance(state, (list, np.ndarray)):
+			state = {'values': state}
+
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+		self.length, self.segments, self.n_written = 0, [], 0
+
+		if 'values' in state:
+			# Written to the file (if any) as new values
+			self.extend(state['values'])
+			return
+
+		# Checkpoints written before segments held a whole file
+		segments = state['segments'] if 'segments' in state else [[state['path'], 0, state['length']]]
+		for path, offset, count in segments:
+			values = np.fromfile(path, dtype=np.float32, count=count, offset=offset) if os.path.isfile(path) else np.empty(0, dtype=np.float32)
+			if values.size<count:
+				# Log missing or cut short: only the summary is left for those steps
+				print('Step log {} has {} of {} values'.format(path, values.size, count))
+				values = np.append(values, np.full(count-values.size, np.nan, dtype=np.float32))
+			path_, self.path = self.path, None
+			self.extend(values)
+			self.path = path_
+		self.segments = [list(segment) for segment in segments]
+
+def history_state(history):
+	# History with the step logs replaced by their checkpoint state
+	return {key: value.state_dict() if isinstance(value, StepLog) else value for key, value in history.items()}
+
+def load_history(history, state):
+	# Loads a checkpointed history into history, keeping its step logs
+	for key, value in state.items():
+		if isinstance(history.get(key), StepLog):
+			history[key].load_state_dict(value)
+		else:
+			history[key] = value
+	return history
+
+def close_history(history):
+	# Closes the files of the step logs of history, when training ends or is preempted
+	for value in history.values():
+		if isinstance(value, StepLog):
+			value.close()
+
+if __name__ == '__main__':
+
+	import tempfile
+	import time
+	import pickle
+
+	log = StepLog(capacity=4)
+	for i in range(10):
+		log.append(i)
+	log.extend([10.0, 11.0])
+	assert len(log) == 12 and log[-1] == 11.0 and log.data.size == 16
+	assert list(log) == list(range(12))
+
+	with tempfile.TemporaryDirectory() as path:
+
+		# Checkpoint size stays constant with the values on disk
+		log = StepLog(path=os.path.join(path, 'steps_loss.f32'), max_points=100)
+		sizes = []
+		for n_steps in [10**4, 10**5]:
+			log.extend(np.random.rand(n_steps-len(log)))
+			start = time.time()
+			state = pickle.dumps({'history': history_state({'loss_batch': log, 'loss': [0.5]})})
+			sizes.append(len(state))
+			print('{} steps: {} bytes, {:.2f}ms'.format(n_steps, len(state), 1e3*(time.time()-start)))
+		# Up to the encoding of the step counts
+		assert abs(sizes[0]-sizes[1]) < 16
+
+		means, steps = log.summary()
+		assert means.size == 100 and abs(means.mean()-log.values().mean()) < 1e-3
+
+		# Resuming from an earlier checkpoint: values logged after it are appended again, and the checkpoints
+		# written after it still load
+		early = pickle.loads(state)['history']
+		log.extend(np.ones(5))
+		late = pickle.loads(pickle.dumps({'history': history_state({'loss_batch': log})}))['history']
+		log.close()
+		history = load_history({'loss_batch': StepLog(path=os.path.join(path, 'steps_loss.f32'))}, early)
+		assert len(history['loss_batch']) == 10**5 and history['loss'] == [0.5]
+		history['loss_batch'].extend(2*np.ones(3))
+		state = history['loss_batch'].state_dict()
+		close_history(history)
+		assert len(state['segments']) == 2 and state['segments'][1][1] == 4*(10**5+5)
+
+		for checkpoint, length, last in [(late, 10**5+5, 1.0), ({'loss_batch': state}, 10**5+3, 2.0)]:
+			resumed = load_history({'loss_batch': StepLog(path=os.path.join(path, 'steps_loss.f32'))}, checkpoint)
+			assert len(resumed['loss_batch']) == length and resumed['loss_batch'][-1] == last
+			assert not np.isnan(resumed['loss_batch'].values()).any()
+
+		# Closed logs keep appending, as a new segment
+		log = resumed['loss_batch']
+		log.extend([3.0])
+		log.close()
+		log.extend([4.0])
+		reloaded = load_history({'loss_batch': StepLog(path=os.path.join(path, 'steps_loss.f32'))}, history_state({'loss_batch': log}))
+		log.close()
+		assert log.file is None and len(reloaded['loss_batch']) == 10**5+5 and list(reloaded['loss_batch'][-3:]) == [2.0, 3.0, 4.0]
+
+		# Lists of older checkpoints
+		history = load_history({'loss_batch': StepLog()}, {'loss_batch': [0.1, 0.2]})
+		assert len(history['loss_batch']) == 2
+
+	print('OK')
@@ -3,6 +3,9 @@ import argparse
 import torch
 from torch.utils.data import DataLoader
 from train_loop import TrainLoop
+from preemption import PREEMPTED_EXIT_CODE
+from tuner import tune, write_config
+from sampler import ResumableSampler
 import torch.optim as optim
 from torchvision import datasets, transforms
 from models import vgg, resnet, densenet
@@ -52,7 +55,35 @@ parser.add_argument('--n-hidden', type=int, default=1, metavar='N', help='maximu
 parser.add_argument('--dropout-prob', type=float, default=0.25, metavar='p', help='Dropout probability (default: 0.25)')
 parser.add_argument('--save-every', type=int, default=1, metavar='N', help='how many epochs to wait before logging training status. Default is 1')
 parser.add_argument('--no-cuda', action='store_true', default=False, help='Disables GPU use')
+parser.add_argument('--mixed-precision', action='store_true', default=False, help='Enables mixed precision training: float16 with loss scaling on GPU, bfloat16 on CPU')
 parser.add_argument('--no-cp', action='store_true', default=False, help='Disables checkpointing')
+parser.add_argument('--keep-last', type=int, default=0, metavar='N', help='Number of most recent checkpoints kept on disk, older ones are deleted - active if greater than 0')
+parser.add_argument('--keep-best', type=int, default=0, metavar='N', help='Number of best checkpoints per validation EER kept in addition to --keep-last, or to the most recent checkpoint without --keep-last (default: 0)')
+parser.add_argument('--stop-patience', type=int, default=0, metavar='N', help='Stops once validation EERs (training loss without validation data) did not improve for N epochs - active if greater than 0')
+parser.add_argument('--stop-min-delta', type=float, default=0.0, metavar='D', help='Minimum decrease counted as an improvement for --stop-patience (default: 0.0)')
+parser.add_argument('--max-time', type=float, default=0.0, metavar='H', help='Stops after this many hours of training - active if greater than 0')
+parser.add_argument('--max-steps', type=int, default=0, metavar='N', help='Stops after N iterations in total - active if greater than 0')
+parser.add_argument('--profile', action='store_true', default=False, help='Times the phases of training steps (synchronizes the device, slower) and prints a summary per epoch')
+parser.add_argument('--profile-trace', type=int, nargs=2, default=None, metavar=('START', 'END'), help='Records a torch.profiler trace of iterations START to END-1 of this run')
+parser.add_argument('--profile-dir', type=str, default='./profile', metavar='Path', help='Path for torch.profiler traces')
+parser.add_argument('--bank-size', type=int, default=0, metavar='N', help='Size of the memory bank of recent embeddings used as extra negatives - active if greater than 0')
+parser.add_argument('--bank-max-age', type=int, default=0, metavar='N', help='Memory bank entries older than N iterations are not used - active if greater than 0')
+parser.add_argument('--bank-negatives', type=int, default=0, metavar='N', help='Number of memory bank negatives sampled per anchor (default: 0, all of them)')
+parser.add_argument('--no-auto-resume', action='store_true', default=False, help='Disables resuming from the newest checkpoint in --checkpoint-path, e.g. after preemption')
+parser.add_argument('--average', choices=['ema', 'swa'], default=None, help='Keeps an exponential moving average (ema) or an equal-weight average (swa) of the weights in memory')
+parser.add_argument('--average-decay', type=float, default=0.999, metavar='D', help='Decay of --average ema (default: 0.999)')
+parser.add_argument('--average-every', type=int, default=1, metavar='N', help='Averages the weights every N steps (default: 1)')
+parser.add_argument('--average-start', type=int, default=0, metavar='N', help='First step averaged (default: 0)')
+parser.add_argument('--average-bn-batches', type=int, default=0, metavar='N', help='Recomputes the BatchNorm statistics of the averaged weights over N training batches each epoch - active if greater than 0')
+parser.add_argument('--average-valid', action='store_true', default=False, help='Validates the averaged weights instead of the trained ones, so early stopping and best checkpoints follow them')
+parser.add_argument('--prefetch-factor', type=int, default=2, metavar='N', help='Batches loaded in advance by each data loading worker (default: 2)')
+parser.add_argument('--tune', action='store_true', default=False, help='Probes short runs of training steps over --tune-batch-sizes and --tune-workers, prints the largest batch size fitting in memory and the fewest workers saturating compute, and exits without training')
+parser.add_argument('--tune-batch-sizes', nargs='+', type=int, default=[16, 32, 64, 128, 256, 512], metavar='N', help='Batch sizes probed by --tune, the largest one fitting in memory is recommended')
+parser.add_argument('--tune-workers', nargs='+', type=int, default=[0, 2, 4, 8, 16], metavar='N', help='Numbers of data loading workers probed by --tune')
+parser.add_argument('--tune-prefetch-factors', nargs='+', type=int, default=[2, 4], metavar='N', help='Prefetch factors probed by --tune (default: 2 4)')
+parser.add_argument('--tune-steps', type=int, default=20, metavar='N', help='Training steps measured per --tune probe, after 3 warmup steps (default: 20)')
+parser.add_argument('--tune-memory-fraction', type=float, default=0.9, metavar='F', help='Fraction of the device memory a batch size may peak at to be recommended by --tune (default: 0.9)')
+parser.add_argument('--tune-output', type=str, default=None, metavar='Path', help='JSON file the settings recommended by --tune and every probe are written to')
 parser.add_argument('--verbose', type=int, default=1, metavar='N', help='Verbose is activated if > 0')
 args = parser.parse_args()
 args.cuda = True if not args.no_cuda and torch.cuda.is_available() else False
@@ -65,7 +96,17 @@ transform_test = transforms.Compose([transforms.ToTensor(), transforms.Normalize
 
 #trainset = Loader(args.data_path)
 trainset = datasets.CIFAR10(root='./data', train=True, download=True, transform=transform_train)
-train_loader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size, shuffle=True, num_workers=args.n_workers, worker_init_fn=set_np_randomseed)
+
+def make_train_loader(batch_size, workers, prefetch_factor):
+	# Also called by --tune with the candidate settings. The order is resumable, so a run resumed from a mid-epoch
+	# checkpoint continues from the next batch. prefetch_factor is only passed along with workers: torch<2.0 rejects it
+	# otherwise, even as None
+	loader_kwargs = {'num_workers': workers, 'worker_init_fn': set_np_randomseed}
+	if workers>0:
+		loader_kwargs['prefetch_factor'] = prefetch_factor
+	return torch.utils.data.DataLoader(trainset, batch_size=batch_size, sampler=ResumableSampler(trainset, num_replicas=1, rank=0, seed=args.seed), **loader_kwargs)
+
+train_loader = make_train_loader(args.batch_size, args.n_workers, args.prefetch_factor)
 
 #validset = Loader(args.valid_data_path)
 validset = datasets.CIFAR10(root='./data', train=False, download=True, transform=transform_test)
@@ -87,7 +128,7 @@ if args.cuda:
 
 optimizer = optim.SGD(model.parameters(), lr=args.lr, weight_decay=args.l2, momentum=args.momentum)
 
-trainer = TrainLoop(model, optimizer, train_loader, valid_loader, patience=args.patience, label_smoothing=args.smoothing, verbose=args.verbose, save_cp=(not args.no_cp), checkpoint_path=args.checkpoint_path, checkpoint_epoch=args.checkpoint_epoch, cuda=args.cuda)
+trainer = TrainLoop(model, optimizer, train_loader, valid_loader, patience=args.patience, label_smoothing=args.smoothing, verbose=args.verbose, save_cp=(not args.no_cp), checkpoint_path=args.checkpoint_path, checkpoint_epoch=args.checkpoint_epoch, cuda=args.cuda, mixed_precision=args.mixed_precision, keep_last=args.keep_last, keep_best=args.keep_best, stop_patience=args.stop_patience, stop_min_delta=args.stop_min_delta, max_time=args.max_time*3600, max_steps=args.max_steps, profile=args.profile, profile_trace=args.profile_trace, profile_dir=args.profile_dir, bank_size=args.bank_size, bank_max_age=args.bank_max_age, bank_negatives=args.bank_negatives, auto_resume=(not args.no_auto_resume), average=args.average, average_decay=args.average_decay, average_every=args.average_every, average_start=args.average_start, average_bn_batches=args.average_bn_batches, average_valid=args.average_valid)
 
 if args.verbose >0:
 	print('\nCuda Mode is: {}'.format(args.cuda))
@@ -100,5 +141,17 @@ if args.verbose >0:
 	print('Patience: {}'.format(args.patience))
 	print('Dropout rate: {}'.format(args.dropout_prob))
 	print('Softmax Mode is: {}'.format(args.softmax))
+	print('Mixed precision: {}'.format(args.mixed_precision))
+
+if args.tune:
+	recommended, results = tune(trainer.train_step, make_train_loader, args.tune_batch_sizes, args.tune_workers, prefetch_factors=args.tune_prefetch_factors, n_steps=args.tune_steps, device=trainer.device, memory_fraction=args.tune_memory_fraction)
+	print('\nRecommended: --batch-size {} --n-workers {} --prefetch-factor {}'.format(recommended['batch_size'], recommended['workers'], recommended['prefetch_factor'] or args.prefetch_factor))
+	if args.tune_output is not None:
+		write_config(recommended, results, args.tune_output, workers_arg='n_workers')
+	sys.exit(0)
 
 trainer.train(n_epochs=args.epochs, save_every=args.save_every)
+
+# Requeue-friendly exit status, the next run resumes from the newest checkpoint
+if trainer.preempted:
+	sys.exit(PREEMPTED_EXIT_CODE)
@@ -0,0 +1,132 @@
+import copy
+import contextlib
+import torch
+
+class WeightAverager(object):
+	"""
+	Average of the weights of a model kept in memory during training, in place of averaging saved checkpoints
+	offline: exponential moving average with the given decay (mode 'ema'), or equal weights for every update (mode
+	'swa'). update() is called after each optimizer step and averages every `every` steps from step `start` on, with
+	foreach ops over all parameters at once. Buffers are copied from the model, so the BatchNorm statistics of the
+	averaged weights should be recomputed with recalibrate_bn() before they are used.
+	"""
+
+	def __init__(self, model, mode='ema', decay=0.999, every=1, start=0):
+		if mode not in ['ema', 'swa']:
+			raise NotImplementedError
+		self.mode = mode
+		self.decay = decay
+		self.every = every
+		self.start = start
+		self.n_averaged = 0
+		self.model = copy.deepcopy(model)
+		self.model.requires_grad_(False)
+		self.params = list(self.model.parameters())
+
+	def update(self, model, step):
+		if step<self.start or (step-self.start) % self.every != 0:
+			return
+
+		if self.n_averaged==0:
+			weight = 1.0
+		elif self.mode=='ema':
+			weight = 1.0-self.decay
+		else:
+			weight = 1.0/(self.n_averaged+1)
+
+		with torch.no_grad():
+			torch._foreach_lerp_(self.params, [param.detach() for param in model.parameters()], weight)
+			for buffer, model_buffer in zip(self.model.buffers(), model.buffers()):
+				buffer.copy_(model_buffer)
+
+		self.n_averaged += 1
+
+	def recalibrate_bn(self, loader, n_batches, device=None):
+		# Running statistics of the BatchNorm layers recomputed for the averaged weights, as a plain average over
+		# n_batches training batches: tuples of input views followed by the labels, as yielded by the train loaders
+		bn_layers = [module for module in self.model.modules() if isinstance(module, torch.nn.modules.batchnorm._BatchNorm)]
+		if not bn_layers or n_batches<=0:
+			return
+
+		momenta = [layer.momentum for layer in bn_layers]
+		for layer in bn_layers:
+			layer.reset_running_stats()
+			layer.momentum = None
+
+		self.model.train()
+		with torch.no_grad():
+			for i, batch in enumerate(loader):
+				if i>=n_batches:
+					break
+				x = torch.cat(list(batch[:-1]), dim=0)
+				self.model(x.to(device) if device is not None else x)
+
+		for layer, momentum in zip(bn_layers, momenta):
+			layer.momentum = momentum
+		self.model.eval()
+
+	def state_dict(self):
+		return {'model_state': self.model.state_dict(), 'n_averaged': self.n_averaged}
+
+	def load_state_dict(self, state):
+		self.model.load_state_dict(state['model_state'])
+		self.n_averaged = state['n_averaged']
+
+@contextlib.contextmanager
+def swapped_model(owner, model):
+	# Temporarily replaces owner.model, e.g. to validate the averaged weights with the TrainLoop's own methods. No-op
+	# with model=None
+	if model is None:
+		yield
+		return
+	original, owner.model = owner.model, model
+	try:
+		yield
+	finally:
+		owner.model = original
+
+if __name__ == '__main__':
+
+	model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8), torch.nn.Linear(8, 2))
+	snapshots = []
+	averager = WeightAverager(model, mode='swa', every=2, start=2)
+
+	for step in range(1, 9):
+		with torch.no_grad():
+			for param in model.parameters():
+				param.add_(torch.randn_like(param))
+		averager.update(model, step)
+		if step>=2 and step % 2 == 0:
+			snapshots.append([param.clone() for param in model.parameters()])
+
+	assert averager.n_averaged == 4
+	for param, params in zip(averager.model.parameters(), zip(*snapshots)):
+		assert torch.allclose(param, torch.stack(params).mean(0), atol=1e-6)
+
+	ema = WeightAverager(model, mode='ema', decay=0.9)
+	target = [param.clone() for param in model.parameters()]
+	ema.update(model, 0)
+	with torch.no_grad():
+		for param in model.parameters():
+			param.add_(1.0)
+	ema.update(model, 1)
+	for param, param_0, param_1 in zip(ema.model.parameters(), target, model.parameters()):
+		assert torch.allclose(param, 0.9*param_0+0.1*param_1, atol=1e-6)
+
+	# Recalibrated statistics are the plain average of the batch statistics
+	batches = [(torch.randn(16, 4)+i, torch.zeros(16)) for i in range(3)]
+	averager.recalibrate_bn(batches, n_batches=3)
+	with torch.no_grad():
+		means = [averager.model[0](x).mean(0) for x, _ in batches]
+	assert torch.allclose(averager.model[1].running_mean, torch.stack(means).mean(0), atol=1e-5)
+	assert averager.model[1].momentum == 0.1 and not averager.model.training
+
+	class Owner(object):
+		pass
+	owner = Owner()
+	owner.model = model
+	with swapped_model(owner, averager.model):
+		assert owner.model is averager.model
+	assert owner.model is model
+
+	print('OK')
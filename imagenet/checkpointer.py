@@ -0,0 +1,173 @@
+import os
+import threading
+import queue
+import torch
+
+def to_cpu(state):
+	# Snapshot of a checkpoint: tensors are copied to CPU memory and containers rebuilt, so training can keep
+	# updating the model, optimizer and history while the snapshot is written
+	if torch.is_tensor(state):
+		return state.detach().to('cpu', copy=True)
+	elif isinstance(state, dict):
+		return type(state)((key, to_cpu(value)) for key, value in state.items())
+	elif isinstance(state, (list, tuple)):
+		return type(state)(to_cpu(value) for value in state)
+	else:
+		return state
+
+class AsyncCheckpointer(object):
+	"""
+	Writes checkpoints from a background thread. Each checkpoint goes to a temporary file in the target directory
+	and is renamed into place once complete, so a crash never leaves a truncated file under the final name.
+	At most max_pending snapshots wait in memory; save blocks beyond that.
+
+	Retention: the keep_last most recent checkpoints are kept, plus the keep_best ones with the lowest value of each
+	score (e.g. {'e2e_eer': 0.05, 'cos_eer': 0.06}). Older checkpoints written by this instance are deleted.
+	With keep_last<=0, only the keep_best ones and the most recent one (to resume from) are kept, and keep_last<=0
+	with keep_best<=0 keeps everything. Checkpoints saved with pending=True wait for their scores (e.g. from out-of-band
+	validation) and are not deleted until update() scores or discards them.
+	"""
+
+	def __init__(self, keep_last=0, keep_best=0, max_pending=1):
+		self.keep_last = keep_last
+		self.keep_best = keep_best
+		self.saved = []
+		self.pending = set()
+		self.error = None
+		self.queue = queue.Queue(maxsize=max_pending)
+		self.thread = threading.Thread(target=self.worker, daemon=True)
+		self.thread.start()
+
+	def save(self, state, path, scores=None, pending=False):
+		self.check_error()
+		self.queue.put((to_cpu(state), path, scores, pending))
+
+	def update(self, path, scores=None, keep=True):
+		# Scores a pending checkpoint once its results are known, or deletes it with keep=False. Applied in order
+		# after the queued saves
+		self.check_error()
+		self.queue.put((None, path, scores, not keep))
+
+	def worker(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				self.queue.task_done()
+				break
+			# flag: pending for saves, discard for updates (state None)
+			state, path, scores, flag = item
+			try:
+				if state is None:
+					self.pending.discard(path)
+					if flag:
+						self.remove(path)
+					else:
+						self.rescore(path, scores)
+					continue
+				tmp_path = os.path.join(os.path.dirname(path), '.{}.tmp'.format(os.path.basename(path)))
+				torch.save(state, tmp_path)
+				os.replace(tmp_path, path)
+				if flag:
+					self.pending.add(path)
+				self.apply_retention(path, scores)
+			except Exception as err:
+				self.error = err
+			finally:
+				self.queue.task_done()
+
+	def apply_retention(self, path, scores):
+		self.saved = [cp for cp in self.saved if cp[0]!=path] + [(path, scores)]
+		self.retain()
+
+	def rescore(self, path, scores):
+		# Scored after the fact: the checkpoint keeps its place among the most recent ones. Checkpoints of a previous
+		# run count as the oldest
+		if path in [cp[0] for cp in self.saved]:
+			self.saved = [(path, scores) if cp[0]==path else cp for cp in self.saved]
+		else:
+			self.saved.insert(0, (path, scores))
+		self.retain()
+
+	def retain(self):
+		if self.keep_last<=0 and self.keep_best<=0:
+			return
+
+		keep = set(cp[0] for cp in self.saved[-max(self.keep_last, 1):])
+
+		if self.keep_best>0:
+			for name in set(name for cp in self.saved if cp[1] for name in cp[1]):
+				ranked = sorted([cp for cp in self.saved if cp[1] and name in cp[1]], key=lambda cp: cp[1][name])
+				keep.update(cp[0] for cp in ranked[:self.keep_best])
+
+		keep.update(self.pending)
+
+		for cp in self.saved:
+			if cp[0] not in keep and os.path.isfile(cp[0]):
+				os.remove(cp[0])
+
+		self.saved = [cp for cp in self.saved if cp[0] in keep]
+
+	def remove(self, path):
+		self.saved = [cp for cp in self.saved if cp[0]!=path]
+		if os.path.isfile(path):
+			os.remove(path)
+
+	def check_error(self):
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise error
+
+	def wait(self):
+		# Blocks until every queued checkpoint is on disk
+		self.queue.join()
+		self.check_error()
+
+	def close(self):
+		self.wait()
+		self.queue.put(None)
+		self.thread.join()
+
+if __name__ == '__main__':
+
+	import tempfile
+	import time
+
+	with tempfile.TemporaryDirectory() as path:
+
+		checkpointer = AsyncCheckpointer(keep_last=2, keep_best=1)
+		scores = [0.3, 0.1, 0.2, 0.25, 0.4, 0.35]
+		model = torch.nn.Linear(10, 10)
+
+		for epoch, score in enumerate(scores):
+			start = time.time()
+			checkpointer.save({'model_state': model.state_dict(), 'history': {'eer': scores[:epoch+1]}}, os.path.join(path, 'checkpoint_{}ep.pt'.format(epoch)), scores={'eer': score})
+			print('Epoch {}: save returned after {:.4f}s'.format(epoch, time.time()-start))
+			# Updating the model right away must not affect the snapshot being written
+			with torch.no_grad():
+				model.weight.add_(1.0)
+
+		checkpointer.close()
+
+		files = sorted(os.listdir(path))
+		print('Kept: {}'.format(files))
+		assert files == ['checkpoint_1ep.pt', 'checkpoint_4ep.pt', 'checkpoint_5ep.pt']
+		assert (torch.load(os.path.join(path, 'checkpoint_1ep.pt'))['model_state']['weight'] - model.weight.detach()).abs().max().item() > 4.0
+
+		# Pending checkpoints survive retention until scored
+		checkpointer = AsyncCheckpointer(keep_last=1, keep_best=1)
+		for epoch in range(3):
+			checkpointer.save({'model_state': model.state_dict()}, os.path.join(path, 'pending_{}ep.pt'.format(epoch)), pending=True)
+		checkpointer.update(os.path.join(path, 'pending_0ep.pt'), scores={'eer': 0.1})
+		checkpointer.update(os.path.join(path, 'pending_1ep.pt'), keep=False)
+		checkpointer.update(os.path.join(path, 'pending_2ep.pt'), scores={'eer': 0.2})
+		checkpointer.close()
+		assert sorted([name for name in os.listdir(path) if name.startswith('pending')]) == ['pending_0ep.pt', 'pending_2ep.pt']
+
+		# keep_best without keep_last
+		checkpointer = AsyncCheckpointer(keep_best=1)
+		for epoch, score in enumerate([0.3, 0.1, 0.2, 0.4]):
+			checkpointer.save({'model_state': model.state_dict()}, os.path.join(path, 'best_{}ep.pt'.format(epoch)), scores={'eer': score})
+		checkpointer.close()
+		assert sorted([name for name in os.listdir(path) if name.startswith('best')]) == ['best_1ep.pt', 'best_3ep.pt']
+
+	print('OK')
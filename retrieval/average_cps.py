@@ -7,14 +7,17 @@ import os
 import re
 
 
-def average_checkpoints(inputs):
+def average_checkpoints(inputs, averaged=False):
 	"""Loads checkpoints from inputs and returns a model with averaged weights.
 
 	Args:
 	  inputs: An iterable of string paths of checkpoints to load from.
+	  averaged: Averages the weights averaged during training (the
+	    'averaged_state' of TrainLoops run with --average) instead of the
+	    trained ones.
 
 	Returns:
-	  A dict of string keys mapping to various values. The 'model' key
+	  A dict of string keys mapping to various values. The 'model_state' key
 	  from the returned dict should correspond to an OrderedDict mapping
 	  string parameter names to torch Tensors.
 	"""
@@ -34,7 +37,13 @@ def average_checkpoints(inputs):
 		if new_state is None:
 			new_state = state
 
-		model_params = state['model']
+		# TrainLoop checkpoints store the weights under 'model_state', older ones under 'model'
+		if averaged:
+			if not state.get('averaged_state'):
+				raise KeyError('Checkpoint {} has no averaged weights'.format(f))
+			model_params = state['averaged_state']['model_state']
+		else:
+			model_params = state['model_state'] if 'model_state' in state else state['model']
 
 		model_params_keys = list(model_params.keys())
 		if params_keys is None:
@@ -52,14 +61,18 @@ def average_checkpoints(inputs):
 			if k not in params_dict:
 				params_dict[k] = p.clone()
 				# NOTE: clone() is needed in case of p is a shared parameter
-			else:
+			elif p.is_floating_point():
 				params_dict[k] += p
 
 	averaged_params = collections.OrderedDict()
 	for k, v in params_dict.items():
 		averaged_params[k] = v
-		averaged_params[k].div_(num_models)
-	new_state['model'] = averaged_params
+		# Integer buffers (BatchNorm num_batches_tracked) are taken from the first checkpoint
+		if v.is_floating_point():
+			averaged_params[k].div_(num_models)
+	new_state.pop('model', None)
+	new_state['model_state'] = averaged_params
+	new_state['averaged_state'] = None
 	return new_state
 
 
@@ -67,9 +80,9 @@ def last_n_checkpoints(paths, n, update_based, upper_bound=None):
 	assert len(paths) == 1
 	path = paths[0]
 	if update_based:
-		pt_regexp = re.compile(r'checkpoint_\d+_(\d+)\ep.pt')
+		pt_regexp = re.compile(r'checkpoint_(\d+)it\.pt')
 	else:
-		pt_regexp = re.compile(r'checkpoint(\d+)\ep.pt')
+		pt_regexp = re.compile(r'checkpoint_(\d+)ep\.pt')
 	files = os.listdir(path)
 
 	entries = []
@@ -90,8 +103,9 @@ def main():
 	parser.add_argument('--inputs', required=True, nargs='+', help='Input checkpoint file paths.')
 	parser.add_argument('--output', required=True, metavar='FILE', help='Write the new checkpoint containing the averaged weights to this path.')
 	num_group = parser.add_mutually_exclusive_group()
-	num_group.add_argument('--num-epoch-checkpoints', type=int, help='if set, will try to find checkpoints with names checkpoint_xx.pt in the path specified by input, and average last this many of them.')
-	num_group.add_argument('--num-update-checkpoints', type=int, help='if set, will try to find checkpoints with names checkpoint_ee_xx.pt in the path specified by input, and average last this many of them.')
+	num_group.add_argument('--num-epoch-checkpoints', type=int, help='if set, will try to find checkpoints with names checkpoint_{epoch}ep.pt in the path specified by input, and average last this many of them.')
+	num_group.add_argument('--num-update-checkpoints', type=int, help='if set, will try to find checkpoints with names checkpoint_{iteration}it.pt in the path specified by input, and average last this many of them.')
+	parser.add_argument('--averaged', action='store_true', default=False, help='Uses the weights averaged during training (train.py --average) instead of the trained ones. With a single input, extracts them as a regular checkpoint.')
 	parser.add_argument('--checkpoint-upper-bound', type=int, help='when using --num-epoch-checkpoints, this will set an upper bound on which checkpoint to use, e.g., with --num-epoch-checkpoints=10 --checkpoint-upper-bound=50, checkpoints 41-50 would be averaged.')
 	# fmt: on
 	args = parser.parse_args()
@@ -116,7 +130,7 @@ def main():
 		)
 		print('averaging checkpoints: ', args.inputs)
 
-	new_state = average_checkpoints(args.inputs)
+	new_state = average_checkpoints(args.inputs, averaged=args.averaged)
 	torch.save(new_state, args.output)
 	print('Finished writing averaged checkpoint to {}.'.format(args.output))
 
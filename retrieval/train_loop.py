@@ -4,16 +4,25 @@ import torch.nn.functional as F
 import numpy as np
 
 import os
+import time
 from tqdm import tqdm
 
 from harvester import HardestNegativeTripletSelector, AllTripletSelector
 from models.losses import LabelSmoothingLoss
 from utils import compute_eer
+from checkpointer import AsyncCheckpointer
+from stopping import EarlyStopping
+from profiler import StepProfiler
+from memory_bank import MemoryBank
+from preemption import PreemptionHandler, latest_checkpoint
+from averaging import WeightAverager, swapped_model
+from steplog import StepLog, history_state, load_history, close_history
+from metrics import MetricsLogger
 from data_load import Loader
 
 class TrainLoop(object):
 
-	def __init__(self, model, optimizer, train_loader, valid_loader, max_gnorm, patience, lr_factor, label_smoothing, verbose=-1, cp_name=None, save_cp=False, checkpoint_path=None, checkpoint_epoch=None, pretrain=False, cuda=True, logger=None):
+	def __init__(self, model, optimizer, train_loader, valid_loader, max_gnorm, patience, lr_factor, label_smoothing, verbose=-1, cp_name=None, save_cp=False, checkpoint_path=None, checkpoint_epoch=None, pretrain=False, cuda=True, logger=None, mixed_precision=False, keep_last=0, keep_best=0, log_sync_every=50, log_artifacts_every=1, stop_patience=0, stop_min_delta=0.0, max_time=0, max_steps=0, profile=False, profile_trace=None, profile_dir='./profile', bank_size=0, bank_max_age=0, bank_negatives=0, auto_resume=False, average=None, average_decay=0.999, average_every=1, average_start=0, average_bn_batches=0, average_valid=False):
 		if checkpoint_path is None:
 			# Save to current directory
 			self.checkpoint_path = os.getcwd()
@@ -23,6 +32,8 @@ class TrainLoop(object):
 				os.mkdir(self.checkpoint_path)
 
 		self.save_epoch_fmt = os.path.join(self.checkpoint_path, cp_name) if cp_name else os.path.join(self.checkpoint_path, 'checkpoint_{}ep.pt')
+		self.save_iter_fmt = os.path.join(self.checkpoint_path, cp_name) if cp_name else os.path.join(self.checkpoint_path, 'checkpoint_{}it.pt')
+		self.step_log_fmt = os.path.join(self.checkpoint_path, os.path.splitext(cp_name)[0]+'_{}.f32') if cp_name else os.path.join(self.checkpoint_path, 'steps_{}.f32')
 		self.cuda_mode = cuda
 		self.pretrain = pretrain
 		self.model = model
@@ -32,13 +43,38 @@ class TrainLoop(object):
 		self.valid_loader = valid_loader
 		self.total_iters = 0
 		self.cur_epoch = 0
+		# Batches done in the current epoch, so a run resumed from a mid-epoch checkpoint continues from the next one
+		self.epoch_step = 0
+		self.epoch_seed = None
 		self.harvester = AllTripletSelector()
 		self.verbose = verbose
 		self.save_cp = save_cp
 		self.device = next(self.model.parameters()).device
 		self.logger = logger
-		self.history = {'train_loss': [], 'train_loss_batch': [], 'ce_loss': [], 'ce_loss_batch': [], 'bin_loss': [], 'bin_loss_batch': []}
+		self.metrics = MetricsLogger(writer=logger, sync_every=log_sync_every, artifact_every=log_artifacts_every)
+		self.profiler = StepProfiler(enabled=profile, device=self.device, metrics=self.metrics, trace_steps=profile_trace, trace_dir=profile_dir)
+		# Extra negatives for the discriminator from recent batches
+		self.memory_bank = MemoryBank(bank_size, max_age=bank_max_age) if bank_size>0 else None
+		self.bank_negatives = bank_negatives
+		self.preemption = PreemptionHandler()
+		self.preempted = False
+		# Weights averaged in memory (EMA or SWA), optionally validated in place of the trained ones
+		self.averager = WeightAverager(self.model, mode=average, decay=average_decay, every=average_every, start=average_start) if average else None
+		self.average_bn_batches = average_bn_batches
+		self.average_valid = average_valid and self.averager is not None
+		# Per-step values are kept in float32 step logs, on disk next to the checkpoints when saving them
+		self.history = {'train_loss': [], 'train_loss_batch': self.step_log('train_loss_batch'), 'ce_loss': [], 'ce_loss_batch': self.step_log('ce_loss_batch'), 'bin_loss': [], 'bin_loss_batch': self.step_log('bin_loss_batch')}
 		self.disc_label_smoothing = label_smoothing*0.5
+		self.checkpointer = AsyncCheckpointer(keep_last=keep_last, keep_best=keep_best)
+		# Early stopping monitors the validation EERs, or the training loss without validation data
+		self.stopping = EarlyStopping(patience=stop_patience, min_delta=stop_min_delta, max_time=max_time, max_steps=max_steps)
+		self.monitored = ['e2e_eer', 'cos_eer'] if self.valid_loader is not None else ['train_loss']
+
+		# Mixed precision: float16 autocast with loss scaling on GPU, bfloat16 autocast (no scaling needed) on CPU.
+		# Losses (AM-softmax, label smoothing, BCE) are computed in float32 outside of autocast
+		self.mixed_precision = mixed_precision
+		self.amp_dtype = torch.float16 if self.device.type=='cuda' else torch.bfloat16
+		self.scaler = torch.cuda.amp.GradScaler(enabled=(mixed_precision and self.device.type=='cuda'))
 
 		if label_smoothing>0.0:
 			self.ce_criterion = LabelSmoothingLoss(label_smoothing, lbl_set_size=100)
@@ -54,15 +90,37 @@ class TrainLoop(object):
 
 		if checkpoint_epoch is not None:
 			self.load_checkpoint(self.save_epoch_fmt.format(checkpoint_epoch))
+		elif auto_resume:
+			# Newest checkpoint, e.g. written when the previous run was preempted
+			checkpoint = latest_checkpoint([self.save_epoch_fmt.format('*'), self.save_iter_fmt.format('*')])
+			if checkpoint is not None:
+				if self.verbose>0:
+					print('Resuming from {}'.format(checkpoint))
+				self.load_checkpoint(checkpoint)
 
 	def train(self, n_epochs=1, save_every=1):
 
+		self.history['stop_reason'] = None
+		self.preemption.install()
+
 		while (self.cur_epoch < n_epochs):
 
-			np.random.seed()
+			if self.epoch_step==0 or self.epoch_seed is None:
+				self.epoch_seed = np.random.RandomState().randint(2**31)
+			np.random.seed(self.epoch_seed)
 			if isinstance(self.train_loader.dataset, Loader):
 				self.train_loader.dataset.update_lists()
 
+			# A resumable sampler skips the examples already done in this epoch; any other sampler restarts it
+			if hasattr(self.train_loader.sampler, 'set_epoch'):
+				self.train_loader.sampler.set_epoch(self.cur_epoch)
+			if hasattr(self.train_loader.sampler, 'set_start'):
+				self.train_loader.sampler.set_start(self.epoch_step*self.train_loader.batch_size)
+			else:
+				self.epoch_step = 0
+
+			epoch_start = time.time()
+
 			if self.verbose>0:
 				print(' ')
 				print('Epoch {}/{}'.format(self.cur_epoch+1, n_epochs))
@@ -72,101 +130,142 @@ class TrainLoop(object):
 
 			if self.pretrain:
 
-				ce_epoch=0.0
 				for t, batch in train_iter:
 					ce = self.pretrain_step(batch)
 					self.history['train_loss_batch'].append(ce)
-					ce_epoch+=ce
-					if self.logger:
-						self.logger.add_scalar('Train/Cross entropy', ce, self.total_iters)
-						self.logger.add_scalar('Info/LR', self.optimizer.param_groups[0]['lr'], self.total_iters)
+					self.metrics.add_scalars(self.total_iters, **{'Train/Cross entropy': ce, 'Info/LR': self.optimizer.param_groups[0]['lr']})
 
 					self.total_iters += 1
+					self.epoch_step += 1
+					if self.preemption.requested:
+						return self.preempt()
+					if self.stopping.budget_reason(self.total_iters) is not None:
+						break
 
-				self.history['train_loss'].append(ce_epoch/(t+1))
+				self.epoch_mean('train_loss')
+				self.metrics.clear()
 
 				if self.verbose>0:
 					print('Train loss: {:0.4f}'.format(self.history['train_loss'][-1]))
 
 			else:
 
-				train_loss_epoch=0.0
-				ce_loss_epoch=0.0
-				bin_loss_epoch=0.0
+				self.profiler.begin_epoch()
 				for t, batch in train_iter:
+					self.profiler.begin_step()
 					train_loss, ce_loss, bin_loss = self.train_step(batch)
-					self.history['train_loss_batch'].append(train_loss)
-					self.history['ce_loss_batch'].append(ce_loss)
-					self.history['bin_loss_batch'].append(bin_loss)
-					train_loss_epoch+=train_loss
-					ce_loss_epoch+=ce_loss
-					bin_loss_epoch+=bin_loss
-					if self.logger:
-						self.logger.add_scalar('Train/Total train Loss', train_loss, self.total_iters)
-						self.logger.add_scalar('Train/Binary class. Loss', bin_loss, self.total_iters)
-						self.logger.add_scalar('Train/Cross enropy', ce_loss, self.total_iters)
-						self.logger.add_scalar('Info/LR', self.optimizer.param_groups[0]['lr'], self.total_iters)
+					self.profiler.end_step(self.total_iters)
+					# Losses stay on the device and are copied to the host every log_sync_every steps
+					self.metrics.add_scalars(self.total_iters, **{'Train/Total train Loss': train_loss, 'Train/Binary class. Loss': bin_loss, 'Train/Cross enropy': ce_loss, 'Info/LR': self.optimizer.param_groups[0]['lr']})
 
 					self.total_iters += 1
-
-				self.history['train_loss'].append(train_loss_epoch/(t+1))
-				self.history['ce_loss'].append(ce_loss_epoch/(t+1))
-				self.history['bin_loss'].append(bin_loss_epoch/(t+1))
+					self.epoch_step += 1
+					if self.averager is not None:
+						self.averager.update(self.model, self.total_iters)
+					if self.preemption.requested:
+						return self.preempt()
+					if self.stopping.budget_reason(self.total_iters) is not None:
+						break
+
+				for key, tag in [('train_loss', 'Train/Total train Loss'), ('ce_loss', 'Train/Cross enropy'), ('bin_loss', 'Train/Binary class. Loss')]:
+					values = self.metrics.collect(tag)
+					self.history[key+'_batch'].extend(values)
+					if len(values)>0:
+						self.history[key].append(np.mean(values))
+					elif len(self.history[key])>0:
+						# No step this epoch (e.g. resumed from a checkpoint written after its last step): the previous
+						# epoch loss is carried rather than the nan mean of nothing
+						self.history[key].append(self.history[key][-1])
+				self.metrics.clear()
 
 				if self.verbose>0:
 					print(' ')
+					print('Logging overhead: {:0.2f}% of train time'.format(100.*self.metrics.pop_overhead()/(time.time()-epoch_start)))
 					print('Total train loss: {:0.4f}'.format(self.history['train_loss'][-1]))
 					print('CE loss: {:0.4f}'.format(self.history['ce_loss'][-1]))
 					print('Binary classification loss: {:0.4f}'.format(self.history['bin_loss'][-1]))
 					print(' ')
+					if self.profiler.enabled:
+						print(self.profiler.summary())
+						print(' ')
 
-			if self.valid_loader is not None:
+			if self.averager is not None and self.average_bn_batches>0:
+				self.averager.recalibrate_bn(self.train_loader, self.average_bn_batches, self.device)
 
-				e2e_scores, cos_scores, labels = None, None, None
+			with swapped_model(self, self.averager.model if self.average_valid else None):
 
-				for t, batch in enumerate(self.valid_loader):
-					e2e_scores_batch, cos_scores_batch, labels_batch = self.valid(batch)
+				if self.valid_loader is not None:
 
-					try:
-						e2e_scores = np.concatenate([e2e_scores, e2e_scores_batch], 0)
-						cos_scores = np.concatenate([cos_scores, cos_scores_batch], 0)
-						labels = np.concatenate([labels, labels_batch], 0)
-					except:
-						e2e_scores, cos_scores, labels = e2e_scores_batch, cos_scores_batch, labels_batch
+					e2e_scores, cos_scores, labels = None, None, None
 
-				self.history['e2e_eer'].append(compute_eer(labels, e2e_scores))
-				self.history['cos_eer'].append(compute_eer(labels, cos_scores))
+					for t, batch in enumerate(self.valid_loader):
+						e2e_scores_batch, cos_scores_batch, labels_batch = self.valid(batch)
 
-				if self.logger:
-					self.logger.add_scalar('Valid/E2E EER', self.history['e2e_eer'][-1], self.total_iters-1)
-					self.logger.add_scalar('Valid/Best E2E EER', np.min(self.history['e2e_eer']), self.total_iters-1)
-					self.logger.add_scalar('Valid/Cosine EER', self.history['cos_eer'][-1], self.total_iters-1)
-					self.logger.add_scalar('Valid/Best Cosine EER', np.min(self.history['cos_eer']), self.total_iters-1)
-					self.logger.add_pr_curve('E2E ROC', labels=labels, predictions=e2e_scores, global_step=self.total_iters-1)
-					self.logger.add_pr_curve('Cosine ROC', labels=labels, predictions=cos_scores, global_step=self.total_iters-1)
-					self.logger.add_histogram('Valid/COS_Scores', values=cos_scores, global_step=self.total_iters-1)
-					self.logger.add_histogram('Valid/E2E_Scores', values=e2e_scores, global_step=self.total_iters-1)
-					self.logger.add_histogram('Valid/Labels', values=labels, global_step=self.total_iters-1)
+						try:
+							e2e_scores = np.concatenate([e2e_scores, e2e_scores_batch], 0)
+							cos_scores = np.concatenate([cos_scores, cos_scores_batch], 0)
+							labels = np.concatenate([labels, labels_batch], 0)
+						except:
+							e2e_scores, cos_scores, labels = e2e_scores_batch, cos_scores_batch, labels_batch
 
-				if self.verbose>0:
-					print(' ')
-					print('Current e2e EER, best e2e EER, and epoch: {:0.4f}, {:0.4f}, {}'.format(self.history['e2e_eer'][-1], np.min(self.history['e2e_eer']), 1+np.argmin(self.history['e2e_eer'])))
-					print('Current cos EER, best cos EER, and epoch: {:0.4f}, {:0.4f}, {}'.format(self.history['cos_eer'][-1], np.min(self.history['cos_eer']), 1+np.argmin(self.history['cos_eer'])))
+					self.history['e2e_eer'].append(compute_eer(labels, e2e_scores))
+					self.history['cos_eer'].append(compute_eer(labels, cos_scores))
 
-				self.scheduler.step(np.min([self.history['e2e_eer'][-1], self.history['cos_eer'][-1]]))
+					if self.logger:
+						self.metrics.add_scalars(self.total_iters-1, **{'Valid/E2E EER': self.history['e2e_eer'][-1], 'Valid/Best E2E EER': np.min(self.history['e2e_eer']), 'Valid/Cosine EER': self.history['cos_eer'][-1], 'Valid/Best Cosine EER': np.min(self.history['cos_eer'])})
+						self.metrics.clear()
 
-			else:
-				self.scheduler.step()
+						# Written from the logging thread, subsampled and every log_artifacts_every epochs
+						self.metrics.add_artifact('add_pr_curve', 'E2E ROC', self.total_iters-1, labels=labels, predictions=e2e_scores)
+						self.metrics.add_artifact('add_pr_curve', 'Cosine ROC', self.total_iters-1, labels=labels, predictions=cos_scores)
+						self.metrics.add_artifact('add_histogram', 'Valid/COS_Scores', self.total_iters-1, values=cos_scores)
+						self.metrics.add_artifact('add_histogram', 'Valid/E2E_Scores', self.total_iters-1, values=e2e_scores)
+						self.metrics.add_artifact('add_histogram', 'Valid/Labels', self.total_iters-1, values=labels)
+
+					if self.verbose>0:
+						print(' ')
+						print('Current e2e EER, best e2e EER, and epoch: {:0.4f}, {:0.4f}, {}'.format(self.history['e2e_eer'][-1], np.min(self.history['e2e_eer']), 1+np.argmin(self.history['e2e_eer'])))
+						print('Current cos EER, best cos EER, and epoch: {:0.4f}, {:0.4f}, {}'.format(self.history['cos_eer'][-1], np.min(self.history['cos_eer']), 1+np.argmin(self.history['cos_eer'])))
+
+					self.scheduler.step(np.min([self.history['e2e_eer'][-1], self.history['cos_eer'][-1]]))
+
+				else:
+					self.scheduler.step()
 
 			if self.verbose>0:
 				print('Current LR: {}'.format(self.optimizer.param_groups[0]['lr']))
 
+			self.epoch_step = 0
 			self.cur_epoch += 1
 
+			stop_reason = self.stopping.stop_reason(self.history, self.monitored, self.total_iters)
+			if stop_reason is not None:
+				self.history['stop_reason'] = stop_reason
+				self.history['best_epoch'] = self.stopping.best_epoch(self.history, self.monitored)
+				self.history['last_improvement'] = self.stopping.last_improvement(self.history, self.monitored)
+
 			if self.valid_loader is not None and self.save_cp and (self.cur_epoch % save_every == 0 or self.history['e2e_eer'][-1] < np.min([np.inf]+self.history['e2e_eer'][:-1]) or self.history['cos_eer'][-1] < np.min([np.inf]+self.history['cos_eer'][:-1])):
 					self.checkpointing()
 			elif self.save_cp and self.cur_epoch % save_every == 0:
 					self.checkpointing()
+			elif self.save_cp and stop_reason is not None:
+					self.checkpointing()
+
+			if stop_reason is not None:
+				if self.verbose>0:
+					print('Stopping after epoch {}: {}. Best epoch: {}'.format(self.cur_epoch, stop_reason, self.history['best_epoch']))
+				break
+
+		if self.history['stop_reason'] is None:
+			self.history['stop_reason'] = 'completed {} epochs'.format(n_epochs)
+			self.history['best_epoch'] = self.stopping.best_epoch(self.history, self.monitored)
+			self.history['last_improvement'] = self.stopping.last_improvement(self.history, self.monitored)
+
+		self.profiler.close()
+		self.preemption.restore()
+		self.checkpointer.wait()
+		self.metrics.flush()
+		close_history(self.history)
 
 		if self.verbose>0:
 			print('Training done!')
@@ -192,41 +291,63 @@ class TrainLoop(object):
 		else:
 			x, y = batch
 
-		x = x.to(self.device, non_blocking=True)
-		y = y.to(self.device, non_blocking=True)
+		with self.profiler.phase('h2d'):
+			x = x.to(self.device, non_blocking=True)
+			y = y.to(self.device, non_blocking=True)
 
-		embeddings, out = self.model.forward(x)
+		with self.profiler.phase('forward'):
+			with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.mixed_precision):
+				embeddings, out = self.model.forward(x)
 
-		ce_loss = self.ce_criterion(self.model.out_proj(out, y), y)
+			embeddings, out = embeddings.float(), out.float()
 
-		# Get all triplets now for bin classifier
-		triplets_idx = self.harvester.get_triplets(embeddings.detach(), y)
-		triplets_idx = triplets_idx.to(self.device, non_blocking=True)
+			ce_loss = self.ce_criterion(self.model.out_proj(out, y), y)
 
-		emb_a = torch.index_select(embeddings, 0, triplets_idx[:, 0])
-		emb_p = torch.index_select(embeddings, 0, triplets_idx[:, 1])
-		emb_n = torch.index_select(embeddings, 0, triplets_idx[:, 2])
+		with self.profiler.phase('mining'):
+			# Get all triplets now for bin classifier
+			triplets_idx = self.harvester.get_triplets(embeddings.detach(), y)
+			triplets_idx = triplets_idx.to(self.device, non_blocking=True)
+			if self.memory_bank is not None:
+				# Bank entry i is row batch_size+i of the negatives, copied before the batch is pushed
+				triplets_idx = self.memory_bank.extend_triplets(triplets_idx, y, self.total_iters, self.bank_negatives, offset=embeddings.size(0))
+				negatives = embeddings if self.memory_bank.embeddings is None else torch.cat([embeddings, self.memory_bank.embeddings], 0)
+				self.memory_bank.push(embeddings, y, self.total_iters)
+			else:
+				negatives = embeddings
+		self.profiler.count('n_triplets', triplets_idx.size(0))
 
-		emb_ap = torch.cat([emb_a, emb_p],1)
-		emb_an = torch.cat([emb_a, emb_n],1)
-		emb_ = torch.cat([emb_ap, emb_an],0)
+		with self.profiler.phase('disc_forward'):
+			emb_a = torch.index_select(embeddings, 0, triplets_idx[:, 0])
+			emb_p = torch.index_select(embeddings, 0, triplets_idx[:, 1])
+			emb_n = torch.index_select(negatives, 0, triplets_idx[:, 2])
 
-		y_ = torch.cat([torch.rand(emb_ap.size(0))*self.disc_label_smoothing+(1.0-self.disc_label_smoothing), torch.rand(emb_an.size(0))*self.disc_label_smoothing],0) if isinstance(self.ce_criterion, LabelSmoothingLoss) else torch.cat([torch.ones(emb_ap.size(0)), torch.zeros(emb_an.size(0))],0)
-		y_ = y_.to(self.device, non_blocking=True)
+			emb_ap = torch.cat([emb_a, emb_p],1)
+			emb_an = torch.cat([emb_a, emb_n],1)
+			emb_ = torch.cat([emb_ap, emb_an],0)
+
+			y_ = torch.cat([torch.rand(emb_ap.size(0))*self.disc_label_smoothing+(1.0-self.disc_label_smoothing), torch.rand(emb_an.size(0))*self.disc_label_smoothing],0) if isinstance(self.ce_criterion, LabelSmoothingLoss) else torch.cat([torch.ones(emb_ap.size(0)), torch.zeros(emb_an.size(0))],0)
+			y_ = y_.to(self.device, non_blocking=True)
 
-		pred_bin = self.model.forward_bin(emb_).squeeze()
+			with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.mixed_precision):
+				pred_bin = self.model.forward_bin(emb_).squeeze()
 
-		loss_bin = torch.nn.BCELoss()(pred_bin, y_)
+			loss_bin = torch.nn.BCELoss()(pred_bin.float(), y_)
 
 		loss = ce_loss + loss_bin
-		loss.backward()
-		grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_gnorm)
-		self.optimizer.step()
+		with self.profiler.phase('backward'):
+			self.scaler.scale(loss).backward()
+		with self.profiler.phase('clip'):
+			self.scaler.unscale_(self.optimizer)
+			grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_gnorm)
+		with self.profiler.phase('step'):
+			self.scaler.step(self.optimizer)
+			self.scaler.update()
 
 		if self.logger:
-			self.logger.add_scalar('Info/Grad_norm', grad_norm, self.total_iters)
+			self.metrics.add_scalars(self.total_iters, **{'Info/Grad_norm': grad_norm})
 
-		return loss.item(), ce_loss.item(), loss_bin.item()
+		# Detached device tensors, see metrics.py
+		return loss.detach(), ce_loss.detach(), loss_bin.detach()
 
 
 	def pretrain_step(self, batch):
@@ -264,7 +385,10 @@ class TrainLoop(object):
 			x = x.to(self.device, non_blocking=True)
 			y = y.to(self.device, non_blocking=True)
 
-			embeddings, out = self.model.forward(x)
+			with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.mixed_precision):
+				embeddings, out = self.model.forward(x)
+
+			embeddings, out = embeddings.float(), out.float()
 
 			# Get all triplets now for bin classifier
 			triplets_idx = self.harvester.get_triplets(embeddings.detach(), y)
@@ -284,12 +408,26 @@ class TrainLoop(object):
 
 		return np.concatenate([e2e_scores_p.detach().cpu().numpy(), e2e_scores_n.detach().cpu().numpy()], 0), np.concatenate([cos_scores_p.detach().cpu().numpy(), cos_scores_n.detach().cpu().numpy()], 0), np.concatenate([np.ones(e2e_scores_p.size(0)), np.zeros(e2e_scores_n.size(0))], 0)
 
-	def checkpointing(self):
+	def step_log(self, key):
+		# Checkpoints only reference the log files, so their size does not grow with the number of steps
+		return StepLog(path=self.step_log_fmt.format(key) if self.save_cp else None)
+
+	def epoch_mean(self, key):
+		# Mean of the current epoch over the step log of key, which also holds the steps done before a resumed
+		# checkpoint. Epochs without steps carry the previous mean
+		log = self.history[key+'_batch']
+		if self.epoch_step>0:
+			self.history[key].append(np.mean(log[len(log)-self.epoch_step:]))
+		elif len(self.history[key])>0:
+			self.history[key].append(self.history[key][-1])
+
+	def checkpointing(self, path=None):
 
 		# Checkpointing
 		if self.verbose>0:
 			print('Checkpointing...')
 		ckpt = {'model_state': self.model.state_dict(),
+		'averaged_state': self.averager.state_dict() if self.averager is not None else None,
 		'dropout_prob': self.model.dropout_prob,
 		'n_hidden': self.model.n_hidden,
 		'hidden_size': self.model.hidden_size,
@@ -298,13 +436,37 @@ class TrainLoop(object):
 		'emb_size': self.model.emb_size,
 		'optimizer_state': self.optimizer.state_dict(),
 		'scheduler_state': self.scheduler.state_dict(),
-		'history': self.history,
+		'scaler_state': self.scaler.state_dict(),
+		'history': history_state(self.history),
 		'total_iters': self.total_iters,
-		'cur_epoch': self.cur_epoch}
-		try:
-			torch.save(ckpt, self.save_epoch_fmt.format(self.cur_epoch))
-		except:
-			torch.save(ckpt, self.save_epoch_fmt)
+		'cur_epoch': self.cur_epoch,
+		'epoch_step': self.epoch_step,
+		'epoch_seed': self.epoch_seed,
+		'stopping_state': self.stopping.state_dict(),
+		'epoch_metrics': self.epoch_metrics()}
+		# Written in the background; best checkpoints are ranked by validation EER for retention
+		scores = {'e2e_eer': self.history['e2e_eer'][-1], 'cos_eer': self.history['cos_eer'][-1]} if self.valid_loader is not None and path is None and self.epoch_step==0 else None
+		self.checkpointer.save(ckpt, path if path is not None else self.save_epoch_fmt.format(self.cur_epoch), scores=scores)
+
+	def epoch_metrics(self):
+		# Per-step values of the current epoch not yet moved to history
+		self.metrics.sync()
+		return {tag: list(values) for tag, values in self.metrics.values.items()}
+
+	def preempt(self):
+		# Called between steps: the mid-epoch checkpoint resumes from the next batch (see auto_resume). The caller exits
+		# with preemption.PREEMPTED_EXIT_CODE when self.preempted is set
+		self.preempted = True
+		self.history['stop_reason'] = 'preempted by signal {}'.format(self.preemption.received)
+		if self.save_cp:
+			self.checkpointing(self.save_iter_fmt.format(self.total_iters))
+		self.profiler.close()
+		self.preemption.restore()
+		self.checkpointer.wait()
+		self.metrics.flush()
+		close_history(self.history)
+		if self.verbose>1:
+			print('Preempted after {} iterations ({})'.format(self.total_iters, self.history['stop_reason']))
 
 	def load_checkpoint(self, ckpt):
 
@@ -313,14 +475,27 @@ class TrainLoop(object):
 			ckpt = torch.load(ckpt, map_location = lambda storage, loc: storage)
 			# Load model state
 			self.model.load_state_dict(ckpt['model_state'])
+			# Averaged weights, absent from checkpoints of runs without averaging
+			if self.averager is not None and ckpt.get('averaged_state'):
+				self.averager.load_state_dict(ckpt['averaged_state'])
 			# Load optimizer state
 			self.optimizer.load_state_dict(ckpt['optimizer_state'])
+			# Load loss scaler state if available; checkpoints without it (or from float32 runs) start with a fresh scale
+			if 'scaler_state' in ckpt and ckpt['scaler_state']:
+				self.scaler.load_state_dict(ckpt['scaler_state'])
 			# Load scheduler state
 			self.scheduler.load_state_dict(ckpt['scheduler_state'])
 			# Load history
-			self.history = ckpt['history']
+			self.history = load_history(self.history, ckpt['history'])
 			self.total_iters = ckpt['total_iters']
 			self.cur_epoch = ckpt['cur_epoch']
+			# Mid-epoch state, absent from older checkpoints
+			self.epoch_step = ckpt.get('epoch_step', 0)
+			self.epoch_seed = ckpt.get('epoch_seed', None)
+			# Training time of the time budget, absent from older checkpoints
+			if ckpt.get('stopping_state'):
+				self.stopping.load_state_dict(ckpt['stopping_state'])
+			self.metrics.values = ckpt.get('epoch_metrics', {})
 			if self.cuda_mode:
 				self.model = self.model.cuda(self.device)
 